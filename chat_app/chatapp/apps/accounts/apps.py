@@ -7,4 +7,5 @@ class AccountsConfig(AppConfig):
     name = 'apps.accounts'
     
     def ready(self):
+        import apps.accounts.checks
         import apps.accounts.signals
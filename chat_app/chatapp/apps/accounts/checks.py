@@ -0,0 +1,23 @@
+# apps/accounts/checks.py
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, Tags, register
+
+
+def is_shared(cache):
+    """Whether every process sees what the others write to cache"""
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+@register(Tags.caches, deploy=True)
+def check_version_stamps_cache(app_configs, **kwargs):
+    """ETags are checked against version stamps, which other workers have to see move"""
+    if is_shared(caches['default']):
+        return []
+    return [Error(
+        'The default cache is not shared between processes, so the version '
+        'stamps behind ETags go stale in every worker but the one that moved them.',
+        hint="Point CACHES['default'] at a shared cache such as Redis.",
+        id='accounts.E001',
+    )]
@@ -35,6 +35,7 @@ class User(AbstractUser):
         indexes = [
             models.Index(fields=['email']),
             models.Index(fields=['username']),
+            models.Index(fields=['is_online', 'last_seen']),
         ]
     
     def __str__(self):
@@ -1,8 +1,9 @@
 # apps/accounts/signals.py
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
-from .models import UserProfile
+from .models import Notification, UserProfile
+from .versions import stamps
 
 User = get_user_model()
 
@@ -18,4 +19,15 @@ def create_user_profile(sender, instance, created, **kwargs):
 def save_user_profile(sender, instance, **kwargs):
     """Save the UserProfile when the User is saved"""
     if hasattr(instance, 'profile'):
-        instance.profile.save()
\ No newline at end of file
+        instance.profile.save()
+
+
+@receiver([post_save, post_delete], sender=User)
+def bump_users_version(sender, instance, **kwargs):
+    """Profiles are embedded in most API responses"""
+    stamps.bump('users')
+
+
+@receiver([post_save, post_delete], sender=Notification)
+def bump_notifications_version(sender, instance, **kwargs):
+    stamps.bump(f'notifications:{instance.recipient_id}')
@@ -1,3 +1,15 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from .checks import check_version_stamps_cache
 
-# Create your tests here.
+
+class VersionStampsCacheCheckTests(TestCase):
+    def test_a_per_process_cache_fails_the_deploy_check(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([error.id for error in check_version_stamps_cache(None)], ['accounts.E001'])
+    
+    def test_a_shared_cache_passes(self):
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': 'redis://localhost:6379/1',
+        }}):
+            self.assertEqual(check_version_stamps_cache(None), [])
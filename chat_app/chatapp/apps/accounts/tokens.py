@@ -0,0 +1,14 @@
+# apps/accounts/tokens.py
+from rest_framework_simplejwt.tokens import RefreshToken as BaseRefreshToken
+
+
+class RefreshToken(BaseRefreshToken):
+    """Refresh token whose access tokens also carry the user's chat identity"""
+    
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        # Copied into every access token, lets the WebSocket auth skip the user lookup
+        token['username'] = user.username
+        token['avatar'] = user.avatar.name if user.avatar else ''
+        return token
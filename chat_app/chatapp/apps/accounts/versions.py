@@ -0,0 +1,46 @@
+# apps/accounts/versions.py
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+
+class VersionStamps:
+    """
+    Version stamps of what clients poll, so ETags are built without loading rows.
+    
+    A stamp covers something like a room, a user's inbox or the public feed
+    and changes whenever a write to it commits. Stamps live in the default
+    cache, which has to be shared (Redis) when several processes serve
+    requests, see apps.accounts.checks. A missing stamp, never set or evicted, is created from the
+    clock, so it never comes back with a value an old ETag was built from.
+    
+    Read the stamps before the data they cover: a write landing in between
+    then only costs the client one more full response.
+    """
+    
+    prefix = 'version:'
+    
+    def get_many(self, names):
+        """Current stamps of names, in order"""
+        keys = [self.prefix + name for name in names]
+        found = cache.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            now = time.time_ns()
+            for key in missing:
+                cache.add(key, now, timeout=None)
+            found.update(cache.get_many(missing))
+        return [found.get(key) for key in keys]
+    
+    def get(self, name):
+        return self.get_many([name])[0]
+    
+    def bump(self, *names):
+        """Move the stamps on once the current transaction commits"""
+        if names:
+            transaction.on_commit(lambda: cache.set_many(
+                {self.prefix + name: time.time_ns() for name in names}, timeout=None
+            ))
+
+
+stamps = VersionStamps()
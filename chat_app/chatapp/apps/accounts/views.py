@@ -1,8 +1,11 @@
 from django.contrib.auth import authenticate, login as auth_login
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from .forms import UserRegistrationForm, UserProfileForm
 from .models import User, UserProfile, Notification
+from .versions import stamps
 
 def login_view(request):
     if request.method == 'POST':
@@ -72,10 +75,19 @@ def edit_profile(request):
 def notifications(request):
     notifications = request.user.notifications.all()[:20]
     # Mark as read
-    request.user.notifications.filter(is_read=False).update(is_read=True)
+    if request.user.notifications.filter(is_read=False).update(is_read=True):
+        stamps.bump(f'notifications:{request.user.id}')
     return render(request, 'accounts/notifications.html', {'notifications': notifications})
 
+def notification_count_etag(request):
+    # Polled by every open tab, answered with a 304 without counting anything while unchanged
+    if request.user.is_authenticated:
+        return str(stamps.get(f'notifications:{request.user.id}'))
+    return None
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=notification_count_etag)
 def notification_count(request):
     from django.http import JsonResponse
     count = request.user.notifications.filter(is_read=False).count()
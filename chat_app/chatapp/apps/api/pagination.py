@@ -0,0 +1,168 @@
+# apps/api/pagination.py
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Newest-first pagination on (created_at, id), without COUNT or OFFSET.
+    
+    Every page is a range scan starting at a position, so deep pages cost
+    the same as the first one. Clients follow the opaque `next` (older)
+    and `previous` (newer) links, or jump to an object by id:
+    
+    - ?before=<id>: the page of objects older than it
+    - ?after=<id>:  the page of objects newer than it
+    - ?around=<id>: the object itself with about half a page on each side
+    
+    Results are always newest first. The queryset must not be sliced or
+    ordered by the view, the paginator orders it.
+    """
+    
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    anchor_query_params = ('before', 'after', 'around')
+    invalid_cursor_message = 'Invalid cursor'
+    
+    def paginate_queryset(self, queryset, request, view=None):
+        self.set_base_url(request)
+        size = self.get_page_size(request)
+        
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            direction, (created_at, pk) = self.decode_cursor(cursor)
+            try:
+                position = (created_at, queryset.model._meta.pk.to_python(pk))
+            except ValidationError:
+                raise NotFound(self.invalid_cursor_message)
+        else:
+            direction, position = self.get_anchor(queryset, request)
+        
+        newer, older = [], []
+        if direction == 'around':
+            newer, self.has_newer = self.newer(queryset, position, size // 2)
+            older, self.has_older = self.older(queryset, position, size - len(newer), inclusive=True)
+        elif direction == 'after':
+            newer, self.has_newer = self.newer(queryset, position, size)
+            # The position itself is older
+            self.has_older = bool(newer)
+        else:
+            older, self.has_older = self.older(queryset, position, size)
+            self.has_newer = position is not None and bool(older)
+        
+        self.page = list(reversed(newer)) + older
+        return self.page
+    
+    def paginate_newest(self, objects, has_older, request):
+        """Paginate the newest objects a view already holds (e.g. cached) as a first page"""
+        self.set_base_url(request)
+        self.page = list(objects)
+        self.has_newer = False
+        self.has_older = has_older
+        return self.page
+    
+    def is_first_page(self, request):
+        """Whether the request asks for the newest page"""
+        return not any(request.query_params.get(param) for param in (self.cursor_query_param,) + self.anchor_query_params)
+    
+    def set_base_url(self, request):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        for param in (self.cursor_query_param,) + self.anchor_query_params:
+            self.base_url = remove_query_param(self.base_url, param)
+    
+    def older(self, queryset, position, size, inclusive=False):
+        """(up to size objects at or before position, newest first; whether there are more)"""
+        queryset = queryset.order_by('-created_at', '-pk')
+        if position is not None:
+            created_at, pk = position
+            same_time = Q(created_at=created_at, pk__lte=pk) if inclusive else Q(created_at=created_at, pk__lt=pk)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | same_time)
+        objects = list(queryset[:size + 1])
+        return objects[:size], len(objects) > size
+    
+    def newer(self, queryset, position, size):
+        """(up to size objects after position, oldest first; whether there are more)"""
+        created_at, pk = position
+        objects = list(queryset.order_by('created_at', 'pk').filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+        )[:size + 1])
+        return objects[:size], len(objects) > size
+    
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+    
+    def get_anchor(self, queryset, request):
+        """(direction, position) of a ?before=/?after=/?around= id, or the newest end"""
+        for direction in self.anchor_query_params:
+            pk = request.query_params.get(direction)
+            if pk:
+                try:
+                    position = queryset.filter(pk=pk).values_list('created_at', 'pk').first()
+                except (ValidationError, ValueError):
+                    position = None
+                if position is None:
+                    raise NotFound(f'No object with id {pk} to page {direction}')
+                return direction, position
+        return 'before', None
+    
+    # Cursors
+    
+    def encode_cursor(self, direction, obj):
+        raw = f'{direction}|{obj.created_at.isoformat()}|{obj.pk}'
+        return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+    
+    def decode_cursor(self, cursor):
+        try:
+            raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            direction, created_at, pk = raw.split('|')
+            created_at = parse_datetime(created_at)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if direction not in ('before', 'after') or created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return direction, (created_at, pk)
+    
+    def link(self, direction, obj):
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(direction, obj))
+    
+    def get_next_link(self):
+        if not self.has_older:
+            return None
+        return self.link('before', self.page[-1])
+    
+    def get_previous_link(self):
+        if not self.has_newer:
+            return None
+        return self.link('after', self.page[0])
+    
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data
+        })
+    
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
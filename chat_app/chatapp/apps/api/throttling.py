@@ -0,0 +1,23 @@
+# apps/api/throttling.py
+from rest_framework.throttling import BaseThrottle
+from apps.chat.ratelimit import limiter
+
+
+class ChatActionThrottle(BaseThrottle):
+    """
+    Throttle a view action with the chat token buckets.
+    
+    The view maps its actions to the budget they draw from with
+    `rate_limit_actions`, e.g. {'create': 'send_message'}, so REST and
+    WebSocket clients share one allowance. Unmapped actions pass.
+    """
+    
+    def allow_request(self, request, view):
+        self.action = getattr(view, 'rate_limit_actions', {}).get(getattr(view, 'action', None))
+        self.user_id = request.user.pk
+        if self.action is None or self.user_id is None:
+            return True
+        return limiter.allow(self.user_id, self.action)
+    
+    def wait(self):
+        return limiter.retry_after(self.user_id, self.action)
@@ -2,7 +2,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .v1.accounts import AuthViewSet, UserViewSet
-from .v1.chat import ChatRoomViewSet, MessageViewSet
+from .v1.chat import ChatRoomViewSet, MessageViewSet, ChatMetricsView, SyncView
 from .v1.blog import PostViewSet, CommentViewSet
 
 router = DefaultRouter()
@@ -15,5 +15,7 @@ router.register(r'blog/comments', CommentViewSet, basename='comment')
 urlpatterns = [
     path('auth/register/', AuthViewSet.as_view({'post': 'register'}), name='register'),
     path('auth/login/', AuthViewSet.as_view({'post': 'login'}), name='login'),
+    path('chat/metrics/', ChatMetricsView.as_view(), name='chat-metrics'),
+    path('chat/sync/', SyncView.as_view(), name='chat-sync'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -3,10 +3,10 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
 from apps.accounts.serializers import UserSerializer, RegisterSerializer, UserProfileSerializer
 from apps.accounts.models import FriendRequest, Friendship
+from apps.accounts.tokens import RefreshToken
 
 User = get_user_model()
 
@@ -3,6 +3,9 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from apps.accounts.versions import stamps
+from apps.api.conditional import conditional, make_etag
+from apps.api.pagination import KeysetPagination
 from apps.blog.models import Post, Comment, PostLike, CommentLike
 from apps.blog.serializers import PostSerializer, CommentSerializer
 
@@ -11,6 +14,7 @@ class PostViewSet(viewsets.ModelViewSet):
     queryset = Post.objects.filter(is_public=True).select_related('author')
     serializer_class = PostSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = KeysetPagination
     lookup_field = 'slug'
     
     def get_queryset(self):
@@ -20,6 +24,13 @@ class PostViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(author_id=author_id)
         return queryset
     
+    def feed_etag(self, request):
+        # is_liked depends on the user
+        return make_etag(request.user.pk, request.get_full_path(), stamps.get_many(['feed', 'users']))
+    
+    def list(self, request, *args, **kwargs):
+        return conditional(request, self.feed_etag(request), lambda: super(PostViewSet, self).list(request, *args, **kwargs))
+    
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
     
@@ -44,9 +55,11 @@ class PostViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def feed(self, request):
-        posts = Post.objects.filter(is_public=True).order_by('-created_at')[:20]
-        serializer = self.get_serializer(posts, many=True)
-        return Response(serializer.data)
+        def respond():
+            posts = self.paginate_queryset(Post.objects.filter(is_public=True).select_related('author'))
+            serializer = self.get_serializer(posts, many=True)
+            return self.get_paginated_response(serializer.data)
+        return conditional(request, self.feed_etag(request), respond)
 
 
 class CommentViewSet(viewsets.ModelViewSet):
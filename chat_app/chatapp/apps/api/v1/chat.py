@@ -2,77 +2,200 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
-from django.db.models import Q, Max
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import F, Prefetch, Q
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from apps.accounts.versions import stamps
+from apps.api.conditional import conditional, make_etag
+from apps.api.pagination import KeysetPagination
+from apps.accounts.models import User
+from apps.api.throttling import ChatActionThrottle
+from apps.chat import metrics
+from apps.chat.cache import is_member, member_room_ids
+from apps.chat.changes import changes_since, current_token, decode_token
+from apps.chat.export import export_room, gzipped, streamed
+from apps.chat.memberships import (
+    add_members, create_room, parse_user_ids, remove_members, set_role, unknown_users
+)
 from apps.chat.models import ChatRoom, Message, ChatMembership
-from apps.chat.serializers import ChatRoomSerializer, MessageSerializer, ChatMemberSerializer
+from apps.chat.recent import recent_messages
+from apps.chat.serializers import (
+    ChatRoomSerializer, MessageSerializer, ChatMemberSerializer, MessageReactionSerializer
+)
+from apps.chat.search import decode_cursor, encode_cursor, search_index
+from apps.chat.services import add_reaction, open_direct_room, remove_reaction
+
+
+def member_rooms(user):
+    """The user's rooms, loaded for ChatRoomSerializer"""
+    # Last message and unread counters are denormalized, so a page is one query plus prefetches
+    return ChatRoom.objects.filter(members=user).select_related(
+        'last_message__sender', 'last_message__reply_to__sender'
+    ).prefetch_related(
+        Prefetch('chatmembership_set', queryset=ChatMembership.objects.select_related('user'))
+    ).order_by(F('last_message_at').desc(nulls_last=True), '-created_at')
 
 
 class ChatRoomViewSet(viewsets.ModelViewSet):
     serializer_class = ChatRoomSerializer
     permission_classes = [IsAuthenticated]
+    throttle_classes = [ChatActionThrottle]
+    rate_limit_actions = {'export': 'export'}
     
     def get_queryset(self):
-        return ChatRoom.objects.filter(members=self.request.user).annotate(
-            last_message_time=Max('messages__created_at')
-        ).order_by('-last_message_time')
+        return member_rooms(self.request.user)
+    
+    def list(self, request, *args, **kwargs):
+        # Changes with any of the user's rooms, their memberships or the members' profiles
+        room_ids = sorted(member_room_ids(request.user.id))
+        etag = make_etag(request.user.id, request.get_full_path(), room_ids, stamps.get_many(
+            [f'inbox:{request.user.id}', 'users'] + [f'room:{room_id}' for room_id in room_ids]
+        ))
+        return conditional(request, etag, lambda: super(ChatRoomViewSet, self).list(request, *args, **kwargs))
+    
+    def get_member_ids(self, request):
+        """(user ids of request.data['user_ids'] or ['member_ids'], error response or None)"""
+        try:
+            user_ids = parse_user_ids(request.data.get('user_ids', request.data.get('member_ids', [])))
+        except ValueError as e:
+            return None, Response({'error': str(e)}, status=400)
+        unknown = unknown_users(user_ids)
+        if unknown:
+            return None, Response({'error': 'Unknown users', 'user_ids': [str(user_id) for user_id in unknown]}, status=400)
+        return user_ids, None
+    
+    def get_admin_room(self):
+        """(group room the user administers, error response or None)"""
+        room = self.get_object()
+        if room.room_type != 'group':
+            return None, Response({'error': 'Can only manage members of groups'}, status=400)
+        if not ChatMembership.objects.filter(user=self.request.user, room=room, role='admin').exists():
+            return None, Response({'error': 'Only admins can manage members'}, status=403)
+        return room, None
     
     def create(self, request):
         room_type = request.data.get('room_type', 'direct')
         member_ids = request.data.get('member_ids', [])
         
         if room_type == 'direct' and len(member_ids) == 1:
-            # Check if direct room already exists
-            other_user_id = member_ids[0]
-            existing_room = ChatRoom.objects.filter(
-                room_type='direct',
-                members=request.user
-            ).filter(members__id=other_user_id).first()
-            
-            if existing_room:
-                serializer = self.get_serializer(existing_room)
-                return Response(serializer.data)
-        
-        # Create new room
-        room = ChatRoom.objects.create(
-            room_type=room_type,
-            name=request.data.get('name'),
-            created_by=request.user
-        )
+            # One indexed lookup on the pair's direct_key, created atomically if missing
+            try:
+                if not User.objects.filter(id=member_ids[0]).exists():
+                    return Response({'error': 'User not found'}, status=400)
+            except ValidationError:
+                return Response({'error': 'Invalid user id'}, status=400)
+            room, created = open_direct_room(request.user, member_ids[0])
+            serializer = self.get_serializer(room)
+            return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
         
-        # Add members
-        ChatMembership.objects.create(user=request.user, room=room, role='admin')
-        for user_id in member_ids:
-            ChatMembership.objects.create(user_id=user_id, room=room)
+        # New room and all its memberships in one transaction
+        member_ids, error = self.get_member_ids(request)
+        if error:
+            return error
+        room = create_room(request.user, room_type, request.data.get('name'), member_ids)
         
-        serializer = self.get_serializer(room)
+        serializer = self.get_serializer(self.get_queryset().get(id=room.id))
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     
     @action(detail=True, methods=['post'])
     def add_member(self, request, pk=None):
-        room = self.get_object()
-        user_id = request.data.get('user_id')
+        room, error = self.get_admin_room()
+        if error:
+            return error
+        try:
+            user_ids = parse_user_ids([request.data.get('user_id')])
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        if unknown_users(user_ids):
+            return Response({'error': 'Unknown users'}, status=400)
         
-        if room.room_type != 'group':
-            return Response({'error': 'Can only add members to groups'}, status=400)
+        add_members(room, user_ids)
+        return Response({'status': 'member added'})
+    
+    @action(detail=True, methods=['post', 'delete'])
+    def members(self, request, pk=None):
+        """
+        Add (POST) or remove (DELETE) up to CHAT_BULK_MEMBERS_MAX members at once.
         
-        membership = ChatMembership.objects.filter(user=request.user, room=room).first()
-        if not membership or membership.role != 'admin':
-            return Response({'error': 'Only admins can add members'}, status=403)
+        {"user_ids": [...], "role": "member"}, one transaction and a single
+        members frame per request. Answers with the ids actually added or
+        removed, users already in or not in the room are skipped.
+        """
+        room, error = self.get_admin_room()
+        if error:
+            return error
+        user_ids, error = self.get_member_ids(request)
+        if error:
+            return error
         
-        ChatMembership.objects.get_or_create(user_id=user_id, room=room)
-        return Response({'status': 'member added'})
+        if request.method == 'DELETE':
+            removed = remove_members(room, user_ids)
+            return Response({'removed': [str(user_id) for user_id in removed]})
+        
+        role = request.data.get('role', 'member')
+        if role not in dict(ChatMembership.ROLE_CHOICES):
+            return Response({'error': f'Unknown role {role}'}, status=400)
+        added = add_members(room, user_ids, role)
+        return Response({'added': [str(user_id) for user_id in added]}, status=status.HTTP_201_CREATED if added else status.HTTP_200_OK)
+    
+    @action(detail=True, methods=['patch'], url_path='members/role')
+    def member_role(self, request, pk=None):
+        """Give members a role in bulk: {"user_ids": [...], "role": "admin"}"""
+        room, error = self.get_admin_room()
+        if error:
+            return error
+        user_ids, error = self.get_member_ids(request)
+        if error:
+            return error
+        role = request.data.get('role')
+        if role not in dict(ChatMembership.ROLE_CHOICES):
+            return Response({'error': f'Unknown role {role}'}, status=400)
+        
+        changed = set_role(room, user_ids, role)
+        return Response({'updated': [str(user_id) for user_id in changed]})
     
     @action(detail=True, methods=['post'])
     def leave(self, request, pk=None):
         room = self.get_object()
-        ChatMembership.objects.filter(user=request.user, room=room).delete()
+        remove_members(room, [request.user.id])
         return Response({'status': 'left room'})
     
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Stream the room's history as NDJSON, gzipped with ?compress=gzip.
+        
+        One room line, then one line per message with its reactions and
+        attachment metadata, oldest first. Memory stays flat however big
+        the room is, see apps.chat.export.
+        """
+        try:
+            room = get_object_or_404(ChatRoom.objects.filter(members=request.user), id=pk)
+        except ValidationError:
+            raise Http404
+        
+        filename = f'room-{room.id}.ndjson'
+        chunks = export_room(room)
+        content_type = 'application/x-ndjson; charset=utf-8'
+        if request.query_params.get('compress') == 'gzip':
+            chunks, filename, content_type = gzipped(chunks), filename + '.gz', 'application/gzip'
+        if isinstance(request._request, ASGIRequest):
+            chunks = streamed(chunks)
+        
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    
     @action(detail=True, methods=['delete'])
     def delete_chat(self, request, pk=None):
         room = self.get_object()
-        ChatMembership.objects.filter(user=request.user, room=room).delete()
+        remove_members(room, [request.user.id])
         
         # If no members left, delete room
         if not room.members.exists():
@@ -84,6 +207,9 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
 class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    throttle_classes = [ChatActionThrottle]
+    pagination_class = KeysetPagination
+    rate_limit_actions = {'create': 'send_message', 'react': 'react'}
     
     def get_queryset(self):
         room_id = self.request.query_params.get('room_id')
@@ -92,9 +218,44 @@ class MessageViewSet(viewsets.ModelViewSet):
                 room_id=room_id,
                 room__members=self.request.user,
                 is_deleted=False
-            ).select_related('sender', 'reply_to').order_by('-created_at')
+            ).select_related('sender', 'reply_to__sender').order_by('-created_at')
         return Message.objects.none()
     
+    def get_member_message(self, pk):
+        """A message of one of the user's rooms, without needing ?room_id="""
+        try:
+            return get_object_or_404(
+                Message.objects.only('id', 'room_id'),
+                id=pk,
+                room__members=self.request.user,
+                is_deleted=False
+            )
+        except ValidationError:
+            raise Http404
+    
+    def list(self, request, *args, **kwargs):
+        room_id = request.query_params.get('room_id')
+        if room_id and is_member(request.user.id, room_id):
+            etag = make_etag(request.get_full_path(), stamps.get_many([f'room:{room_id}', 'users']))
+            return conditional(request, etag, lambda: self.list_messages(request, *args, **kwargs))
+        return self.list_messages(request, *args, **kwargs)
+    
+    def list_messages(self, request, *args, **kwargs):
+        # The newest page of a room is served from the recent messages cache
+        room_id = request.query_params.get('room_id')
+        page_size = self.paginator.get_page_size(request)
+        if (
+            room_id
+            and self.paginator.is_first_page(request)
+            and page_size <= recent_messages.size
+            and is_member(request.user.id, room_id)
+        ):
+            recent = recent_messages.get(room_id)
+            has_older = len(recent['messages']) > page_size or recent['has_more']
+            page = self.paginator.paginate_newest(recent['messages'][:page_size], has_older, request)
+            return self.paginator.get_paginated_response(self.get_serializer(page, many=True).data)
+        return super().list(request, *args, **kwargs)
+    
     def create(self, request):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -116,19 +277,135 @@ class MessageViewSet(viewsets.ModelViewSet):
         message.is_deleted = True
         message.deleted_at = timezone.now()
         message.save()
+        recent_messages.remove(message.room_id, message.id)
         return Response(status=status.HTTP_204_NO_CONTENT)
     
+    @action(detail=True, methods=['get'])
+    def reactions(self, request, pk=None):
+        """Everyone who reacted to the message, newest first, optionally for one ?emoji="""
+        message = self.get_member_message(pk)
+        reactions = message.reactions.select_related('user')
+        emoji = request.query_params.get('emoji')
+        if emoji:
+            reactions = reactions.filter(emoji=emoji)
+        
+        page = self.paginate_queryset(reactions)
+        serializer = MessageReactionSerializer(page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+    
+    @action(detail=True, methods=['post', 'delete'])
+    def react(self, request, pk=None):
+        """Add (POST) or remove (DELETE) the user's emoji reaction"""
+        emoji = request.data.get('emoji') or request.query_params.get('emoji')
+        if not emoji:
+            return Response({'error': 'emoji is required'}, status=400)
+        
+        message = self.get_member_message(pk)
+        change = add_reaction if request.method == 'POST' else remove_reaction
+        summary = change(message.room_id, message.id, request.user, emoji)
+        if summary is not None:
+            recent_messages.refresh(message.room_id, [message.id])
+        else:
+            summary = Message.objects.filter(id=message.id).values_list('reaction_summary', flat=True).first()
+        return Response({'message_id': str(message.id), 'reactions': summary})
+    
     @action(detail=False, methods=['get'])
     def search(self, request):
+        """Full-text search of a room, best match first, with highlighted snippets"""
         room_id = request.query_params.get('room_id')
         query = request.query_params.get('q', '')
+        try:
+            if not room_id or not is_member(request.user.id, room_id):
+                return Response({'error': 'Not a member of this room'}, status=403)
+        except (ValidationError, ValueError):
+            raise Http404
         
+        cursor = request.query_params.get('cursor')
+        try:
+            position = decode_cursor(cursor) if cursor else None
+            hits, next_position = search_index.search(room_id, query, self.paginator.get_page_size(request), position)
+        except ValueError:
+            return Response({'error': 'Invalid cursor'}, status=400)
         messages = Message.objects.filter(
-            room_id=room_id,
-            room__members=request.user,
-            content__icontains=query,
             is_deleted=False
-        )[:50]
+        ).select_related('sender', 'reply_to__sender').in_bulk([hit.message_id for hit in hits])
+        
+        results = []
+        for hit in hits:
+            if hit.message_id in messages:
+                data = self.get_serializer(messages[hit.message_id]).data
+                data['rank'] = -hit.score if hit.score is not None else None
+                data['highlight'] = hit.highlight
+                results.append(data)
+        
+        next_url = None
+        if next_position:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', encode_cursor(next_position))
+        return Response({'next': next_url, 'results': results})
+
+
+class SyncView(APIView):
+    """
+    Delta sync of the user's rooms: GET ?since=<token>.
+    
+    Returns the rooms (with their members), messages (with their
+    reactions) and deletions that changed since the token, and a new token.
+    Without a token, or with one older than the change log, the response
+    is just {'token', 'reset': true}: the client lists its rooms and
+    messages from scratch, then syncs from that token. has_more means the
+    client should sync again right away. An idle client's sync is a single
+    indexed query on the change log.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        position = None
+        since = request.query_params.get('since')
+        if since:
+            try:
+                position = decode_token(since)
+            except ValueError:
+                return Response({'error': 'Invalid sync token'}, status=400)
+        if position is None:
+            return Response({'token': current_token(), 'reset': True})
+        
+        entries, token, has_more = changes_since(
+            request.user.id, position, getattr(settings, 'CHAT_SYNC_MAX_CHANGES', 500)
+        )
+        room_ids, message_ids, deleted_ids = set(), set(), set()
+        for entry in entries:
+            room_ids.add(entry.room_id)
+            if entry.kind == 'message':
+                message_ids.add(entry.object_id)
+            elif entry.kind == 'message_deleted':
+                deleted_ids.add(entry.object_id)
         
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        rooms = list(member_rooms(request.user).filter(id__in=room_ids)) if room_ids else []
+        messages = []
+        if message_ids - deleted_ids:
+            messages = list(Message.objects.filter(
+                id__in=message_ids - deleted_ids,
+                room_id__in=[room.id for room in rooms],
+                is_deleted=False
+            ).select_related('sender', 'reply_to__sender').order_by('created_at', 'id'))
+        # Soft deleted since, or gone along with a room the user left
+        deleted_ids |= message_ids - {message.id for message in messages}
+        
+        context = {'request': request}
+        return Response({
+            'token': token,
+            'reset': False,
+            'has_more': has_more,
+            'rooms': ChatRoomSerializer(rooms, many=True, context=context).data,
+            'removed_rooms': [str(room_id) for room_id in room_ids - {room.id for room in rooms}],
+            'messages': MessageSerializer(messages, many=True, context=context).data,
+            'deleted_messages': [str(message_id) for message_id in deleted_ids]
+        })
+
+
+class ChatMetricsView(APIView):
+    """Realtime counters and gauges of this worker process"""
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response(metrics.snapshot())
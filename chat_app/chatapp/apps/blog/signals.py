@@ -1,7 +1,8 @@
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from .models import Post, Comment, PostLike
+from .models import Post, Comment, CommentLike, PostLike, PostMedia
 from apps.accounts.models import Notification
+from apps.accounts.versions import stamps
 from django.utils.text import slugify
 import uuid
 
@@ -44,4 +45,14 @@ def notify_like(sender, instance, created, **kwargs):
                 notification_type='like',
                 message=f'{instance.user.username} liked your post',
                 link=f'/post/{instance.post.slug}/'
-            )
\ No newline at end of file
+            )
+
+
+@receiver([post_save, post_delete], sender=Post)
+@receiver([post_save, post_delete], sender=PostLike)
+@receiver([post_save, post_delete], sender=Comment)
+@receiver([post_save, post_delete], sender=CommentLike)
+@receiver([post_save, post_delete], sender=PostMedia)
+def bump_feed_version(sender, instance, **kwargs):
+    """Anything shown in a post list changed, including view and like counts"""
+    stamps.bump('feed')
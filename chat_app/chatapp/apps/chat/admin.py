@@ -1,6 +1,7 @@
 # apps/chat/admin.py
 from django.contrib import admin
 from .models import ChatRoom, ChatMembership, Message, MessageReadReceipt, MessageReaction
+from .search import search_index
 
 
 class ChatMembershipInline(admin.TabularInline):
@@ -13,6 +14,7 @@ class ChatRoomAdmin(admin.ModelAdmin):
     list_display = ['id', 'room_type', 'name', 'created_by', 'created_at']
     list_filter = ['room_type', 'created_at']
     search_fields = ['name', 'members__username']
+    readonly_fields = ['direct_key']
     inlines = [ChatMembershipInline]
 
 
@@ -20,8 +22,18 @@ class ChatRoomAdmin(admin.ModelAdmin):
 class MessageAdmin(admin.ModelAdmin):
     list_display = ['id', 'room', 'sender', 'message_type', 'status', 'is_deleted', 'created_at']
     list_filter = ['message_type', 'status', 'is_deleted', 'created_at']
-    search_fields = ['content', 'sender__username', 'room__name']
-    readonly_fields = ['created_at', 'updated_at']
+    # Content goes through the search index instead of a LIKE scan of the table
+    search_fields = ['sender__username', 'room__name']
+    search_help_text = 'Full-text search of the content, or a sender or room name'
+    search_limit = 1000
+    readonly_fields = ['reaction_summary', 'created_at', 'updated_at']
+    
+    def get_search_results(self, request, queryset, search_term):
+        matched, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            hits, _ = search_index.search(None, search_term, self.search_limit)
+            matched = matched | queryset.filter(id__in=[hit.message_id for hit in hits])
+        return matched, may_have_duplicates
 
 
 @admin.register(MessageReadReceipt)
@@ -7,4 +7,5 @@ class ChatConfig(AppConfig):
     name = 'apps.chat'
     
     def ready(self):
+        import apps.chat.checks
         import apps.chat.signals
\ No newline at end of file
@@ -0,0 +1,95 @@
+# apps/chat/cache.py
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from apps.accounts.models import User
+from . import metrics
+from .models import ChatMembership
+
+
+class TTLCache:
+    """
+    Small in-process LRU cache whose entries also expire after `ttl` seconds.
+    
+    Signal handlers invalidate entries when the underlying rows change; the
+    TTL bounds how stale another process's copy can get, since every worker
+    keeps its own cache. Safe to use from the sync_to_async thread pool.
+    """
+    
+    def __init__(self, name, max_size, ttl):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, expires_at)
+        self.lock = threading.Lock()
+        metrics.register_gauge(f'cache.{name}.size', lambda: len(self.entries))
+    
+    def get(self, key, load):
+        """The cached value for key, calling load() on a miss"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                metrics.incr(f'cache.{self.name}.hits')
+                return entry[0]
+        
+        metrics.incr(f'cache.{self.name}.misses')
+        value = load()
+        with self.lock:
+            self.entries[key] = (value, now + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+    
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+membership_cache = TTLCache(
+    'membership',
+    max_size=getattr(settings, 'CHAT_CACHE_MAX_ENTRIES', 10000),
+    ttl=getattr(settings, 'CHAT_CACHE_TTL', 60)
+)
+user_cache = TTLCache(
+    'user',
+    max_size=getattr(settings, 'CHAT_CACHE_MAX_ENTRIES', 10000),
+    ttl=getattr(settings, 'CHAT_CACHE_TTL', 60)
+)
+
+
+def member_room_ids(user_id):
+    """Ids of every room the user belongs to, as strings"""
+    user_id = str(user_id)
+    return membership_cache.get(user_id, lambda: frozenset(
+        str(room_id) for room_id in
+        ChatMembership.objects.filter(user_id=user_id).values_list('room_id', flat=True)
+    ))
+
+
+def is_member(user_id, room_id):
+    return str(room_id) in member_room_ids(user_id)
+
+
+def cached_user(user_id):
+    """The active user with only the identity fields chat needs loaded, or None"""
+    user_id = str(user_id)
+    fields = user_cache.get(user_id, lambda: User.objects.filter(
+        id=user_id,
+        is_active=True
+    ).values('id', 'username', 'email', 'avatar').first())
+    return partial_user(fields) if fields else None
+
+
+def partial_user(fields):
+    """A User built from a few known fields, the others load from the database on access"""
+    # from_db expects values in the model's field order
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in fields]
+    return User.from_db('default', names, [fields[name] for name in names])
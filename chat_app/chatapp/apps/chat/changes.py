@@ -0,0 +1,117 @@
+# apps/chat/changes.py
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from apps.accounts.versions import stamps
+from .cache import member_room_ids
+from .models import ChangeLogEntry
+
+
+def retention():
+    return timedelta(days=getattr(settings, 'CHAT_SYNC_RETENTION_DAYS', 30))
+
+
+def settle_time():
+    return timedelta(seconds=getattr(settings, 'CHAT_SYNC_SETTLE_SECONDS', 5))
+
+
+def record(entries):
+    """
+    Append (kind, room_id, object_id, user_id) tuples to the change log in one INSERT.
+    
+    Also moves the version stamps of the rooms, and of the inboxes of the
+    members whose membership changed, on for conditional GETs.
+    """
+    ChangeLogEntry.objects.bulk_create([
+        ChangeLogEntry(kind=kind, room_id=room_id, object_id=object_id, user_id=user_id)
+        for kind, room_id, object_id, user_id in entries
+    ])
+    stamps.bump(*{f'room:{room_id}' for kind, room_id, object_id, user_id in entries}, *{
+        f'inbox:{user_id}' for kind, room_id, object_id, user_id in entries if user_id is not None
+    })
+
+
+def record_messages(messages, kind='message'):
+    record([(kind, message.room_id, message.id, None) for message in messages])
+
+
+def record_memberships(room_id, user_ids):
+    record([('membership', room_id, None, user_id) for user_id in user_ids])
+
+
+# Sync tokens
+
+def encode_token(position, unseen_since):
+    """
+    Opaque token for log position `position`.
+    
+    unseen_since is a lower bound on the creation time of the entries the
+    client has not seen yet; once those may have been pruned the token is
+    refused and the client has to start over.
+    """
+    raw = f'{position}:{int(unseen_since.timestamp())}'
+    return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_token(token):
+    """The log position of a token, None if it is older than the log; ValueError if it is not one"""
+    try:
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        position, unseen_since = (int(value) for value in raw.split(':'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid sync token')
+    if position < 0:
+        raise ValueError('Invalid sync token')
+    if time.time() - unseen_since > retention().total_seconds():
+        return None
+    return position
+
+
+def current_token():
+    """Token for a client that is about to fetch everything it needs from scratch"""
+    cutoff = timezone.now() - settle_time()
+    position = ChangeLogEntry.objects.filter(created_at__lte=cutoff).order_by('-id').values_list('id', flat=True).first()
+    return encode_token(position or 0, cutoff)
+
+
+def changes_since(user_id, position, limit):
+    """
+    (entries, token, has_more): the log entries visible to the user after position.
+    
+    Visible are the entries of the user's rooms and the user's own
+    membership entries, so rooms they left show up too. One indexed query.
+    
+    Log ids are handed out before their transaction commits, so an entry
+    may become visible after a later one. The position therefore only
+    moves past entries older than CHAT_SYNC_SETTLE_SECONDS; younger ones
+    are returned again by the next sync, which is harmless as clients get
+    the current state of everything an entry points at. has_more is only
+    set when the position moved past every entry returned, so clients
+    never resync right away for entries that are still settling.
+    """
+    entries = list(ChangeLogEntry.objects.filter(
+        Q(room_id__in=member_room_ids(user_id)) | Q(user_id=user_id),
+        id__gt=position
+    ).order_by('id')[:limit + 1])
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    
+    cutoff = unseen_since = timezone.now() - settle_time()
+    settled = 0
+    for entry in entries:
+        if entry.created_at > cutoff:
+            break
+        position = entry.id
+        settled += 1
+        if has_more:
+            unseen_since = entry.created_at
+    return entries, encode_token(position, unseen_since), has_more and settled == len(entries)
+
+
+def prune(older_than=None):
+    """Delete log entries older than the retention period, returns how many"""
+    cutoff = timezone.now() - (older_than or retention())
+    return ChangeLogEntry.objects.filter(created_at__lt=cutoff).delete()[0]
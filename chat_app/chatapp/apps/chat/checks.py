@@ -0,0 +1,21 @@
+# apps/chat/checks.py
+from channels.layers import get_channel_layer
+from django.core.cache import caches
+from django.core.checks import Error, register
+from apps.accounts.checks import is_shared
+from .layers import is_cross_process
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """Rooms spread over processes need a cache they all see"""
+    layer = get_channel_layer()
+    if layer is None or not is_cross_process(layer) or is_shared(caches['default']):
+        return []
+    return [Error(
+        'The channel layer spans processes but the default cache is per-process: '
+        'the recent messages of a room and presence counts go stale in every '
+        'process but the one that wrote them.',
+        hint="Point CACHES['default'] at a shared cache such as Redis.",
+        id='chat.E001',
+    )]
@@ -1,16 +1,58 @@
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.core.exceptions import ObjectDoesNotExist
-import json
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from datetime import datetime
-from .models import ChatRoom, Message, MessageReadReceipt, ChatMembership
-from apps.accounts.models import User
+from urllib.parse import parse_qs
+from .cache import is_member, member_room_ids
+from .changes import record_memberships
+from .models import Message, ChatMembership
+from .protocol import FrameError, encode_frame, negotiate
+from .outbound import OutboundQueue
+from .persistence import batched_persistence_enabled, write_behind
+from .presence import presence
+from .ratelimit import limiter
+from .recent import recent_messages
+from .replay import room_log
+from .statuses import status_pipeline
+from .services import (
+    add_reaction, build_message, create_message, message_payload, messages_after, messages_created, sender_snapshot,
+    unread_count
+)
+from .typing_indicators import typing_aggregator
+
+
+def room_group(room_id):
+    return f'chat_{room_id}'
+
+
+def resume_point(data):
+    """(seq, message_id) a client asks to resume a room from, or None"""
+    try:
+        return int(data.get('seq')), data.get('message_id')
+    except (TypeError, ValueError):
+        return None
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Group event handler -> kind of outbound frame
+    EVENT_KINDS = {
+        'chat_message': 'message',
+        'typing_indicator': 'typing',
+        'user_status': 'status',
+        'read_receipt': 'read',
+        'message_reaction': 'reaction',
+        'message_failed': 'control',
+        'message_status_update': 'message_status',
+        'membership_update': 'members',
+    }
+    # Actions only members of the room may take
+    MEMBER_ACTIONS = {'send_message', 'typing', 'read', 'react'}
+    
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_group_name = room_group(self.room_id)
         self.user = self.scope['user']
         
         if not self.user.is_authenticated:
@@ -23,249 +65,548 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         
+        self.user_id = str(self.user.id)
+        self.sender = sender_snapshot(self.user)
+        
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         
-        await self.accept()
+        # JSON text frames unless the client negotiated the binary protocol
+        self.codec, subprotocol = negotiate(self.scope)
+        await self.accept(subprotocol)
+        self.outbound = OutboundQueue(self.send_frame, self.close_slow_consumer)
+        self.replayed = {}
         
-        # Update user online status
-        await self.update_online_status(True)
+        # Reconnecting clients pass ?epoch=&seq=&message_id= to catch up
+        query_params = {
+            name: values[0]
+            for name, values in parse_qs(self.scope.get('query_string', b'').decode()).items()
+        }
+        point = resume_point(query_params)
+        if point:
+            await self.resume(self.room_id, query_params.get('epoch'), *point)
+        self.reply({
+            'type': 'session',
+            'epoch': room_log.epoch,
+            'seq': {self.room_id: room_log.last_seq(self.room_id)}
+        })
         
-        # Notify others user is online
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-                'is_online': True
-            }
-        )
+        # Only the user's first live connection makes them come online
+        if await presence.connect(self.user_id, self.channel_name):
+            await self.broadcast_presence(True)
     
     async def disconnect(self, close_code):
-        # Update user online status
-        await self.update_online_status(False)
+        # Connection was rejected before it was fully set up
+        if not hasattr(self, 'user_id'):
+            return
         
-        # Notify others user is offline
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-                'is_online': False
-            }
-        )
+        # Stop showing this user as typing
+        typing_aggregator.update(self.room_id, self.user_id, self.channel_name, self.user.username, False)
+        
+        # Only closing the user's last connection makes them go offline
+        if await presence.disconnect(self.user_id, self.channel_name):
+            await self.broadcast_presence(False)
         
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        self.outbound.stop()
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode(text_data, bytes_data)
+        if data is not None:
+            await self.dispatch_action(self.room_id, data)
+    
+    def decode(self, text_data, bytes_data):
+        """The frame's action, None once a frame that isn't one was answered with an error"""
+        try:
+            return self.codec.decode(text_data, bytes_data)
+        except FrameError as e:
+            self.reply({'type': 'error', 'error': 'malformed frame', 'reason': str(e)})
+            return None
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def dispatch_action(self, room_id, data):
         action = data.get('action')
         
+        if not limiter.allow(self.user_id, action):
+            # Rejected before any DB work, the client may retry later
+            self.reply({
+                'type': 'error',
+                'error': 'rate_limited',
+                'action': action,
+                'client_id': data.get('client_id'),
+                'retry_after': round(limiter.retry_after(self.user_id, action), 3)
+            })
+            return
+        
+        if action in self.MEMBER_ACTIONS and not await self.is_room_member(room_id):
+            # Removed since the socket joined the room
+            self.reply({
+                'type': 'error',
+                'error': 'not a member of room',
+                'action': action,
+                'client_id': data.get('client_id'),
+                'room_id': str(room_id)
+            })
+            return
+        
         if action == 'send_message':
-            await self.handle_send_message(data)
+            await self.handle_send_message(room_id, data)
         elif action == 'typing':
-            await self.handle_typing(data)
+            await self.handle_typing(room_id, data)
         elif action == 'read':
-            await self.handle_read_receipt(data)
+            await self.handle_read_receipt(room_id, data)
         elif action == 'react':
-            await self.handle_reaction(data)
+            await self.handle_reaction(room_id, data)
+        elif action == 'ping':
+            presence.heartbeat(self.user_id)
+            self.reply({'type': 'pong'})
+        elif action == 'presence':
+            await self.handle_presence_query(data)
+    
+    async def broadcast(self, room_id, handler, payload, **meta):
+        """Number and encode payload once, then fan it out to the whole room"""
+        # Tag every room event so multiplexed clients know where it belongs
+        payload['room_id'] = str(room_id)
+        await self.channel_layer.group_send(
+            room_group(room_id),
+            room_log.append(room_id, handler, payload, **meta)
+        )
+    
+    async def resume(self, room_id, epoch, seq, message_id=None):
+        """
+        Replay what the client missed in room_id since seq.
+        
+        Buffered events are replayed verbatim. When the gap is older than the
+        buffer, the messages sent after message_id are loaded instead, and
+        the client is told whether that covered everything or it has to
+        refetch the history.
+        """
+        current = room_log.last_seq(room_id)
+        events = room_log.since(room_id, epoch, seq)
+        # Live events numbered up to here are part of the replay, not sent twice
+        self.replayed[room_id] = (room_log.epoch, current)
+        
+        if events is not None:
+            for event in events:
+                self.enqueue(event)
+            source, replayed, complete = 'buffer', len(events), True
+        else:
+            limit = getattr(settings, 'CHAT_REPLAY_DB_LIMIT', 100)
+            payloads = None
+            if message_id:
+                payloads = await database_sync_to_async(messages_after)(room_id, message_id, limit)
+            for payload in payloads or []:
+                self.outbound.put('message', encode_frame({
+                    'type': 'message',
+                    'data': payload,
+                    'room_id': room_id
+                }), delivered=(room_id, payload['id']))
+            source, replayed = 'database', len(payloads or [])
+            complete = payloads is not None and len(payloads) < limit
+        
+        self.reply({
+            'type': 'resumed',
+            'room_id': room_id,
+            'epoch': room_log.epoch,
+            'seq': current,
+            'source': source,
+            'replayed': replayed,
+            'complete': complete
+        })
     
-    async def handle_send_message(self, data):
+    def reply(self, payload):
+        """Answer this connection only, in order with the room events queued for it"""
+        self.outbound.put('control', encode_frame(payload))
+    
+    async def send_frame(self, frame):
+        await self.send(**self.codec.wire(frame))
+    
+    async def close_slow_consumer(self):
+        await self.close(code=4008)
+    
+    async def close_removed(self):
+        await self.close(code=4003)
+    
+    async def broadcast_presence(self, is_online):
+        """Announce a presence change to every room shared with someone else"""
+        for room_id in await self.get_shared_room_ids():
+            await self.broadcast(room_id, 'user_status', {
+                'type': 'status',
+                'user_id': self.user_id,
+                'username': self.user.username,
+                'is_online': is_online
+            })
+    
+    async def handle_send_message(self, room_id, data):
         message_type = data.get('message_type', 'text')
         content = data.get('content', '')
         reply_to_id = data.get('reply_to')
+        client_id = data.get('client_id')
         
-        # Save message to database
-        message = await self.save_message(
+        if batched_persistence_enabled():
+            # Broadcast right away, the sender is acked once the batch commits
+            message = build_message(
+                room_id,
+                self.user,
+                message_type=message_type,
+                content=content,
+                reply_to_id=reply_to_id
+            )
+            await self.broadcast(room_id, 'chat_message', {
+                'type': 'message',
+                'data': message_payload(message, self.sender)
+            }, **self.message_meta(message))
+            asyncio.ensure_future(
+                self.ack_when_persisted(room_id, message, write_behind.submit(message), client_id)
+            )
+            return
+        
+        # Validate and insert in one DB round trip, the payload needs no queries
+        message = await database_sync_to_async(create_message)(
+            room_id,
+            self.user,
             message_type=message_type,
             content=content,
             reply_to_id=reply_to_id
         )
         
         # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': await self.serialize_message(message)
-            }
-        )
+        await self.broadcast(room_id, 'chat_message', {
+            'type': 'message',
+            'data': message_payload(message, self.sender)
+        }, **self.message_meta(message))
+        
+        await self.send_ack(message, client_id)
+        
+        # Notifications and caches are updated after delivery, off the hot path
+        await database_sync_to_async(messages_created)([message])
+    
+    def message_meta(self, message):
+        return {
+            'message_id': str(message.id),
+            'sender_id': self.user_id,
+            'created_at': message.created_at.isoformat()
+        }
     
-    async def handle_typing(self, data):
+    async def ack_when_persisted(self, room_id, message, persisted, client_id):
+        try:
+            await persisted
+        except Exception as error:
+            # Everyone already saw the message, tell them to drop it
+            await self.broadcast(room_id, 'message_failed', {
+                'type': 'message_failed',
+                'message_id': str(message.id)
+            })
+            await self.send_ack(message, client_id, error=str(error))
+            return
+        
+        await self.send_ack(message, client_id)
+    
+    async def send_ack(self, message, client_id, error=None):
+        """Tell the sender whether their message is durably stored"""
+        ack = {
+            'type': 'ack',
+            'message_id': str(message.id),
+            'client_id': client_id,
+            'persisted': error is None
+        }
+        if error:
+            ack['error'] = error
+        self.reply(ack)
+    
+    async def handle_typing(self, room_id, data):
         is_typing = data.get('is_typing', False)
         
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'typing_indicator',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-                'is_typing': is_typing
-            }
-        )
+        # Coalesced per room, the aggregator broadcasts who is typing
+        typing_aggregator.update(room_id, self.user_id, self.channel_name, self.user.username, bool(is_typing))
     
-    async def handle_read_receipt(self, data):
+    async def handle_read_receipt(self, room_id, data):
+        # "Read up to message_id": one event covers every earlier message too
         message_id = data.get('message_id')
         
         if message_id:
-            await self.mark_as_read(message_id)
+            read_up_to = await self.mark_as_read(room_id, message_id)
             
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'read_receipt',
+            # Only broadcast when the watermark actually moved forward
+            if read_up_to:
+                status_pipeline.read(room_id)
+                await self.broadcast(room_id, 'read_receipt', {
+                    'type': 'read',
                     'message_id': message_id,
-                    'user_id': str(self.user.id),
-                    'username': self.user.username
-                }
-            )
+                    'user_id': self.user_id,
+                    'username': self.user.username,
+                    'read_at': read_up_to.isoformat()
+                })
     
-    async def handle_reaction(self, data):
+    async def handle_reaction(self, room_id, data):
         message_id = data.get('message_id')
         emoji = data.get('emoji')
         
         if message_id and emoji:
-            await self.add_reaction(message_id, emoji)
+            summary = await self.add_reaction(room_id, message_id, emoji)
+            if summary is None:
+                return
             
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'message_reaction',
-                    'message_id': message_id,
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'emoji': emoji
-                }
-            )
+            await self.broadcast(room_id, 'message_reaction', {
+                'type': 'reaction',
+                'message_id': message_id,
+                'user_id': self.user_id,
+                'username': self.user.username,
+                'emoji': emoji,
+                'reactions': summary
+            }, message_id=message_id)
+    
+    async def handle_presence_query(self, data):
+        user_ids = [str(user_id) for user_id in data.get('user_ids', [])]
+        
+        self.reply({
+            'type': 'presence',
+            'online': sorted(await presence.online_among(user_ids))
+        })
     
-    # WebSocket event handlers
+    # WebSocket event handlers: frames arrive pre-encoded and are queued verbatim
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'data': event['message']
-        }))
+        self.deliver(event)
+        # Handed to someone other than its sender, so the message is delivered
+        if 'sender_id' in event and event['sender_id'] != self.user_id:
+            status_pipeline.delivered(event['room_id'], datetime.fromisoformat(event['created_at']))
     
     async def typing_indicator(self, event):
-        # Don't send typing indicator to the user who's typing
-        if event['user_id'] != str(self.user.id):
-            await self.send(text_data=json.dumps({
-                'type': 'typing',
-                'user_id': event['user_id'],
-                'username': event['username'],
-                'is_typing': event['is_typing']
-            }))
+        self.deliver(event)
     
     async def user_status(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'status',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'is_online': event['is_online']
-        }))
+        self.deliver(event)
     
     async def read_receipt(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'read',
-            'message_id': event['message_id'],
-            'user_id': event['user_id'],
-            'username': event['username']
-        }))
+        self.deliver(event)
     
     async def message_reaction(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'reaction',
-            'message_id': event['message_id'],
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'emoji': event['emoji']
-        }))
+        self.deliver(event)
+    
+    async def message_failed(self, event):
+        self.deliver(event)
+    
+    async def message_status_update(self, event):
+        self.deliver(event)
+    
+    async def membership_update(self, event):
+        self.deliver(event)
+        if self.user_id in event['removed']:
+            await self.leave_room(event['room_id'])
+    
+    async def leave_room(self, room_id):
+        """This user was removed from the room, the socket has nothing left to do"""
+        await self.channel_layer.group_discard(room_group(room_id), self.channel_name)
+        # After the members frame that says so
+        self.outbound.close_after(self.close_removed)
+    
+    def deliver(self, event):
+        # Already sent as part of a replay. Seqs only order the events of the
+        # process that numbered them, events from other processes are never skipped.
+        epoch, seq = self.replayed.get(event.get('room_id'), (None, 0))
+        if 'seq' in event and event.get('epoch') == epoch and event['seq'] <= seq:
+            return
+        self.enqueue(event)
+    
+    def enqueue(self, event):
+        kind = self.EVENT_KINDS[event['type']]
+        room_id = event.get('room_id')
+        self.outbound.put(
+            kind,
+            event['text'],
+            key=(room_id, event['message_id']) if kind == 'reaction' else None,
+            delivered=(room_id, event['message_id']) if kind == 'message' else None,
+            # Resume hints report seqs of this process's log, the one they are replayed from
+            seq=(room_id, event['seq']) if event.get('epoch') == room_log.epoch else None
+        )
     
     # Database operations
     @database_sync_to_async
     def check_membership(self):
-        try:
-            return ChatMembership.objects.filter(
-                user=self.user,
-                room_id=self.room_id
-            ).exists()
-        except:
-            return False
+        return is_member(self.user.id, self.room_id)
     
     @database_sync_to_async
-    def save_message(self, message_type, content, reply_to_id=None):
-        reply_to = None
-        if reply_to_id:
-            try:
-                reply_to = Message.objects.get(id=reply_to_id)
-            except Message.DoesNotExist:
-                pass
-        
-        message = Message.objects.create(
-            room_id=self.room_id,
-            sender=self.user,
-            message_type=message_type,
-            content=content,
-            reply_to=reply_to
-        )
-        return message
+    def is_room_member(self, room_id):
+        return is_member(self.user_id, room_id)
     
     @database_sync_to_async
-    def serialize_message(self, message):
-        return {
-            'id': str(message.id),
-            'sender': {
-                'id': str(message.sender.id),
-                'username': message.sender.username,
-                'avatar': message.sender.avatar.url if message.sender.avatar else None
-            },
-            'message_type': message.message_type,
-            'content': message.content,
-            'reply_to': str(message.reply_to.id) if message.reply_to else None,
-            'status': message.status,
-            'created_at': message.created_at.isoformat()
-        }
+    def get_shared_room_ids(self):
+        my_rooms = ChatMembership.objects.filter(user_id=self.user_id).values('room_id')
+        return list(
+            ChatMembership.objects.filter(
+                room_id__in=my_rooms
+            ).exclude(
+                user_id=self.user_id
+            ).values_list('room_id', flat=True).distinct()
+        )
     
     @database_sync_to_async
-    def update_online_status(self, is_online):
-        User.objects.filter(id=self.user.id).update(is_online=is_online)
+    def mark_as_read(self, room_id, message_id):
+        """Advance the reader's watermark to message_id, return it if it moved"""
+        try:
+            read_up_to = Message.objects.filter(
+                id=message_id,
+                room_id=room_id
+            ).values_list('created_at', flat=True).first()
+        except ValidationError:
+            return None
+        
+        if read_up_to is None:
+            return None
+        
+        # Single conditional write, the watermark never moves backwards and
+        # the unread counter is recounted over the messages still after it
+        advanced = ChatMembership.objects.filter(
+            user=self.user,
+            room_id=room_id,
+            last_read_at__lt=read_up_to
+        ).update(
+            last_read_at=read_up_to,
+            unread_count=unread_count(room_id, self.user.id, read_up_to)
+        )
+        
+        if not advanced:
+            return None
+        record_memberships(room_id, [self.user.id])
+        # Message statuses are rolled up by the status pipeline
+        return read_up_to
     
     @database_sync_to_async
-    def mark_as_read(self, message_id):
+    def add_reaction(self, room_id, message_id, emoji):
+        """The message's new reaction summary, None if nothing was added"""
         try:
-            message = Message.objects.get(id=message_id)
-            MessageReadReceipt.objects.get_or_create(
-                message=message,
-                user=self.user
-            )
-            
-            # Update message status if all members have read
-            room_members_count = message.room.members.count()
-            read_count = message.read_receipts.count()
+            summary = add_reaction(room_id, message_id, self.user, emoji)
+        except ValidationError:
+            return None
+        if summary is not None:
+            recent_messages.refresh(room_id, [message_id])
+        return summary
+
+
+class StreamConsumer(ChatConsumer):
+    """
+    One socket per user, multiplexing many rooms.
+    
+    Subscribes to every room of the user, or to the subset given as
+    ?rooms=<id>,<id> at connect time. Clients add and remove rooms with
+    subscribe/unsubscribe frames, and room actions carry a room_id. Every
+    room event sent out is tagged with its room_id. A reconnecting client
+    resubscribes with the session epoch and, per room, the last seq and
+    message id it saw: {'resume': {room_id: {'seq': ..., 'message_id': ...}}}.
+    """
+    
+    async def connect(self):
+        self.user = self.scope['user']
+        self.rooms = set()
+        
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        
+        self.user_id = str(self.user.id)
+        self.sender = sender_snapshot(self.user)
+        
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        requested = None
+        if query_params.get('rooms'):
+            requested = [room_id for room_id in query_params['rooms'][0].split(',') if room_id]
+        
+        # JSON text frames unless the client negotiated the binary protocol
+        self.codec, subprotocol = negotiate(self.scope)
+        await self.accept(subprotocol)
+        self.outbound = OutboundQueue(self.send_frame, self.close_slow_consumer)
+        self.replayed = {}
+        await self.subscribe(await self.get_member_room_ids(requested))
+        self.reply({
+            'type': 'session',
+            'epoch': room_log.epoch,
+            'seq': {room_id: room_log.last_seq(room_id) for room_id in self.rooms}
+        })
+        
+        if await presence.connect(self.user_id, self.channel_name):
+            await self.broadcast_presence(True)
+    
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'user_id'):
+            return
+        
+        for room_id in self.rooms:
+            typing_aggregator.update(room_id, self.user_id, self.channel_name, self.user.username, False)
+        
+        if await presence.disconnect(self.user_id, self.channel_name):
+            await self.broadcast_presence(False)
+        
+        await self.unsubscribe(list(self.rooms))
+        self.outbound.stop()
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode(text_data, bytes_data)
+        if data is None:
+            return
+        action = data.get('action')
+        
+        if action == 'subscribe':
+            room_ids = await self.get_member_room_ids(data.get('room_ids', []))
+            await self.subscribe(room_ids)
             
-            if read_count >= room_members_count - 1:  # Exclude sender
-                message.status = 'read'
-                message.save(update_fields=['status'])
-        except Message.DoesNotExist:
-            pass
+            resume = data.get('resume') or {}
+            for room_id in room_ids:
+                point = resume_point(resume.get(room_id) or {})
+                if point:
+                    await self.resume(room_id, data.get('epoch'), *point)
+            self.reply({
+                'type': 'subscribed',
+                'room_ids': room_ids,
+                'epoch': room_log.epoch,
+                'seq': {room_id: room_log.last_seq(room_id) for room_id in room_ids}
+            })
+        elif action == 'unsubscribe':
+            room_ids = [room_id for room_id in self.rooms if room_id in data.get('room_ids', [])]
+            await self.unsubscribe(room_ids)
+            self.reply({
+                'type': 'unsubscribed',
+                'room_ids': room_ids
+            })
+        elif action in ('ping', 'presence'):
+            await self.dispatch_action(None, data)
+        else:
+            # Room actions are only accepted for rooms this socket is subscribed to
+            room_id = str(data.get('room_id', ''))
+            if room_id not in self.rooms:
+                self.reply({
+                    'type': 'error',
+                    'error': 'not subscribed to room',
+                    'room_id': room_id
+                })
+                return
+            await self.dispatch_action(room_id, data)
+    
+    async def subscribe(self, room_ids):
+        for room_id in room_ids:
+            if room_id not in self.rooms:
+                await self.channel_layer.group_add(room_group(room_id), self.channel_name)
+                self.rooms.add(room_id)
+    
+    async def leave_room(self, room_id):
+        # Also rejects further actions on the room
+        await self.unsubscribe([room_id])
+    
+    async def unsubscribe(self, room_ids):
+        for room_id in room_ids:
+            await self.channel_layer.group_discard(room_group(room_id), self.channel_name)
+            self.rooms.discard(room_id)
+            self.replayed.pop(room_id, None)
     
     @database_sync_to_async
-    def add_reaction(self, message_id, emoji):
-        from .models import MessageReaction
-        try:
-            message = Message.objects.get(id=message_id)
-            MessageReaction.objects.get_or_create(
-                message=message,
-                user=self.user,
-                emoji=emoji
-            )
-        except Message.DoesNotExist:
-            pass
\ No newline at end of file
+    def get_member_room_ids(self, requested=None):
+        """The user's room ids, optionally narrowed down to the requested ones"""
+        room_ids = member_room_ids(self.user_id)
+        if requested is not None:
+            return [str(room_id) for room_id in requested if str(room_id) in room_ids]
+        return list(room_ids)
@@ -0,0 +1,123 @@
+# apps/chat/export.py
+import json
+import zlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from .models import ChatMembership, Message, MessageReaction
+
+MESSAGE_FIELDS = [
+    'id', 'sender_id', 'sender__username', 'message_type', 'content', 'reply_to_id',
+    'status', 'file', 'file_name', 'file_size', 'thumbnail', 'created_at', 'updated_at'
+]
+
+
+def chunk_size():
+    return getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 1000)
+
+
+def line(record):
+    return json.dumps(record, cls=DjangoJSONEncoder, ensure_ascii=False).encode() + b'\n'
+
+
+def file_url(name, field):
+    return Message._meta.get_field(field).storage.url(name) if name else None
+
+
+def message_record(row, reactions):
+    attachment = None
+    if row['file']:
+        attachment = {
+            'name': row['file_name'],
+            'size': row['file_size'],
+            'url': file_url(row['file'], 'file'),
+            'thumbnail_url': file_url(row['thumbnail'], 'thumbnail'),
+        }
+    return {
+        'type': 'message',
+        'id': row['id'],
+        'sender': {'id': row['sender_id'], 'username': row['sender__username']},
+        'message_type': row['message_type'],
+        'content': row['content'],
+        'reply_to': row['reply_to_id'],
+        'status': row['status'],
+        'attachment': attachment,
+        'reactions': reactions,
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at'],
+    }
+
+
+def export_room(room, size=None):
+    """
+    NDJSON lines of a room's history, as bytes: one room line, then its messages oldest first.
+    
+    Messages are read through iterator(), a server-side cursor where the
+    database has them, and handled `size` at a time with one query for
+    the reactions of each chunk, so memory stays flat whatever the size
+    of the room. Each yielded item is a whole chunk of lines.
+    """
+    size = size or chunk_size()
+    yield line({
+        'type': 'room',
+        'id': room.id,
+        'room_type': room.room_type,
+        'name': room.name,
+        'description': room.description,
+        'created_at': room.created_at,
+        'exported_at': timezone.now(),
+        'members': [
+            {'id': user_id, 'username': username, 'role': role}
+            for user_id, username, role in ChatMembership.objects.filter(room=room).values_list(
+                'user_id', 'user__username', 'role'
+            ).order_by('joined_at')
+        ],
+    })
+    
+    rows = Message.objects.filter(room=room, is_deleted=False).order_by('created_at', 'id').values(*MESSAGE_FIELDS)
+    chunk = []
+    for row in rows.iterator(chunk_size=size):
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield export_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield export_chunk(chunk)
+
+
+def export_chunk(rows):
+    reactions = {row['id']: [] for row in rows}
+    for message_id, emoji, user_id, created_at in MessageReaction.objects.filter(
+        message_id__in=list(reactions)
+    ).order_by('created_at').values_list('message_id', 'emoji', 'user_id', 'created_at'):
+        reactions[message_id].append({'emoji': emoji, 'user_id': user_id, 'created_at': created_at})
+    return b''.join(line(message_record(row, reactions[row['id']])) for row in rows)
+
+
+def gzipped(chunks):
+    """Gzip a stream of byte chunks on the fly, flushing after each so output keeps flowing"""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def streamed(chunks):
+    """
+    Serve a chunk generator to an ASGI response one chunk at a time.
+    
+    Django consumes a sync iterator under ASGI with sync_to_async(list),
+    which holds the whole export in memory before the first byte goes
+    out. Each chunk is pulled on the sync thread instead, where the
+    generator's cursor lives, and the generator is closed if the client
+    goes away.
+    """
+    done = object()
+    try:
+        while (chunk := await sync_to_async(next)(chunks, done)) is not done:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
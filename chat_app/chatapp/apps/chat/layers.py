@@ -0,0 +1,235 @@
+# apps/chat/layers.py
+import asyncio
+import atexit
+import logging
+import os
+import random
+import string
+import struct
+import time
+from copy import deepcopy
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('>I')
+
+
+def is_cross_process(layer):
+    """Whether the layer's groups span processes, so a process only sees part of a room's events"""
+    return getattr(layer, 'cross_process', not isinstance(layer, InMemoryChannelLayer))
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+    """
+    Channel layer for several worker processes on one host, without Redis.
+    
+    Every process listens on its own Unix socket in `path` and keeps its
+    channels and group memberships locally, exactly like
+    InMemoryChannelLayer. Channel names embed the id of the owning process,
+    so send() goes straight to that process. group_send() delivers to the
+    local members and forwards the message once to every other process,
+    which delivers it to its own members. Frames are length-prefixed
+    MessagePack, so messages must hold plain data, as with channels-redis.
+    
+    Capacity and expiry behave as in the in-memory layer for local
+    channels. A send to another process is fire-and-forget: if the target
+    channel is full there, the message is dropped and counted, the same
+    way group_send drops messages for full channels.
+    """
+    
+    cross_process = True
+    PEER_REFRESH = 1.0  # seconds a listing of the socket directory is reused
+    
+    def __init__(self, path='/tmp/chatapp-channels', expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, group_expiry=group_expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = path
+        self.pid = os.getpid()
+        self.process_id = self.new_process_id()
+        self.server = None
+        self.server_loop = None
+        self.writers = {}  # process id -> stream writer on server_loop
+        self.peer_ids = []
+        self.peers_listed_at = 0
+    
+    def new_process_id(self):
+        return ''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(12))
+    
+    def socket_path(self, process_id):
+        return os.path.join(self.path, f'{process_id}.sock')
+    
+    async def start(self):
+        """Listen for other processes, once per process and event loop"""
+        if os.getpid() != self.pid:
+            # Inherited through fork, this process needs an identity of its own
+            self.pid = os.getpid()
+            self.process_id = self.new_process_id()
+            self.server = None
+            self.channels = {}
+            self.groups = {}
+        if self.server is not None and not self.server_loop.is_closed():
+            return
+        os.makedirs(self.path, exist_ok=True)
+        own_path = self.socket_path(self.process_id)
+        if os.path.exists(own_path):
+            os.unlink(own_path)
+        self.server = await asyncio.start_unix_server(self.handle_peer, path=own_path)
+        self.server_loop = asyncio.get_running_loop()
+        self.writers = {}
+        atexit.register(self.remove_socket)
+    
+    def remove_socket(self):
+        try:
+            os.unlink(self.socket_path(self.process_id))
+        except FileNotFoundError:
+            pass
+    
+    def owner(self, channel):
+        """Id of the process a specific channel lives in, None if it is ours or not specific"""
+        if '!' not in channel:
+            return None
+        process_id = channel.split('!', 1)[0].rsplit('.', 1)[-1]
+        return None if process_id == self.process_id else process_id
+    
+    # Channel layer API
+    
+    async def new_channel(self, prefix='specific'):
+        await self.start()
+        return '%s.%s!%s' % (
+            prefix,
+            self.process_id,
+            ''.join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+    
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        process_id = self.owner(channel)
+        if process_id is None:
+            await self.deliver(channel, deepcopy(message))
+        else:
+            await self.forward(process_id, ['send', channel, message])
+    
+    async def deliver(self, channel, message):
+        # InMemoryChannelLayer.send with per-channel capacities
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        await queue.put((time.time() + self.expiry, message))
+    
+    async def receive(self, channel):
+        await self.start()
+        return await super().receive(channel)
+    
+    async def group_add(self, group, channel):
+        await self.start()
+        await super().group_add(group, channel)
+    
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        frame = self.encode(['group', group, message])
+        for process_id in self.list_peers():
+            await self.forward(process_id, frame)
+        await self.deliver_group(group, message)
+    
+    async def deliver_group(self, group, message):
+        self._clean_expired()
+        for channel in list(self.groups.get(group, {})):
+            try:
+                await self.deliver(channel, deepcopy(message))
+            except ChannelFull:
+                metrics.incr('channel_layer.dropped')
+    
+    async def flush(self):
+        await super().flush()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+    
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        await self.flush()
+        self.remove_socket()
+    
+    # Transport
+    
+    def encode(self, item):
+        payload = msgpack.packb(item, use_bin_type=True)
+        return HEADER.pack(len(payload)) + payload
+    
+    def list_peers(self):
+        now = time.monotonic()
+        if now - self.peers_listed_at > self.PEER_REFRESH:
+            try:
+                names = os.listdir(self.path)
+            except FileNotFoundError:
+                names = []
+            own = f'{self.process_id}.sock'
+            self.peer_ids = [name[:-5] for name in names if name.endswith('.sock') and name != own]
+            self.peers_listed_at = now
+        return self.peer_ids
+    
+    async def forward(self, process_id, item):
+        """Write one frame to another process, forgetting it if it is gone"""
+        frame = item if isinstance(item, bytes) else self.encode(item)
+        loop = asyncio.get_running_loop()
+        # Connections are kept for the serving loop; other loops (async_to_sync) use one-off ones
+        persistent = loop is self.server_loop
+        writer = self.writers.get(process_id) if persistent else None
+        try:
+            if writer is None or writer.is_closing():
+                reader, writer = await asyncio.open_unix_connection(self.socket_path(process_id))
+                if persistent:
+                    self.writers[process_id] = writer
+            writer.write(frame)
+            await writer.drain()
+        except (ConnectionRefusedError, FileNotFoundError):
+            # The process died without cleaning up its socket
+            self.forget_peer(process_id, unlink=True)
+            return
+        except (ConnectionError, OSError):
+            self.forget_peer(process_id)
+            metrics.incr('channel_layer.send_failed')
+            return
+        if not persistent:
+            writer.close()
+    
+    def forget_peer(self, process_id, unlink=False):
+        writer = self.writers.pop(process_id, None)
+        if writer is not None:
+            writer.close()
+        if process_id in self.peer_ids:
+            self.peer_ids.remove(process_id)
+        if unlink:
+            try:
+                os.unlink(self.socket_path(process_id))
+            except FileNotFoundError:
+                pass
+    
+    async def handle_peer(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                payload = await reader.readexactly(HEADER.unpack(header)[0])
+                kind, target, message = msgpack.unpackb(payload, raw=False)
+                if kind == 'group':
+                    await self.deliver_group(target, message)
+                else:
+                    try:
+                        await self.deliver(target, message)
+                    except ChannelFull:
+                        metrics.incr('channel_layer.dropped')
+        except (asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Peer went away, or this process's loop is shutting down
+            pass
+        except Exception:
+            logger.exception('Dropping connection from a peer process')
+        finally:
+            writer.close()
@@ -0,0 +1,89 @@
+# apps/chat/management/commands/backfill_direct_keys.py
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery
+from apps.chat.changes import record
+from apps.chat.models import ChatMembership, ChatRoom, Message
+from apps.chat.recent import recent_messages
+from apps.chat.search import search_index
+from apps.chat.services import unread_count
+
+
+class Command(BaseCommand):
+    help = 'Set ChatRoom.direct_key on direct rooms, merging duplicate rooms of the same pair of users'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of moved messages reindexed at a time')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be keyed and merged')
+    
+    def handle(self, *args, **options):
+        members = defaultdict(set)
+        for room_id, user_id in ChatMembership.objects.filter(
+            room__room_type='direct'
+        ).values_list('room_id', 'user_id').order_by():
+            members[room_id].add(user_id)
+        
+        # Oldest room first, a room that already has its key always wins
+        rooms = ChatRoom.objects.filter(room_type='direct').order_by('created_at', 'id')
+        pairs = defaultdict(list)
+        skipped = 0
+        for room in rooms.only('id', 'direct_key', 'created_at'):
+            if len(members[room.id]) != 2:
+                # Someone left, there is no pair to key the room by
+                skipped += 1
+                continue
+            key = ChatRoom.direct_key_for(*members[room.id])
+            if room.direct_key == key:
+                pairs[key].insert(0, room)
+            else:
+                pairs[key].append(room)
+        
+        keyed = merged = 0
+        for key, (room, *duplicates) in pairs.items():
+            if room.direct_key == key and not duplicates:
+                continue
+            if options['dry_run']:
+                self.stdout.write(f'{room.id}: {key}' + (f', merging {len(duplicates)} rooms' if duplicates else ''))
+            else:
+                self.merge(room, duplicates, key, options['batch_size'])
+            keyed += 1
+            merged += len(duplicates)
+        
+        verb = 'Would key' if options['dry_run'] else 'Keyed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {keyed} direct rooms, merging {merged} duplicates; '
+            f'skipped {skipped} rooms without exactly two members'
+        ))
+    
+    def merge(self, room, duplicates, key, batch_size):
+        duplicate_ids = [duplicate.id for duplicate in duplicates]
+        with transaction.atomic():
+            moved = list(Message.objects.filter(room_id__in=duplicate_ids).values_list('id', flat=True))
+            if duplicate_ids:
+                Message.objects.filter(room_id__in=duplicate_ids).update(room=room)
+                # Each member keeps their furthest read watermark of all the copies
+                read_up_to = ChatMembership.objects.filter(
+                    room_id__in=duplicate_ids + [room.id],
+                    user_id=OuterRef('user_id')
+                ).order_by().values('user_id').annotate(latest=Max('last_read_at')).values('latest')
+                ChatMembership.objects.filter(room=room).update(last_read_at=Subquery(read_up_to))
+                ChatRoom.objects.filter(id__in=duplicate_ids).delete()
+            
+            newest = Message.objects.filter(room=room).order_by('-created_at', '-id')
+            ChatRoom.objects.filter(id=room.id).update(
+                direct_key=key,
+                last_message=Subquery(newest.values('id')[:1]),
+                last_message_at=Subquery(newest.values('created_at')[:1])
+            )
+            ChatMembership.objects.filter(room=room).update(
+                unread_count=unread_count(room.id, OuterRef('user_id'), OuterRef('last_read_at'))
+            )
+            record([('room', room.id, None, None)] + [('message', room.id, message_id, None) for message_id in moved])
+        
+        if moved:
+            recent_messages.invalidate(room.id)
+            for start in range(0, len(moved), batch_size):
+                search_index.update(list(Message.objects.filter(id__in=moved[start:start + batch_size])))
@@ -0,0 +1,91 @@
+# apps/chat/management/commands/bench_channel_layer.py
+import asyncio
+import multiprocessing
+import shutil
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+from channels.layers import InMemoryChannelLayer
+from apps.chat.layers import UnixSocketChannelLayer
+from apps.chat.protocol import room_event
+from .bench_fanout import sample_message
+
+
+async def run_worker(layer_name, path, index, members, messages, barrier, results):
+    """Join `members` channels to one group, then drain `messages` broadcasts on each"""
+    if layer_name == 'unix-socket':
+        layer = UnixSocketChannelLayer(path=path, capacity=messages + 1)
+    else:
+        layer = InMemoryChannelLayer(capacity=messages + 1)
+    channels = [await layer.new_channel() for _ in range(members)]
+    for channel in channels:
+        await layer.group_add('chat_bench', channel)
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    
+    started = time.time()
+    # In-memory workers can only reach their own channels, so each sends for itself;
+    # with the socket layer the first worker's broadcasts reach every worker
+    if layer_name == 'in-memory' or index == 0:
+        event = room_event('chat_message', {'type': 'message', 'data': sample_message()})
+        for _ in range(messages):
+            await layer.group_send('chat_bench', event)
+    
+    for _ in range(messages):
+        for channel in channels:
+            await layer.receive(channel)
+    results.put((index, started, time.time(), members * messages))
+    await layer.close()
+
+
+def worker(*args):
+    asyncio.run(run_worker(*args))
+
+
+class Command(BaseCommand):
+    help = 'Compare group_send throughput of InMemoryChannelLayer and UnixSocketChannelLayer across worker processes'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--members', type=int, default=1000,
+                            help='Group members, split evenly over the workers')
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Broadcasts sent to the group per run')
+    
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'layer':>12} {'workers':>8} {'members':>8} {'delivered':>10} {'elapsed':>10} {'deliveries/s':>13}"
+        )
+        for workers in options['workers']:
+            for layer_name in ('in-memory', 'unix-socket'):
+                delivered, elapsed = self.run(layer_name, workers, options['members'], options['messages'])
+                self.stdout.write(
+                    f'{layer_name:>12} {workers:>8} {options["members"]:>8} {delivered:>10} '
+                    f'{elapsed * 1000:>7.1f} ms {delivered / elapsed:>13.0f}'
+                )
+        self.stdout.write(
+            'in-memory workers each broadcast to their own share of the group only; '
+            'unix-socket broadcasts from one worker reach the whole group.'
+        )
+    
+    def run(self, layer_name, workers, members, messages):
+        context = multiprocessing.get_context('fork')
+        path = tempfile.mkdtemp(prefix='bench-layer-')
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=worker,
+                args=(layer_name, path, index, members // workers, messages, barrier, results)
+            )
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        finished = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        shutil.rmtree(path, ignore_errors=True)
+        
+        started = min(started for index, started, ended, delivered in finished)
+        ended = max(ended for index, started, ended, delivered in finished)
+        return sum(delivered for index, started, ended, delivered in finished), ended - started
@@ -0,0 +1,92 @@
+# apps/chat/management/commands/bench_fanout.py
+import asyncio
+import json
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from channels.layers import InMemoryChannelLayer
+from apps.chat.protocol import room_event
+
+
+def sample_message():
+    return {
+        'id': str(uuid.uuid4()),
+        'sender': {
+            'id': str(uuid.uuid4()),
+            'username': 'benchmark_user',
+            'avatar': '/media/avatars/2024/01/benchmark_user.png'
+        },
+        'message_type': 'text',
+        'content': 'The quick brown fox jumps over the lazy dog. ' * 4,
+        'reply_to': None,
+        'status': 'sent',
+        'created_at': timezone.now().isoformat()
+    }
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of one chat_message broadcast, per-recipient encoding vs encode-once'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--rounds', type=int, default=50,
+                            help='Broadcasts timed per member count')
+    
+    def handle(self, *args, **options):
+        rounds = options['rounds']
+        
+        self.stdout.write(
+            f"{'members':>8} {'mode':>13} {'encode/bcast':>14} {'fan-out/bcast':>15} {'encodes':>8}"
+        )
+        for members in options['members']:
+            for mode in ('per-recipient', 'encode-once'):
+                encode_us, encodes = self.time_encode(mode, members, rounds)
+                fanout_us = asyncio.run(self.time_fanout(mode, members, rounds))
+                self.stdout.write(
+                    f'{members:>8} {mode:>13} {encode_us:>11.1f} us {fanout_us:>12.1f} us {encodes:>8}'
+                )
+    
+    def time_encode(self, mode, members, rounds):
+        """Time spent producing every recipient's frame for one broadcast"""
+        message = sample_message()
+        started = time.perf_counter()
+        for _ in range(rounds):
+            if mode == 'per-recipient':
+                # What each consumer's handler used to do on its own
+                for _ in range(members):
+                    json.dumps({'type': 'message', 'data': message})
+            else:
+                event = room_event('chat_message', {'type': 'message', 'data': message})
+                for _ in range(members):
+                    event['text']
+        elapsed = time.perf_counter() - started
+        encodes = members if mode == 'per-recipient' else 1
+        return elapsed / rounds * 1e6, encodes
+    
+    async def time_fanout(self, mode, members, rounds):
+        """End-to-end group_send through InMemoryChannelLayer, drained by every member"""
+        layer = InMemoryChannelLayer(capacity=rounds + 1)
+        channels = [await layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await layer.group_add('chat_bench', channel)
+        
+        message = sample_message()
+        started = time.perf_counter()
+        for _ in range(rounds):
+            if mode == 'per-recipient':
+                await layer.group_send('chat_bench', {'type': 'chat_message', 'message': message})
+            else:
+                await layer.group_send(
+                    'chat_bench',
+                    room_event('chat_message', {'type': 'message', 'data': message})
+                )
+            for channel in channels:
+                event = await layer.receive(channel)
+                if mode == 'per-recipient':
+                    json.dumps({'type': 'message', 'data': event['message']})
+                else:
+                    event['text']
+        elapsed = time.perf_counter() - started
+        await layer.flush()
+        return elapsed / rounds * 1e6
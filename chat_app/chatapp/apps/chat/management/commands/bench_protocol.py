@@ -0,0 +1,73 @@
+# apps/chat/management/commands/bench_protocol.py
+import json
+import time
+import uuid
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from apps.chat import protocol
+from .bench_fanout import sample_message
+
+
+def sample_frames():
+    room_id = str(uuid.uuid4())
+    user = {'user_id': str(uuid.uuid4()), 'username': 'benchmark_user'}
+    return {
+        'message': {'type': 'message', 'data': sample_message(), 'room_id': room_id},
+        'typing': {'type': 'typing', 'room_id': room_id, 'users': [user]},
+        'read': {
+            'type': 'read',
+            'message_id': str(uuid.uuid4()),
+            **user,
+            'read_at': timezone.now().isoformat(),
+            'room_id': room_id
+        },
+        'status': {'type': 'status', **user, 'is_online': True},
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compare bytes on the wire and encode/decode time of the WebSocket protocols'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=10000,
+                            help='Encodes and decodes timed per frame and format')
+    
+    def handle(self, *args, **options):
+        if protocol.msgpack is None:
+            raise CommandError('msgpack is not installed')
+        rounds = options['rounds']
+        
+        self.stdout.write(
+            f"{'frame':>8} {'format':>16} {'bytes':>6} {'encode':>11} {'decode':>11}"
+        )
+        for kind, payload in sample_frames().items():
+            for name in ('json', 'msgpack', 'msgpack.deflate'):
+                size, encode_us, decode_us = self.measure(name, payload, rounds)
+                self.stdout.write(
+                    f'{kind:>8} {name:>16} {size:>6} {encode_us:>8.2f} us {decode_us:>8.2f} us'
+                )
+    
+    def measure(self, name, payload, rounds):
+        """Frame size and per-frame cost, starting from the payload dict"""
+        if name == 'json':
+            encode = json.dumps
+            decode = json.loads
+        else:
+            compress = name == 'msgpack.deflate'
+            # Binary frames are converted from the JSON one, the process cache is bypassed
+            encode = lambda payload: protocol.pack(json.dumps(payload), compress)
+            decode = lambda frame: protocol.unpack(frame, compress)
+        
+        frame = encode(payload)
+        size = len(frame.encode() if isinstance(frame, str) else frame)
+        
+        started = time.perf_counter()
+        for _ in range(rounds):
+            encode(payload)
+        encode_us = (time.perf_counter() - started) / rounds * 1e6
+        
+        started = time.perf_counter()
+        for _ in range(rounds):
+            decode(frame)
+        decode_us = (time.perf_counter() - started) / rounds * 1e6
+        return size, encode_us, decode_us
@@ -0,0 +1,43 @@
+# apps/chat/management/commands/export_room.py
+import sys
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from apps.chat.export import export_room, gzipped
+from apps.chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = "Export a room's history as NDJSON: the room, then every message with its reactions and attachments"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('room_id')
+        parser.add_argument('--output', default='-',
+                            help='File to write, standard output by default')
+        parser.add_argument('--gzip', action='store_true',
+                            help='Gzip the output on the fly')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Messages read and encoded at a time, CHAT_EXPORT_CHUNK_SIZE by default')
+    
+    def handle(self, *args, **options):
+        try:
+            room = ChatRoom.objects.filter(id=options['room_id']).first()
+        except ValidationError:
+            room = None
+        if room is None:
+            raise CommandError(f"No room with id {options['room_id']}")
+        
+        chunks = export_room(room, options['chunk_size'])
+        if options['gzip']:
+            chunks = gzipped(chunks)
+        
+        written = 0
+        output = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        if options['output'] != '-':
+            self.stdout.write(self.style.SUCCESS(f"Wrote {written} bytes to {options['output']}"))
@@ -0,0 +1,53 @@
+# apps/chat/management/commands/fold_read_receipts.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from apps.chat.models import ChatMembership, MessageReadReceipt
+
+
+class Command(BaseCommand):
+    help = 'Fold legacy MessageReadReceipt rows into ChatMembership.last_read_at watermarks'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of (user, room) pairs folded per transaction')
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete the receipts once they have been folded')
+    
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        
+        # Newest message each user has a receipt for, per room
+        latest_reads = MessageReadReceipt.objects.values(
+            'user_id', 'message__room_id'
+        ).annotate(
+            read_up_to=Max('message__created_at')
+        ).order_by()
+        
+        folded = 0
+        batch = []
+        for row in latest_reads.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                folded += self.fold(batch)
+                batch = []
+        if batch:
+            folded += self.fold(batch)
+        
+        self.stdout.write(self.style.SUCCESS(f'Advanced {folded} membership watermarks'))
+        
+        if options['delete']:
+            deleted = MessageReadReceipt.objects.all().delete()[0]
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} read receipts'))
+    
+    @transaction.atomic
+    def fold(self, rows):
+        advanced = 0
+        for row in rows:
+            # Never move a watermark backwards
+            advanced += ChatMembership.objects.filter(
+                user_id=row['user_id'],
+                room_id=row['message__room_id'],
+                last_read_at__lt=row['read_up_to']
+            ).update(last_read_at=row['read_up_to'])
+        return advanced
@@ -0,0 +1,227 @@
+# apps/chat/management/commands/loadtest.py
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from apps.accounts.models import User
+from apps.chat.models import ChatMembership, ChatRoom
+from apps.chat.ratelimit import limiter
+from apps.chat.routing import websocket_urlpatterns
+
+
+def parse_mix(value):
+    """'send=6,typing=3,read=1' -> {'send': 6.0, 'typing': 3.0, 'read': 1.0}"""
+    mix = {}
+    for part in value.split(','):
+        action, _, weight = part.partition('=')
+        if action not in ('send', 'typing', 'read'):
+            raise CommandError(f'Unknown action in --mix: {action}')
+        mix[action] = float(weight or 1)
+    return mix
+
+
+def percentile(samples, q):
+    if len(samples) < 2:
+        return samples[0] if samples else None
+    return statistics.quantiles(samples, n=100)[q - 1]
+
+
+class SimulatedClient:
+    """One WebSocket client driven in-process through WebsocketCommunicator"""
+    
+    def __init__(self, application, user, room_id):
+        self.user = user
+        self.room_id = str(room_id)
+        self.communicator = WebsocketCommunicator(application, f'/ws/chat/{room_id}/')
+        self.communicator.scope['user'] = user
+        self.frames = Counter()
+        self.latencies = []
+        self.last_message_id = None
+        self.sent = 0
+    
+    async def connect(self):
+        connected, code = await self.communicator.connect()
+        if not connected:
+            raise CommandError(f'{self.user.username} was refused with code {code}')
+    
+    async def read(self):
+        # Cancelled at the end of the run, never times out on its own
+        while True:
+            output = await self.communicator.receive_output(timeout=3600)
+            if output['type'] == 'websocket.close':
+                return
+            frame = json.loads(output['text'])
+            self.frames[frame['type']] += 1
+            if frame['type'] == 'message':
+                self.last_message_id = frame['data']['id']
+                content = frame['data']['content']
+                if content.startswith('loadtest '):
+                    self.latencies.append(time.perf_counter() - float(content.split()[1]))
+    
+    async def act(self, action):
+        if action == 'send':
+            self.sent += 1
+            await self.communicator.send_json_to({
+                'action': 'send_message',
+                'content': f'loadtest {time.perf_counter()}',
+                'client_id': str(uuid.uuid4())
+            })
+        elif action == 'typing':
+            await self.communicator.send_json_to({'action': 'typing', 'is_typing': True})
+        elif action == 'read' and self.last_message_id:
+            await self.communicator.send_json_to({'action': 'read', 'message_id': self.last_message_id})
+
+
+class Command(BaseCommand):
+    help = 'Load-test ChatConsumer in-process: connect rate, fan-out latency, throughput and memory'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200)
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--duration', type=float, default=10,
+                            help='Seconds the action mix is driven for')
+        parser.add_argument('--rate', type=float, default=1,
+                            help='Actions per second per client')
+        parser.add_argument('--mix', type=parse_mix, default=parse_mix('send=6,typing=3,read=1'),
+                            help='Relative weights of send, typing and read actions')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Keep CHAT_RATE_LIMITS on, they are lifted by default')
+        parser.add_argument('--output', default=None,
+                            help='Where to write the JSON results, loadtest-<time>.json by default')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the generated users and rooms')
+    
+    def handle(self, *args, **options):
+        if options['clients'] < options['rooms']:
+            raise CommandError('Need at least one client per room')
+        if not options['rate_limits']:
+            limiter.limits = {}
+        
+        run_id = uuid.uuid4().hex[:8]
+        users, rooms = self.create_fixtures(run_id, options['clients'], options['rooms'])
+        try:
+            results = asyncio.run(self.run(users, rooms, options))
+        finally:
+            if not options['keep']:
+                ChatRoom.objects.filter(id__in=[room.id for room in rooms]).delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+        
+        results['run_id'] = run_id
+        results['started_at'] = timezone.now().isoformat()
+        output = options['output'] or f'loadtest-{timezone.now():%Y%m%d-%H%M%S}.json'
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+        
+        latency = results['latency_ms']
+        self.stdout.write(f"connect rate:   {results['connect']['per_second']:.0f} clients/s")
+        self.stdout.write(
+            f"fan-out p50/p95/p99: {latency['p50']} / {latency['p95']} / {latency['p99']} ms "
+            f"({latency['samples']} samples)"
+        )
+        self.stdout.write(
+            f"messages:       {results['messages']['sent_per_second']:.1f} sent/s, "
+            f"{results['messages']['delivered_per_second']:.1f} delivered/s"
+        )
+        self.stdout.write(f"memory:         {results['memory_per_connection_kb']:.1f} KiB per connection")
+        self.stdout.write(self.style.SUCCESS(f'Results written to {output}'))
+    
+    def create_fixtures(self, run_id, clients, rooms):
+        users = [
+            User(username=f'loadtest_{run_id}_{index}', email=f'loadtest_{run_id}_{index}@example.com')
+            for index in range(clients)
+        ]
+        for user in users:
+            user.set_unusable_password()
+        User.objects.bulk_create(users)
+        
+        rooms = ChatRoom.objects.bulk_create([
+            ChatRoom(room_type='group', name=f'loadtest {run_id} {index}', created_by=users[0])
+            for index in range(rooms)
+        ])
+        ChatMembership.objects.bulk_create([
+            ChatMembership(user=user, room=rooms[index % len(rooms)])
+            for index, user in enumerate(users)
+        ])
+        return users, rooms
+    
+    async def run(self, users, rooms, options):
+        application = URLRouter(websocket_urlpatterns)
+        clients = [
+            SimulatedClient(application, user, rooms[index % len(rooms)].id)
+            for index, user in enumerate(users)
+        ]
+        
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        for client in clients:
+            await client.connect()
+        connect_seconds = time.perf_counter() - started
+        per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / len(clients)
+        tracemalloc.stop()
+        
+        readers = [asyncio.ensure_future(client.read()) for client in clients]
+        actions, weights = zip(*options['mix'].items())
+        deadline = time.perf_counter() + options['duration']
+        
+        async def drive(client):
+            # Spread clients out so they don't all act on the same tick
+            await asyncio.sleep(random.random() / options['rate'])
+            while time.perf_counter() < deadline:
+                await client.act(random.choices(actions, weights)[0])
+                await asyncio.sleep(random.expovariate(options['rate']))
+        
+        started = time.perf_counter()
+        await asyncio.gather(*[drive(client) for client in clients])
+        # Let in-flight broadcasts land before counting, deliveries are counted over the longer span
+        driven = time.perf_counter() - started
+        await asyncio.sleep(1)
+        elapsed = time.perf_counter() - started
+        
+        for reader in readers:
+            reader.cancel()
+        for client in clients:
+            await client.communicator.disconnect()
+        
+        latencies = sorted(sample * 1000 for client in clients for sample in client.latencies)
+        frames = sum((client.frames for client in clients), Counter())
+        sent = sum(client.sent for client in clients)
+        return {
+            'config': {
+                'clients': options['clients'],
+                'rooms': options['rooms'],
+                'duration': options['duration'],
+                'rate': options['rate'],
+                'mix': options['mix'],
+                'rate_limits': options['rate_limits'],
+            },
+            'connect': {
+                'clients': len(clients),
+                'seconds': round(connect_seconds, 3),
+                'per_second': len(clients) / connect_seconds,
+            },
+            'latency_ms': {
+                'samples': len(latencies),
+                'p50': round(percentile(latencies, 50), 2) if latencies else None,
+                'p95': round(percentile(latencies, 95), 2) if latencies else None,
+                'p99': round(percentile(latencies, 99), 2) if latencies else None,
+                'max': round(latencies[-1], 2) if latencies else None,
+            },
+            'messages': {
+                'sent': sent,
+                'delivered': frames['message'],
+                'sent_per_second': sent / driven,
+                'delivered_per_second': frames['message'] / elapsed,
+            },
+            'frames': dict(frames),
+            'memory_per_connection_kb': per_connection / 1024,
+        }
@@ -0,0 +1,43 @@
+# apps/chat/management/commands/rebuild_reaction_summaries.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from apps.chat.models import Message
+from apps.chat.services import summarize_reactions
+
+
+class Command(BaseCommand):
+    help = 'Rebuild Message.reaction_summary from the MessageReaction rows'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of messages checked per transaction')
+    
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        
+        rebuilt = 0
+        batch = []
+        for message_id in Message.objects.values_list('id', flat=True).order_by().iterator(chunk_size=batch_size):
+            batch.append(message_id)
+            if len(batch) >= batch_size:
+                rebuilt += self.rebuild(batch)
+                batch = []
+        if batch:
+            rebuilt += self.rebuild(batch)
+        
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} reaction summaries'))
+    
+    @transaction.atomic
+    def rebuild(self, message_ids):
+        # Locked like in add_reaction, so live reactions are not overwritten
+        stored = dict(Message.objects.select_for_update().filter(
+            id__in=message_ids
+        ).values_list('id', 'reaction_summary'))
+        summaries = summarize_reactions(list(stored))
+        changed = [
+            Message(id=message_id, reaction_summary=summaries[message_id])
+            for message_id, summary in stored.items()
+            if summary != summaries[message_id]
+        ]
+        Message.objects.bulk_update(changed, ['reaction_summary'])
+        return len(changed)
@@ -0,0 +1,22 @@
+# apps/chat/management/commands/rebuild_room_summaries.py
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from apps.chat.models import ChatMembership, ChatRoom, Message
+from apps.chat.services import unread_count
+
+
+class Command(BaseCommand):
+    help = 'Recompute ChatRoom.last_message/last_message_at and ChatMembership.unread_count'
+    
+    def handle(self, *args, **options):
+        newest = Message.objects.filter(room_id=OuterRef('id')).order_by('-created_at', '-id')
+        rooms = ChatRoom.objects.update(
+            last_message=Subquery(newest.values('id')[:1]),
+            last_message_at=Subquery(newest.values('created_at')[:1])
+        )
+        self.stdout.write(self.style.SUCCESS(f'Updated the last message of {rooms} rooms'))
+        
+        memberships = ChatMembership.objects.update(
+            unread_count=unread_count(OuterRef('room_id'), OuterRef('user_id'), OuterRef('last_read_at'))
+        )
+        self.stdout.write(self.style.SUCCESS(f'Recounted unread messages of {memberships} memberships'))
@@ -0,0 +1,46 @@
+# apps/chat/management/commands/rebuild_search_index.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from apps.chat.models import Message
+from apps.chat.search import search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text message search index in chunks'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of messages indexed per transaction')
+        parser.add_argument('--keep', action='store_true',
+                            help='Reindex over the existing entries instead of clearing them first')
+    
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        backend = search_index.backend
+        self.stdout.write(f'Using {type(backend).__name__}')
+        
+        backend.ensure_schema()
+        if not options['keep']:
+            backend.clear()
+        
+        indexed = 0
+        batch = []
+        messages = Message.objects.filter(is_deleted=False).exclude(content='').only(
+            'id', 'room_id', 'content', 'is_deleted'
+        ).order_by()
+        for message in messages.iterator(chunk_size=batch_size):
+            batch.append(message)
+            if len(batch) >= batch_size:
+                indexed += self.index(backend, batch)
+                batch = []
+        if batch:
+            indexed += self.index(backend, batch)
+        
+        backend.optimize()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} messages'))
+    
+    @transaction.atomic
+    def index(self, backend, messages):
+        # Replaces, so messages indexed live while this runs are not doubled
+        backend.update(messages)
+        return len(messages)
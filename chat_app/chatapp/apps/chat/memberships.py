@@ -0,0 +1,128 @@
+# apps/chat/memberships.py
+import uuid
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from apps.accounts.models import User
+from .cache import membership_cache
+from .changes import record_memberships
+from .models import ChatMembership, ChatRoom
+from .protocol import room_event
+
+
+def max_batch_size():
+    return getattr(settings, 'CHAT_BULK_MEMBERS_MAX', 5000)
+
+
+def parse_user_ids(values):
+    """Distinct user UUIDs in request order, ValueError on anything that is not one"""
+    if not isinstance(values, (list, tuple)):
+        raise ValueError('Expected a list of user ids')
+    user_ids = []
+    for value in values:
+        try:
+            user_id = uuid.UUID(str(value))
+        except ValueError:
+            raise ValueError(f'Invalid user id {value}')
+        if user_id not in user_ids:
+            user_ids.append(user_id)
+    if len(user_ids) > max_batch_size():
+        raise ValueError(f'At most {max_batch_size()} users per request')
+    return user_ids
+
+
+def unknown_users(user_ids):
+    """The ids of user_ids that don't belong to any user, in one query"""
+    known = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    return [user_id for user_id in user_ids if user_id not in known]
+
+
+def membership_event(room_id, added=(), removed=(), roles=None):
+    """
+    One members frame for a whole batch.
+    
+    removed travels as plain meta too, so connections of removed users can
+    drop the room without decoding the frame.
+    """
+    return room_event('membership_update', {
+        'type': 'members',
+        'room_id': str(room_id),
+        'added': [str(user_id) for user_id in added],
+        'removed': [str(user_id) for user_id in removed],
+        'roles': roles or {}
+    }, room_id=str(room_id), removed=[str(user_id) for user_id in removed])
+
+
+def memberships_changed(room_id, user_ids, event):
+    """
+    Log the batch for delta sync and, once it is committed, forget the
+    members' cached room ids and tell the room.
+    
+    bulk_create() and update() bypass the ChatMembership signals, so the
+    cache is invalidated here, once per batch. Removals go through
+    delete(), whose per-row post_delete only drops a cache entry.
+    """
+    record_memberships(room_id, user_ids)
+    
+    def done():
+        for user_id in user_ids:
+            membership_cache.invalidate(str(user_id))
+        async_to_sync(get_channel_layer().group_send)(f'chat_{room_id}', event)
+    transaction.on_commit(done)
+
+
+def create_room(creator, room_type, name, member_ids):
+    """A room with creator as admin and member_ids as members, one INSERT for all memberships"""
+    member_ids = [user_id for user_id in member_ids if user_id != creator.id]
+    with transaction.atomic():
+        room = ChatRoom.objects.create(room_type=room_type, name=name, created_by=creator)
+        ChatMembership.objects.bulk_create(
+            [ChatMembership(user=creator, room=room, role='admin')]
+            + [ChatMembership(user_id=user_id, room=room) for user_id in member_ids]
+        )
+        memberships_changed(room.id, [creator.id] + member_ids, membership_event(
+            room.id, added=[creator.id] + member_ids, roles={str(creator.id): 'admin'}
+        ))
+    return room
+
+
+def add_members(room, user_ids, role='member'):
+    """Add the users who aren't members yet, returns their ids"""
+    with transaction.atomic():
+        existing = set(ChatMembership.objects.filter(room=room, user_id__in=user_ids).values_list('user_id', flat=True))
+        added = [user_id for user_id in user_ids if user_id not in existing]
+        # ignore_conflicts: a concurrent add of the same user is not an error
+        ChatMembership.objects.bulk_create(
+            [ChatMembership(user_id=user_id, room=room, role=role) for user_id in added],
+            ignore_conflicts=True
+        )
+        if added:
+            memberships_changed(room.id, added, membership_event(
+                room.id, added=added, roles={str(user_id): role for user_id in added} if role != 'member' else None
+            ))
+    return added
+
+
+def remove_members(room, user_ids):
+    """Remove the users who are members, returns their ids"""
+    with transaction.atomic():
+        memberships = ChatMembership.objects.filter(room=room, user_id__in=user_ids)
+        removed = list(memberships.values_list('user_id', flat=True))
+        memberships.delete()
+        if removed:
+            memberships_changed(room.id, removed, membership_event(room.id, removed=removed))
+    return removed
+
+
+def set_role(room, user_ids, role):
+    """Give the members among user_ids the role in one UPDATE, returns the ids that changed"""
+    with transaction.atomic():
+        memberships = ChatMembership.objects.filter(room=room, user_id__in=user_ids).exclude(role=role)
+        changed = list(memberships.values_list('user_id', flat=True))
+        ChatMembership.objects.filter(room=room, user_id__in=changed).update(role=role)
+        if changed:
+            memberships_changed(room.id, changed, membership_event(
+                room.id, roles={str(user_id): role for user_id in changed}
+            ))
+    return changed
@@ -0,0 +1,24 @@
+# apps/chat/metrics.py
+from collections import Counter
+
+# Monotonic event counters, e.g. frames dropped for slow consumers
+counters = Counter()
+
+# name -> callable returning the current value
+gauges = {}
+
+
+def incr(name, amount=1):
+    counters[name] += amount
+
+
+def register_gauge(name, read):
+    gauges[name] = read
+
+
+def snapshot():
+    """Current values of every counter and gauge in this process"""
+    return {
+        'counters': dict(counters),
+        'gauges': {name: read() for name, read in gauges.items()}
+    }
@@ -1,21 +1,41 @@
 # apps/chat/middleware.py
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
-from rest_framework_simplejwt.tokens import UntypedToken
+from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from urllib.parse import parse_qs
+from .cache import cached_user, partial_user
 
 User = get_user_model()
 
 
 @database_sync_to_async
-def get_user(user_id):
-    try:
-        return User.objects.get(id=user_id)
-    except User.DoesNotExist:
+def get_user(token):
+    """The token's user, AnonymousUser once they are deactivated or deleted"""
+    # Active users only, so deactivation is seen within CHAT_CACHE_TTL even
+    # though the token stays valid until it expires
+    user = cached_user(token['user_id'])
+    if user is None:
         return AnonymousUser()
+    if getattr(settings, 'CHAT_JWT_TRUST_CLAIMS', False):
+        return user_from_claims(token) or user
+    return user
+
+
+def user_from_claims(token):
+    """Build the user straight from the token's claims, None if they are missing"""
+    try:
+        fields = {
+            'id': User._meta.pk.to_python(token['user_id']),
+            'username': token['username'],
+            'avatar': token['avatar']
+        }
+    except KeyError:
+        return None
+    return partial_user(fields)
 
 
 class JWTAuthMiddleware(BaseMiddleware):
@@ -29,16 +49,13 @@ class JWTAuthMiddleware(BaseMiddleware):
         
         if token:
             try:
-                # Validate token
-                UntypedToken(token)
-                # Decode token to get user_id
-                from rest_framework_simplejwt.tokens import AccessToken
+                # Verifies signature, expiry and token type in one decode
                 access_token = AccessToken(token)
-                user_id = access_token['user_id']
-                scope['user'] = await get_user(user_id)
             except (InvalidToken, TokenError):
                 scope['user'] = AnonymousUser()
-        else:
+            else:
+                scope['user'] = await get_user(access_token)
+        elif 'user' not in scope:
             # Try to get user from session (for template-based auth)
             if 'session' in scope:
                 from channels.auth import get_user as channels_get_user
@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 import uuid
 
 
@@ -18,6 +19,13 @@ class ChatRoom(models.Model):
     members = models.ManyToManyField(settings.AUTH_USER_MODEL, through='ChatMembership', related_name='chat_rooms')
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='created_rooms')
     
+    # Sorted pair of member ids of a direct room (see direct_key_for), None for groups
+    direct_key = models.CharField(max_length=65, unique=True, null=True, blank=True, editable=False)
+    
+    # Denormalized newest message, maintained by services.update_room_summaries
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -25,6 +33,7 @@ class ChatRoom(models.Model):
         db_table = 'chat_rooms'
         indexes = [
             models.Index(fields=['room_type', 'created_at']),
+            models.Index(fields=['-last_message_at']),
         ]
     
     def __str__(self):
@@ -33,6 +42,11 @@ class ChatRoom(models.Model):
             return f"DM: {' & '.join([m.username for m in members])}"
         return self.name or f"Group {self.id}"
     
+    @staticmethod
+    def direct_key_for(user_id, other_user_id):
+        """Canonical key of the direct room between two users, the same whichever opens it"""
+        return ':'.join(sorted(uuid.UUID(str(value)).hex for value in (user_id, other_user_id)))
+    
     def get_last_message(self):
         return self.messages.order_by('-created_at').first()
 
@@ -52,8 +66,10 @@ class ChatMembership(models.Model):
     muted = models.BooleanField(default=False)
     muted_until = models.DateTimeField(null=True, blank=True)
     
-    # Read tracking
+    # Read tracking: every message created at or before this watermark counts as read
     last_read_at = models.DateTimeField(auto_now_add=True)
+    # Messages of others after the watermark, kept in step on send and read
+    unread_count = models.PositiveIntegerField(default=0)
     
     joined_at = models.DateTimeField(auto_now_add=True)
     
@@ -66,6 +82,9 @@ class ChatMembership(models.Model):
     
     def __str__(self):
         return f"{self.user.username} in {self.room}"
+    
+    def has_read(self, message):
+        return message.created_at <= self.last_read_at
 
 
 class Message(models.Model):
@@ -102,11 +121,16 @@ class Message(models.Model):
     # Status tracking
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='sent')
     
+    # Denormalized reactions, {emoji: {'count': n, 'user_ids': [first few reactors]}},
+    # maintained by services.add_reaction/remove_reaction
+    reaction_summary = models.JSONField(default=dict, blank=True)
+    
     # Soft delete
     is_deleted = models.BooleanField(default=False)
     deleted_at = models.DateTimeField(null=True, blank=True)
     
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Assigned on instantiation so batched writes keep the time they were broadcast with
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
@@ -115,6 +139,8 @@ class Message(models.Model):
         indexes = [
             models.Index(fields=['room', '-created_at']),
             models.Index(fields=['sender', '-created_at']),
+            # The status pipeline's UPDATEs, which only touch messages not read yet
+            models.Index(fields=['room', 'status', 'created_at']),
         ]
     
     def __str__(self):
@@ -122,6 +148,8 @@ class Message(models.Model):
 
 
 class MessageReadReceipt(models.Model):
+    # Legacy per-message receipts, superseded by the ChatMembership.last_read_at
+    # watermark. Existing rows are folded in with `manage.py fold_read_receipts`.
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='read_receipts')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -153,4 +181,37 @@ class MessageReaction(models.Model):
         ]
     
     def __str__(self):
-        return f"{self.user.username} reacted {self.emoji} to {self.message.id}"
\ No newline at end of file
+        return f"{self.user.username} reacted {self.emoji} to {self.message.id}"
+
+
+class ChangeLogEntry(models.Model):
+    """
+    Append-only log of what changed in which room, read by the delta sync endpoint.
+    
+    room_id and object_id are plain values rather than foreign keys, so
+    entries outlive the rows they describe. Membership entries also carry
+    the member, which is how a user hears about rooms they left.
+    """
+    KINDS = [
+        ('room', 'Room'),
+        ('membership', 'Membership'),
+        ('message', 'Message'),
+        ('message_deleted', 'Message deleted'),
+    ]
+    
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=20, choices=KINDS)
+    room_id = models.UUIDField()
+    object_id = models.UUIDField(null=True, blank=True)
+    user_id = models.UUIDField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    class Meta:
+        db_table = 'chat_change_log'
+        indexes = [
+            models.Index(fields=['room_id', 'id']),
+            models.Index(fields=['user_id', 'id']),
+        ]
+    
+    def __str__(self):
+        return f"{self.id}: {self.kind} in {self.room_id}"
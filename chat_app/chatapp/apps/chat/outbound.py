@@ -0,0 +1,127 @@
+# apps/chat/outbound.py
+import asyncio
+import weakref
+from collections import deque
+from django.conf import settings
+from . import metrics
+from .protocol import encode_frame
+from .replay import room_log
+
+
+class OutboundQueue:
+    """
+    Bounded send queue of one WebSocket connection.
+    
+    Channel-layer events are handed over without waiting for the socket, so a
+    slow reader never stalls its consumer or piles up in the channel layer.
+    Frames leave the queue as fast as the server's send() returns. Where
+    send() waits for the socket to take the data, as with uvicorn, that is
+    the client's reading speed. Daphne buffers in its transport and returns
+    at once, so there the queue only absorbs bursts and a slow reader grows
+    Daphne's buffer instead; the limits below then rarely trigger.
+    
+    Once the queue holds CHAT_OUTBOUND_SOFT_LIMIT frames, typing and status
+    frames are dropped and pending reactions to the same message collapse
+    into a single refresh hint. At CHAT_OUTBOUND_HIGH_WATER frames the
+    connection is given up: the backlog is discarded and the client gets a
+    resume hint with the last message and seq delivered per room before it
+    is closed.
+    """
+    
+    DROPPABLE = {'typing', 'status'}
+    
+    live = weakref.WeakSet()
+    
+    def __init__(self, send, close, soft_limit=None, high_water=None):
+        self.send = send
+        self.close = close
+        self.soft_limit = soft_limit or getattr(settings, 'CHAT_OUTBOUND_SOFT_LIMIT', 100)
+        self.high_water = high_water or getattr(settings, 'CHAT_OUTBOUND_HIGH_WATER', 1000)
+        self.frames = deque()  # [kind, frame, key, delivered, seq]
+        self.pending_keys = {}  # coalescing key -> queued entry
+        self.delivered = {}  # room_id -> id of the last message sent
+        self.last_seq = {}  # room_id -> seq of the last room event sent
+        self.ready = asyncio.Event()
+        self.closing = None  # called once the queue is sent, nothing more is queued
+        self.writer = asyncio.ensure_future(self.drain())
+        OutboundQueue.live.add(self)
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    def put(self, kind, frame, key=None, delivered=None, seq=None):
+        """Queue a pre-encoded frame, applying the slow-consumer policy"""
+        if self.closing:
+            return
+        
+        behind = len(self.frames) >= self.soft_limit
+        if kind == 'reaction' and behind and key in self.pending_keys:
+            # The client is behind, have it refetch the reactions once
+            entry = self.pending_keys[key]
+            entry[1] = encode_frame({'type': 'reaction_refresh', 'room_id': key[0], 'message_id': key[1]})
+            entry[4] = seq or entry[4]
+            metrics.incr('outbound.coalesced.reaction')
+            return
+        
+        if behind and kind in self.DROPPABLE:
+            metrics.incr(f'outbound.dropped.{kind}')
+            return
+        
+        if len(self.frames) >= self.high_water:
+            self.overflow()
+            return
+        
+        entry = [kind, frame, key, delivered, seq]
+        self.frames.append(entry)
+        if key is not None:
+            self.pending_keys[key] = entry
+        self.ready.set()
+    
+    def close_after(self, close):
+        """Send what is queued, then call close()"""
+        if not self.closing:
+            self.closing = close
+            self.ready.set()
+    
+    def overflow(self):
+        self.closing = self.close
+        metrics.incr('outbound.disconnected')
+        metrics.incr('outbound.dropped.backlog', len(self.frames))
+        self.frames.clear()
+        self.pending_keys.clear()
+        self.frames.append(['control', encode_frame({
+            'type': 'resume',
+            'reason': 'slow_consumer',
+            'epoch': room_log.epoch,
+            'last_seq': self.last_seq,
+            'last_message_ids': self.delivered
+        }), None, None, None])
+        self.ready.set()
+    
+    async def drain(self):
+        while True:
+            await self.ready.wait()
+            while self.frames:
+                kind, frame, key, delivered, seq = entry = self.frames.popleft()
+                if key is not None and self.pending_keys.get(key) is entry:
+                    del self.pending_keys[key]
+                await self.send(frame)
+                if delivered:
+                    room_id, message_id = delivered
+                    self.delivered[room_id] = message_id
+                if seq:
+                    room_id, number = seq
+                    self.last_seq[room_id] = number
+            self.ready.clear()
+            if self.closing:
+                await self.closing()
+                return
+    
+    def stop(self):
+        self.writer.cancel()
+        OutboundQueue.live.discard(self)
+
+
+metrics.register_gauge('outbound.connections', lambda: len(OutboundQueue.live))
+metrics.register_gauge('outbound.queued', lambda: sum(len(queue) for queue in OutboundQueue.live))
+metrics.register_gauge('outbound.max_depth', lambda: max((len(queue) for queue in OutboundQueue.live), default=0))
@@ -0,0 +1,128 @@
+# apps/chat/persistence.py
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from .models import Message
+from .services import messages_created
+
+logger = logging.getLogger(__name__)
+
+
+def batched_persistence_enabled():
+    return getattr(settings, 'CHAT_MESSAGE_PERSISTENCE', 'sync') == 'batched'
+
+
+class MessageWriteBehind:
+    """
+    Write-behind queue for chat messages (CHAT_MESSAGE_PERSISTENCE = 'batched').
+    
+    Messages arrive with their id and created_at already assigned and have
+    already been broadcast. They are flushed with one bulk_create every
+    CHAT_BATCH_MAX_MESSAGES messages or CHAT_BATCH_MAX_DELAY_MS milliseconds,
+    whichever comes first. submit() returns a future that resolves once the
+    message is committed, or fails with the error that kept it out.
+    
+    Failure semantics:
+    - if the batch insert fails, its messages are retried one by one so a
+      single bad row cannot sink the others;
+    - a reply_to that does not point at a message of the same room (in the
+      database or earlier in the batch) is dropped, as in the sync path;
+    - errors in the follow-up work of committed messages are logged, their
+      futures still resolve;
+    - messages still queued when the process dies are lost, which bounds
+      the loss to one batch window.
+    """
+    
+    def __init__(self, max_messages=None, max_delay_ms=None):
+        self.max_messages = max_messages or getattr(settings, 'CHAT_BATCH_MAX_MESSAGES', 100)
+        self.max_delay = (max_delay_ms or getattr(settings, 'CHAT_BATCH_MAX_DELAY_MS', 50)) / 1000
+        self.pending = []  # (message, future)
+        self.timer = None
+        self.lock = asyncio.Lock()
+    
+    def submit(self, message):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        
+        if len(self.pending) >= self.max_messages:
+            asyncio.ensure_future(self.flush())
+        elif self.timer is None:
+            self.timer = asyncio.ensure_future(self.flush_later())
+        return future
+    
+    async def flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self.timer = None
+        await self.flush()
+    
+    async def flush(self):
+        # Serialized so batches commit in the order they were queued
+        async with self.lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            
+            messages = [message for message, future in batch]
+            try:
+                failures = await database_sync_to_async(self.write)(messages)
+            except Exception as error:
+                logger.exception('Flushing %d messages failed', len(messages))
+                failures = {message.id: error for message in messages}
+            
+            for message, future in batch:
+                if future.done():
+                    continue
+                if message.id in failures:
+                    future.set_exception(failures[message.id])
+                else:
+                    future.set_result(message)
+    
+    def write(self, messages):
+        """Persist a batch, return {message id: error} for the messages that failed"""
+        self.drop_invalid_replies(messages)
+        
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(messages)
+            persisted, failures = messages, {}
+        except DatabaseError:
+            logger.exception('Batched insert of %d messages failed, retrying one by one', len(messages))
+            persisted, failures = [], {}
+            for message in messages:
+                # Don't let a failed message take its replies down with it
+                if message.reply_to_id in failures:
+                    message.reply_to_id = None
+                try:
+                    with transaction.atomic():
+                        Message.objects.bulk_create([message])
+                    persisted.append(message)
+                except DatabaseError as error:
+                    failures[message.id] = error
+        
+        if persisted:
+            # Whatever goes wrong now, the messages are committed and their futures must say so
+            try:
+                messages_created(persisted)
+            except Exception:
+                logger.exception('Follow-up work for %d messages failed', len(persisted))
+        return failures
+    
+    def drop_invalid_replies(self, messages):
+        reply_ids = {message.reply_to_id for message in messages if message.reply_to_id}
+        if not reply_ids:
+            return
+        
+        rooms = dict(Message.objects.filter(id__in=reply_ids).values_list('id', 'room_id'))
+        
+        for message in messages:
+            if message.reply_to_id:
+                reply_room = rooms.get(message.reply_to_id)
+                if reply_room is None or str(reply_room) != str(message.room_id):
+                    message.reply_to_id = None
+            # Later messages of the batch may reply to this one
+            rooms[message.id] = message.room_id
+
+
+write_behind = MessageWriteBehind()
@@ -0,0 +1,137 @@
+# apps/chat/presence.py
+import asyncio
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Value, When
+from django.utils import timezone
+from apps.accounts.models import User
+
+
+class PresenceRegistry:
+    """
+    In-process presence, refcounted over every live connection of a user.
+    
+    A user comes online with their first socket and goes offline with their
+    last one, so closing one tab no longer hides someone who still has others
+    open. User.is_online / last_seen are written lazily: flush() persists all
+    changes since the previous flush in at most a couple of bulk UPDATEs.
+    
+    The default cache counts the processes each user is connected to, so
+    with several workers a user only goes offline with their last
+    connection in any of them. That takes a shared cache (Redis); with the
+    per-process cache every process decides on its own. Counts of a
+    process that dies unflushed expire after a few flush intervals.
+    
+    Presence does not move the 'users' version stamp: it changes all the
+    time and would invalidate every ETag with it. The is_online/last_seen
+    embedded in conditional responses may lag, clients get presence live
+    over the socket.
+    """
+    
+    prefix = 'presence:'
+    
+    def __init__(self, flush_interval=None):
+        self.flush_interval = flush_interval or getattr(settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 30)
+        self.connections = {}  # user_id -> set of channel names
+        self.last_active = {}  # user_id -> time of the last connect or heartbeat
+        self.went_offline = {}  # user_id -> time of disconnect, not yet persisted
+        self.flusher = None
+    
+    async def connect(self, user_id, channel_name):
+        """Register a connection, return True if the user just came online"""
+        channels = self.connections.setdefault(user_id, set())
+        first_here = not channels
+        channels.add(channel_name)
+        self.last_active[user_id] = timezone.now()
+        self.went_offline.pop(user_id, None)
+        self.start_flusher()
+        if not first_here:
+            return False
+        await cache.aadd(self.prefix + user_id, 0, timeout=self.shared_timeout())
+        processes = await cache.aincr(self.prefix + user_id)
+        # Unless they left again meanwhile
+        return processes == 1 and user_id in self.connections
+    
+    async def disconnect(self, user_id, channel_name):
+        """Drop a connection, return True if it was the user's last one in any process"""
+        channels = self.connections.get(user_id)
+        if not channels:
+            return False
+        channels.discard(channel_name)
+        if channels:
+            return False
+        del self.connections[user_id]
+        left_at = self.last_active.pop(user_id, timezone.now())
+        try:
+            processes = await cache.adecr(self.prefix + user_id)
+        except ValueError:
+            # The count expired
+            processes = 0
+        # Still connected through another process, or here again meanwhile
+        if processes > 0 or user_id in self.connections:
+            return False
+        self.went_offline[user_id] = left_at
+        return True
+    
+    def heartbeat(self, user_id):
+        if user_id in self.connections:
+            self.last_active[user_id] = timezone.now()
+    
+    def is_online(self, user_id):
+        return user_id in self.connections
+    
+    async def online_among(self, user_ids):
+        """Batch lookup: the subset of user_ids with at least one live connection in any process"""
+        online = {user_id for user_id in user_ids if user_id in self.connections}
+        elsewhere = [self.prefix + user_id for user_id in user_ids if user_id not in online]
+        if elsewhere:
+            counts = await cache.aget_many(elsewhere)
+            online.update(key[len(self.prefix):] for key, processes in counts.items() if processes > 0)
+        return online
+    
+    def shared_timeout(self):
+        return self.flush_interval * 3
+    
+    def start_flusher(self):
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.run_flusher())
+    
+    async def run_flusher(self):
+        while self.connections or self.went_offline:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    async def flush(self):
+        """Persist presence in bulk: refresh everyone online, settle everyone who left"""
+        # Taken on the event loop, where connections come and go, so no
+        # disconnect lands between reading and resetting went_offline
+        online = list(self.connections)
+        offline, self.went_offline = self.went_offline, {}
+        await database_sync_to_async(self.write)(online, offline)
+    
+    def write(self, online, offline):
+        now = timezone.now()
+        
+        # Keep this process's share of the counts from expiring
+        for user_id in online:
+            if not cache.touch(self.prefix + user_id, self.shared_timeout()):
+                cache.add(self.prefix + user_id, 1, timeout=self.shared_timeout())
+        
+        # Keeps last_seen fresh so update_user_online_status leaves them alone
+        for start in range(0, len(online), 500):
+            User.objects.filter(id__in=online[start:start + 500]).update(
+                is_online=True,
+                last_seen=now
+            )
+        if offline:
+            User.objects.filter(id__in=list(offline)).update(
+                is_online=False,
+                last_seen=Case(*[
+                    When(id=user_id, then=Value(left_at))
+                    for user_id, left_at in offline.items()
+                ])
+            )
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,184 @@
+# apps/chat/protocol.py
+import json
+import zlib
+from functools import lru_cache
+from urllib.parse import parse_qs
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Short keys used on the wire by the binary protocol; unknown keys pass through
+COMPACT_KEYS = {
+    'type': 't',
+    'action': 'a',
+    'room_id': 'r',
+    'room_ids': 'rs',
+    'message_id': 'm',
+    'user_id': 'u',
+    'username': 'n',
+    'users': 'us',
+    'is_typing': 'ty',
+    'is_online': 'o',
+    'data': 'd',
+    'id': 'i',
+    'sender': 's',
+    'avatar': 'av',
+    'message_type': 'mt',
+    'content': 'c',
+    'reply_to': 'rt',
+    'status': 'st',
+    'created_at': 'ca',
+    'read_at': 'ra',
+    'delivered_up_to': 'du',
+    'read_up_to': 'ru',
+    'client_id': 'ci',
+    'persisted': 'p',
+    'error': 'e',
+    'emoji': 'em',
+    'reason': 'rn',
+    'retry_after': 'ry',
+    'last_message_ids': 'lm',
+    'added': 'ad',
+    'removed': 'rm',
+    'roles': 'ro',
+}
+FULL_KEYS = {short: full for full, short in COMPACT_KEYS.items()}
+
+# Leading byte of a frame sent with the compressed binary protocol
+RAW, DEFLATED = 0, 1
+
+
+class FrameError(ValueError):
+    """An incoming frame that does not decode to an action"""
+
+
+def action_frame(data):
+    if not isinstance(data, dict):
+        raise FrameError('Frame is not an object')
+    return data
+
+
+def encode_frame(payload):
+    """Encode an outgoing WebSocket frame"""
+    return json.dumps(payload)
+
+
+def room_event(handler, payload, **meta):
+    """
+    Build a group_send event carrying a frame that is encoded exactly once.
+    
+    Every recipient forwards event['text'] verbatim; ``meta`` holds the few
+    plain fields handlers need to decide whether to forward at all (such as
+    the sender to skip), so they never decode or re-encode the frame.
+    """
+    event = {'type': handler, 'text': encode_frame(payload)}
+    event.update(meta)
+    return event
+
+
+def rename_keys(value, names):
+    if isinstance(value, dict):
+        return {names.get(key, key): rename_keys(item, names) for key, item in value.items()}
+    if isinstance(value, list):
+        return [rename_keys(item, names) for item in value]
+    return value
+
+
+def pack(text, compress=False):
+    """Convert a JSON frame to its compact MessagePack form"""
+    packed = msgpack.packb(rename_keys(json.loads(text), COMPACT_KEYS))
+    if not compress:
+        return packed
+    if len(packed) >= getattr(settings, 'CHAT_COMPRESS_MIN_BYTES', 256):
+        deflated = zlib.compress(packed)
+        if len(deflated) < len(packed):
+            return bytes([DEFLATED]) + deflated
+    return bytes([RAW]) + packed
+
+
+# Room events reach every binary client of a process as the same JSON text,
+# so each one is only converted once per process
+cached_pack = lru_cache(maxsize=1024)(pack)
+
+
+def unpack(data, compress=False):
+    if compress:
+        flag, data = data[0], data[1:]
+        if flag == DEFLATED:
+            data = zlib.decompress(data)
+    return rename_keys(msgpack.unpackb(data), FULL_KEYS)
+
+
+class JSONCodec:
+    """The default protocol: JSON text frames"""
+    
+    name = 'json'
+    
+    def wire(self, frame):
+        return {'text_data': frame}
+    
+    def decode(self, text_data=None, bytes_data=None):
+        """The frame as a dict, FrameError if it is not a JSON object"""
+        try:
+            return action_frame(json.loads(text_data if text_data is not None else bytes_data))
+        except ValueError as e:
+            raise FrameError(f'Invalid JSON frame: {e}')
+
+
+class MessagePackCodec:
+    """Binary frames: MessagePack with compact keys, optionally zlib-compressed"""
+    
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.name = 'msgpack.deflate' if compress else 'msgpack'
+    
+    def wire(self, frame):
+        return {'bytes_data': cached_pack(frame, self.compress)}
+    
+    def decode(self, text_data=None, bytes_data=None):
+        """The frame as a dict, FrameError if it does not unpack to a map"""
+        # Clients may still send JSON text frames
+        if text_data is not None:
+            return JSONCodec().decode(text_data)
+        try:
+            return action_frame(unpack(bytes_data, self.compress))
+        except (ValueError, IndexError, zlib.error) as e:
+            raise FrameError(f'Invalid binary frame: {e}')
+
+
+# WebSocket subprotocol -> codec name
+SUBPROTOCOLS = {
+    'chat.json': 'json',
+    'chat.msgpack': 'msgpack',
+    'chat.msgpack.deflate': 'msgpack.deflate',
+}
+
+
+def make_codec(name):
+    if name == 'json' or msgpack is None:
+        return JSONCodec()
+    return MessagePackCodec(compress=name == 'msgpack.deflate')
+
+
+def negotiate(scope):
+    """
+    Pick the codec for a connection, return (codec, subprotocol to accept).
+    
+    Clients either offer subprotocols (chat.json, chat.msgpack,
+    chat.msgpack.deflate) in order of preference, or pass
+    ?format=msgpack[&compress=1]. Anything else gets JSON.
+    """
+    for subprotocol in scope.get('subprotocols', []):
+        name = SUBPROTOCOLS.get(subprotocol)
+        if name and (name == 'json' or msgpack is not None):
+            return make_codec(name), subprotocol
+    
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('format', [''])[0] == 'msgpack':
+        compress = query.get('compress', [''])[0] in ('1', 'true')
+        return make_codec('msgpack.deflate' if compress else 'msgpack'), None
+    return JSONCodec(), None
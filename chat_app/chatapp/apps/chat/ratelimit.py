@@ -0,0 +1,66 @@
+# apps/chat/ratelimit.py
+import time
+from django.conf import settings
+from . import metrics
+
+
+class TokenBucketLimiter:
+    """
+    In-memory token buckets keyed by (user, action).
+    
+    Budgets come from CHAT_RATE_LIMITS as action -> (tokens per second,
+    burst); actions without a budget are never limited. The WebSocket
+    consumers and the REST throttle share the same buckets, so a client
+    cannot double its budget by switching transports. State is per process.
+    """
+    
+    PRUNE_EVERY = 1000  # checks between sweeps of idle buckets
+    
+    def __init__(self, limits=None):
+        self.limits = limits if limits is not None else getattr(settings, 'CHAT_RATE_LIMITS', {})
+        self.buckets = {}  # (user_id, action) -> (tokens, updated_at)
+        self.checks = 0
+    
+    def allow(self, user_id, action):
+        """Take a token for this action, return False if the user is over budget"""
+        if action not in self.limits:
+            return True
+        rate, burst = self.limits[action]
+        
+        now = time.monotonic()
+        key = (str(user_id), action)
+        tokens, updated_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        
+        self.checks += 1
+        if self.checks % self.PRUNE_EVERY == 0:
+            self.prune(now)
+        
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            metrics.incr(f'ratelimit.rejected.{action}')
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        metrics.incr(f'ratelimit.allowed.{action}')
+        return True
+    
+    def retry_after(self, user_id, action):
+        """Seconds until the next token for this action is available"""
+        if action not in self.limits:
+            return 0
+        rate, burst = self.limits[action]
+        tokens, updated_at = self.buckets.get((str(user_id), action), (burst, time.monotonic()))
+        tokens += (time.monotonic() - updated_at) * rate
+        return max(0, (1 - tokens) / rate)
+    
+    def prune(self, now):
+        # A bucket that has refilled completely is the same as no bucket
+        for key, (tokens, updated_at) in list(self.buckets.items()):
+            rate, burst = self.limits[key[1]]
+            if tokens + (now - updated_at) * rate >= burst:
+                del self.buckets[key]
+
+
+limiter = TokenBucketLimiter()
+
+metrics.register_gauge('ratelimit.buckets', lambda: len(limiter.buckets))
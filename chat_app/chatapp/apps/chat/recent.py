@@ -0,0 +1,144 @@
+# apps/chat/recent.py
+import time
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+from .models import Message
+
+
+class RecentMessages:
+    """
+    Cache of the newest messages of each room, ready to render or serialize.
+    
+    An entry holds the room's CHAT_RECENT_MESSAGES newest messages (sender
+    and reply loaded) and whether the room has older ones. It is filled on
+    read and patched in place by the write paths. Every write also bumps a
+    per-room version, and an entry is only trusted while its version is
+    current. A reader that filled the cache while a write was in flight, or
+    two writers racing, just invalidate the entry instead of leaving a stale
+    copy behind. Lives in the default cache, which has to be shared (Redis)
+    when HTTP and WebSocket traffic are served by different processes, see
+    apps.chat.checks.
+    """
+    
+    def __init__(self, size=None, ttl=None):
+        self.size = size or getattr(settings, 'CHAT_RECENT_MESSAGES', 50)
+        self.ttl = ttl or getattr(settings, 'CHAT_RECENT_MESSAGES_TTL', 300)
+    
+    def keys(self, room_id):
+        return f'chat:recent:{room_id}', f'chat:recent:{room_id}:version'
+    
+    def queryset(self):
+        return Message.objects.filter(is_deleted=False).select_related('sender', 'reply_to__sender')
+    
+    def lookup(self, room_id):
+        """(entry if current else None, current version) in one cache round trip"""
+        entry_key, version_key = self.keys(room_id)
+        found = cache.get_many([entry_key, version_key])
+        version = found.get(version_key)
+        if version is None:
+            # Unknown start value, so a culled version never revives an old entry
+            cache.add(version_key, time.time_ns(), timeout=None)
+            version = cache.get(version_key)
+        entry = found.get(entry_key)
+        if entry is None or entry['version'] != version:
+            return None, version
+        return entry, version
+    
+    def get(self, room_id):
+        """{'messages', 'has_more'} of the room, newest message first"""
+        entry, version = self.lookup(room_id)
+        if entry is not None:
+            metrics.incr('recent_messages.hits')
+            return entry
+        
+        metrics.incr('recent_messages.misses')
+        messages = list(self.queryset().filter(room_id=room_id).order_by('-created_at', '-id')[:self.size + 1])
+        entry = {
+            'version': version,
+            'messages': messages[:self.size],
+            'has_more': len(messages) > self.size
+        }
+        cache.set(self.keys(room_id)[0], entry, self.ttl)
+        return entry
+    
+    def update(self, room_id, patch):
+        """Apply patch(entry) to a current entry and move it to a new version"""
+        entry, version = self.lookup(room_id)
+        entry_key, version_key = self.keys(room_id)
+        try:
+            new_version = cache.incr(version_key)
+        except ValueError:
+            cache.delete(entry_key)
+            return
+        if entry is None or new_version != version + 1:
+            # Not cached, or another write got in between
+            return
+        if patch(entry) is False:
+            cache.delete(entry_key)
+            return
+        entry['version'] = new_version
+        cache.set(entry_key, entry, self.ttl)
+    
+    def add(self, messages):
+        """New messages were saved"""
+        rooms = {}
+        for message in messages:
+            rooms.setdefault(str(message.room_id), []).append(message.id)
+        
+        for room_id, message_ids in rooms.items():
+            def patch(entry):
+                cached = {message.id for message in entry['messages']}
+                loaded = [message for message in self.queryset().filter(id__in=message_ids) if message.id not in cached]
+                merged = sorted(entry['messages'] + loaded, key=lambda message: (message.created_at, message.id), reverse=True)
+                entry['messages'] = merged[:self.size]
+                entry['has_more'] = entry['has_more'] or len(merged) > self.size
+            self.update(room_id, patch)
+    
+    def refresh(self, room_id, message_ids):
+        """Reload cached messages whose reaction summary changed"""
+        message_ids = {str(message_id) for message_id in message_ids}
+        
+        def patch(entry):
+            stale = [message.id for message in entry['messages'] if str(message.id) in message_ids]
+            if not stale:
+                return
+            loaded = {message.id: message for message in self.queryset().filter(id__in=stale)}
+            entry['messages'] = [loaded.get(message.id, message) for message in entry['messages']]
+        self.update(room_id, patch)
+    
+    def refresh_statuses(self, room_id):
+        """Re-read the status of the cached messages after a read receipt rollup"""
+        def patch(entry):
+            statuses = dict(Message.objects.filter(
+                id__in=[message.id for message in entry['messages']]
+            ).values_list('id', 'status'))
+            for message in entry['messages']:
+                message.status = statuses.get(message.id, message.status)
+        self.update(room_id, patch)
+    
+    def invalidate(self, room_id):
+        """Drop the room's entry, e.g. after messages were moved in from another room"""
+        self.update(room_id, lambda entry: False)
+    
+    def remove(self, room_id, message_id):
+        """A message was soft deleted"""
+        def patch(entry):
+            kept = [message for message in entry['messages'] if str(message.id) != str(message_id)]
+            # Refill rather than serve a short window
+            if len(kept) < len(entry['messages']) and entry['has_more']:
+                return False
+            entry['messages'] = kept
+        self.update(room_id, patch)
+
+
+recent_messages = RecentMessages()
+
+
+def hit_ratio():
+    hits = metrics.counters['recent_messages.hits']
+    total = hits + metrics.counters['recent_messages.misses']
+    return round(hits / total, 3) if total else None
+
+
+metrics.register_gauge('recent_messages.hit_ratio', hit_ratio)
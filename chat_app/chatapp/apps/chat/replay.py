@@ -0,0 +1,95 @@
+# apps/chat/replay.py
+import uuid
+from collections import OrderedDict, deque
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.functional import cached_property
+from . import metrics
+from .layers import is_cross_process
+from .protocol import room_event
+
+
+class RoomEventLog:
+    """
+    Per-room sequence numbers and a ring buffer of the latest room events.
+    
+    Every sequenced event gets the next seq of its room, both inside the
+    frame and as event meta, and the encoded event is kept in a buffer of
+    CHAT_REPLAY_BUFFER_SIZE entries. A reconnecting client presents the
+    epoch and last seq it saw and gets exactly the events it missed, as
+    long as they are still buffered. The epoch changes with every process
+    start, so numbers from before a restart are never trusted.
+    
+    Sequence state is per process. Events carry the epoch of the process
+    that numbered them, so (epoch, seq) identifies an event even when the
+    channel layer spans processes. A process then only buffers part of a
+    room's events, so the buffer is not used: every resume falls back to
+    the messages in the database.
+    
+    Only the CHAT_REPLAY_MAX_ROOMS rooms with the latest events are kept.
+    A room that comes back after being dropped continues from above every
+    seq dropped so far, so an old seq of it can never match a new event:
+    resuming from one finds a gap and falls back to the database.
+    """
+    
+    def __init__(self, size=None, max_rooms=None):
+        self.size = size or getattr(settings, 'CHAT_REPLAY_BUFFER_SIZE', 200)
+        self.max_rooms = max_rooms or getattr(settings, 'CHAT_REPLAY_MAX_ROOMS', 10000)
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seqs = OrderedDict()  # room_id -> last seq handed out, least recently used first
+        self.events = {}           # room_id -> deque of the latest events
+        self.floor = 0             # highest seq of a dropped room
+    
+    def append(self, room_id, handler, payload, **meta):
+        """Number, encode and buffer a room event, return it for group_send"""
+        room_id = str(room_id)
+        seq = self.seqs.get(room_id, self.floor) + 1
+        self.seqs[room_id] = seq
+        self.seqs.move_to_end(room_id)
+        while len(self.seqs) > self.max_rooms:
+            self.drop_oldest()
+        
+        payload['epoch'] = self.epoch
+        payload['seq'] = seq
+        event = room_event(handler, payload, room_id=room_id, epoch=self.epoch, seq=seq, **meta)
+        if self.buffered:
+            if room_id not in self.events:
+                self.events[room_id] = deque(maxlen=self.size)
+            self.events[room_id].append(event)
+        return event
+    
+    def drop_oldest(self):
+        room_id, seq = self.seqs.popitem(last=False)
+        self.events.pop(room_id, None)
+        self.floor = max(self.floor, seq)
+        metrics.incr('replay.rooms_dropped')
+    
+    @cached_property
+    def buffered(self):
+        # Only complete when every event of a room goes through this process
+        return not is_cross_process(get_channel_layer())
+    
+    def last_seq(self, room_id):
+        return self.seqs.get(str(room_id), self.floor)
+    
+    def since(self, room_id, epoch, seq):
+        """Events of the room after seq, or None when they are no longer buffered"""
+        room_id = str(room_id)
+        current = self.last_seq(room_id)
+        if not self.buffered or epoch != self.epoch or seq > current:
+            metrics.incr('replay.miss')
+            return None
+        if seq == current:
+            return []
+        
+        events = self.events.get(room_id)
+        if not events or events[0]['seq'] > seq + 1:
+            metrics.incr('replay.miss')
+            return None
+        metrics.incr('replay.hit')
+        return [event for event in events if event['seq'] > seq]
+
+
+room_log = RoomEventLog()
+
+metrics.register_gauge('replay.rooms', lambda: len(room_log.events))
@@ -0,0 +1,352 @@
+# apps/chat/search.py
+import html
+import json
+import logging
+import re
+import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from . import metrics
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# Highlight markers: private-use characters, turned into <mark> once the text is escaped
+MARK_START, MARK_END = '\ue000', '\ue001'
+TERM = re.compile(r'\w+')
+
+SearchHit = namedtuple('SearchHit', ['message_id', 'score', 'highlight'])
+
+
+def query_terms(query):
+    """The words of a user query, every one of them has to match (as a prefix)"""
+    return TERM.findall(query.lower())[:16]
+
+
+def highlight(text):
+    """HTML-escape a highlighted snippet, keeping only our <mark> tags as markup"""
+    return html.escape(text).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def encode_cursor(position):
+    return urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """The position of an opaque search cursor, ValueError if it is not one"""
+    try:
+        position = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(position, list) or len(position) != 2:
+        raise ValueError('Invalid cursor')
+    return position
+
+
+def hex_id(value):
+    return uuid.UUID(str(value)).hex
+
+
+def searchable(message):
+    return not message.is_deleted and bool(message.content)
+
+
+class MessageSearch:
+    """
+    Fallback for databases without full-text search: a LIKE scan, newest first.
+    
+    Backends keep a search index of the non-deleted messages in step through
+    add/update/remove, and search(room_id, query, limit, cursor) returns
+    (hits, next cursor). Hits come best match first; a lower score is a
+    better match. room_id None searches every room. A cursor the backend
+    did not hand out raises ValueError.
+    """
+    
+    def ensure_schema(self):
+        pass
+    
+    def add(self, messages):
+        pass
+    
+    def update(self, messages):
+        pass
+    
+    def remove(self, message_ids):
+        pass
+    
+    def clear(self):
+        pass
+    
+    def optimize(self):
+        pass
+    
+    def position(self, cursor):
+        """(created_at, message id) of a cursor"""
+        created_at = parse_datetime(cursor[0]) if isinstance(cursor[0], str) else None
+        if created_at is None:
+            raise ValueError('Invalid cursor')
+        return created_at, uuid.UUID(str(cursor[1]))
+    
+    def search(self, room_id, query, limit, cursor=None):
+        position = self.position(cursor) if cursor else None
+        terms = query_terms(query)
+        if not terms:
+            return [], None
+        
+        messages = Message.objects.filter(is_deleted=False)
+        if room_id:
+            messages = messages.filter(room_id=room_id)
+        for term in terms:
+            messages = messages.filter(content__icontains=term)
+        if position:
+            created_at, message_id = position
+            messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+        
+        rows = list(messages.order_by('-created_at', '-id').values_list('id', 'created_at', 'content')[:limit + 1])
+        hits = [SearchHit(message_id, None, html.escape(content)) for message_id, created_at, content in rows[:limit]]
+        if len(rows) <= limit:
+            return hits, None
+        message_id, created_at, content = rows[limit - 1]
+        return hits, [created_at.isoformat(), str(message_id)]
+
+
+class SQLiteMessageSearch(MessageSearch):
+    """
+    FTS5 table message_search(content, message_id, room_id).
+    
+    Ids are stored as hex tokens in indexed columns, so finding a
+    message's row or restricting a search to one room goes through the
+    full-text index as well. Ranked with bm25 over the content only.
+    """
+    
+    def ensure_schema(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5("
+                "content, message_id, room_id, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+    
+    def add(self, messages):
+        rows = [
+            (message.content, hex_id(message.id), hex_id(message.room_id))
+            for message in messages if searchable(message)
+        ]
+        if rows:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    'INSERT INTO message_search (content, message_id, room_id) VALUES (%s, %s, %s)',
+                    rows
+                )
+    
+    def update(self, messages):
+        self.remove([message.id for message in messages])
+        self.add(messages)
+    
+    def remove(self, message_ids):
+        if not message_ids:
+            return
+        ids = ' OR '.join(f'"{hex_id(message_id)}"' for message_id in message_ids)
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM message_search WHERE message_search MATCH %s', [f'message_id:({ids})'])
+    
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM message_search')
+    
+    def optimize(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO message_search (message_search) VALUES ('optimize')")
+    
+    def position(self, cursor):
+        """(score, rowid) of a cursor"""
+        try:
+            return float(cursor[0]), int(cursor[1])
+        except TypeError:
+            raise ValueError('Invalid cursor')
+    
+    def search(self, room_id, query, limit, cursor=None):
+        position = self.position(cursor) if cursor else None
+        terms = query_terms(query)
+        if not terms:
+            return [], None
+        
+        match = 'content:(%s)' % ' '.join(f'"{term}"*' for term in terms)
+        if room_id:
+            match = f'room_id:"{hex_id(room_id)}" AND {match}'
+        after, params = '', []
+        if position:
+            after = 'WHERE score > %s OR (score = %s AND rowid > %s)'
+            params = [position[0], position[0], position[1]]
+        
+        with connection.cursor() as db:
+            db.execute(
+                f"""
+                SELECT message_id, score, rowid, snippet FROM (
+                    SELECT message_id, rowid, bm25(message_search, 1.0, 0.0, 0.0) AS score,
+                           snippet(message_search, 0, %s, %s, '…', 32) AS snippet
+                    FROM message_search WHERE message_search MATCH %s
+                ) {after}
+                ORDER BY score, rowid LIMIT %s
+                """,
+                [MARK_START, MARK_END, match] + params + [limit + 1]
+            )
+            rows = db.fetchall()
+        
+        hits = [SearchHit(uuid.UUID(message_id), score, highlight(snippet)) for message_id, score, rowid, snippet in rows[:limit]]
+        if len(rows) <= limit:
+            return hits, None
+        message_id, score, rowid, snippet = rows[limit - 1]
+        return hits, [score, rowid]
+
+
+class PostgresMessageSearch(MessageSearch):
+    """
+    Side table message_search(message_id, room_id, document tsvector) with a GIN index.
+    
+    Documents use the CHAT_SEARCH_CONFIG text search configuration,
+    queries match every term as a prefix and are ranked with ts_rank.
+    """
+    
+    @property
+    def config(self):
+        return getattr(settings, 'CHAT_SEARCH_CONFIG', 'simple')
+    
+    def ensure_schema(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS message_search ('
+                'message_id uuid PRIMARY KEY REFERENCES messages (id) ON DELETE CASCADE, '
+                'room_id uuid NOT NULL, '
+                'document tsvector NOT NULL)'
+            )
+            cursor.execute('CREATE INDEX IF NOT EXISTS message_search_document ON message_search USING GIN (document)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS message_search_room ON message_search (room_id)')
+    
+    def write(self, messages, on_conflict):
+        rows = [
+            (message.id, message.room_id, self.config, message.content)
+            for message in messages if searchable(message)
+        ]
+        if rows:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    'INSERT INTO message_search (message_id, room_id, document) '
+                    f'VALUES (%s, %s, to_tsvector(%s::regconfig, %s)) ON CONFLICT (message_id) {on_conflict}',
+                    rows
+                )
+    
+    def add(self, messages):
+        self.write(messages, 'DO NOTHING')
+    
+    def update(self, messages):
+        self.remove([message.id for message in messages if not searchable(message)])
+        self.write(messages, 'DO UPDATE SET document = EXCLUDED.document')
+    
+    def remove(self, message_ids):
+        if message_ids:
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM message_search WHERE message_id = ANY(%s)', [list(message_ids)])
+    
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE message_search')
+    
+    def position(self, cursor):
+        """(score, message id) of a cursor"""
+        try:
+            return float(cursor[0]), uuid.UUID(str(cursor[1]))
+        except TypeError:
+            raise ValueError('Invalid cursor')
+    
+    def search(self, room_id, query, limit, cursor=None):
+        position = self.position(cursor) if cursor else None
+        terms = query_terms(query)
+        if not terms:
+            return [], None
+        
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        where, params = ['document @@ q'], []
+        if room_id:
+            where.append('room_id = %s')
+            params.append(room_id)
+        after, after_params = '', []
+        if position:
+            after = 'WHERE hits.score > %s OR (hits.score = %s AND hits.message_id > %s)'
+            after_params = [position[0], position[0], position[1]]
+        
+        with connection.cursor() as db:
+            db.execute(
+                f"""
+                SELECT hits.message_id, hits.score,
+                       ts_headline(%s::regconfig, m.content, to_tsquery(%s::regconfig, %s), %s)
+                FROM (
+                    SELECT message_id, -ts_rank(document, q) AS score
+                    FROM message_search, to_tsquery(%s::regconfig, %s) q
+                    WHERE {' AND '.join(where)}
+                ) hits JOIN messages m ON m.id = hits.message_id
+                {after}
+                ORDER BY hits.score, hits.message_id LIMIT %s
+                """,
+                [self.config, self.config, tsquery, f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=32, MinWords=12',
+                 self.config, tsquery] + params + after_params + [limit + 1]
+            )
+            rows = db.fetchall()
+        
+        hits = [SearchHit(message_id, score, highlight(snippet)) for message_id, score, snippet in rows[:limit]]
+        if len(rows) <= limit:
+            return hits, None
+        message_id, score, snippet = rows[limit - 1]
+        return hits, [score, str(message_id)]
+
+
+class SearchIndex:
+    """
+    Message search, backed by FTS5 on SQLite and tsvector/GIN on PostgreSQL.
+    
+    Index writes never fail the caller: they run in a savepoint and errors
+    are logged and counted, `manage.py rebuild_search_index` catches the
+    index up again.
+    """
+    
+    @cached_property
+    def backend(self):
+        if connection.vendor == 'postgresql':
+            return PostgresMessageSearch()
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA compile_options')
+                if ('ENABLE_FTS5',) in cursor.fetchall():
+                    return SQLiteMessageSearch()
+        return MessageSearch()
+    
+    def ensure_schema(self):
+        self.backend.ensure_schema()
+    
+    def write(self, operation, items):
+        try:
+            with transaction.atomic():
+                getattr(self.backend, operation)(items)
+        except DatabaseError:
+            logger.exception('Search index %s of %d messages failed', operation, len(items))
+            metrics.incr('search.index_failed')
+    
+    def add(self, messages):
+        self.write('add', list(messages))
+    
+    def update(self, messages):
+        self.write('update', list(messages))
+    
+    def remove(self, message_ids):
+        self.write('remove', list(message_ids))
+    
+    def search(self, room_id, query, limit, cursor=None):
+        metrics.incr('search.queries')
+        return self.backend.search(room_id, query, limit, cursor)
+
+
+search_index = SearchIndex()
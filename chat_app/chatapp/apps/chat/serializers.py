@@ -18,7 +18,7 @@ class ChatMemberSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
     reply_to = serializers.SerializerMethodField()
-    reactions = serializers.SerializerMethodField()
+    reactions = serializers.JSONField(source='reaction_summary', read_only=True)
     file_url = serializers.SerializerMethodField()
     
     class Meta:
@@ -37,18 +37,6 @@ class MessageSerializer(serializers.ModelSerializer):
             }
         return None
     
-    def get_reactions(self, obj):
-        reactions = {}
-        for reaction in obj.reactions.all():
-            emoji = reaction.emoji
-            if emoji not in reactions:
-                reactions[emoji] = []
-            reactions[emoji].append({
-                'user_id': str(reaction.user.id),
-                'username': reaction.user.username
-            })
-        return reactions
-    
     def get_file_url(self, obj):
         if obj.file:
             request = self.context.get('request')
@@ -56,6 +44,14 @@ class MessageSerializer(serializers.ModelSerializer):
         return None
 
 
+class MessageReactionSerializer(serializers.ModelSerializer):
+    user = UserSerializer(read_only=True)
+    
+    class Meta:
+        model = MessageReaction
+        fields = ['id', 'user', 'emoji', 'created_at']
+
+
 class ChatRoomSerializer(serializers.ModelSerializer):
     members = ChatMemberSerializer(source='chatmembership_set', many=True, read_only=True)
     last_message = serializers.SerializerMethodField()
@@ -68,17 +64,15 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
     
     def get_last_message(self, obj):
-        last_msg = obj.get_last_message()
-        if last_msg:
-            return MessageSerializer(last_msg, context=self.context).data
+        if obj.last_message:
+            return MessageSerializer(obj.last_message, context=self.context).data
         return None
     
     def get_unread_count(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            membership = obj.chatmembership_set.filter(user=request.user).first()
-            if membership:
-                return obj.messages.filter(
-                    created_at__gt=membership.last_read_at
-                ).exclude(sender=request.user).count()
-        return 0
\ No newline at end of file
+            # Memberships come prefetched with the room list
+            for membership in obj.chatmembership_set.all():
+                if membership.user_id == request.user.id:
+                    return membership.unread_count
+        return 0
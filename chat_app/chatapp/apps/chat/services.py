@@ -0,0 +1,296 @@
+# apps/chat/services.py
+import uuid
+from collections import defaultdict
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from apps.accounts.models import Notification
+from apps.accounts.versions import stamps
+from .changes import record, record_messages
+from .memberships import membership_event, memberships_changed
+from .models import ChatRoom, Message, ChatMembership, MessageReaction
+from .recent import recent_messages
+from .search import search_index
+
+
+def sender_snapshot(user):
+    """The sender fields of an outgoing message, taken once per connection"""
+    return {
+        'id': str(user.id),
+        'username': user.username,
+        'avatar': user.avatar.url if user.avatar else None
+    }
+
+
+def build_message(room_id, sender, message_type='text', content='', reply_to_id=None):
+    """An unsaved message whose id and created_at are already assigned"""
+    try:
+        reply_to_id = uuid.UUID(str(reply_to_id)) if reply_to_id else None
+    except ValueError:
+        reply_to_id = None
+    
+    return Message(
+        room_id=room_id,
+        sender=sender,
+        message_type=message_type,
+        content=content,
+        reply_to_id=reply_to_id
+    )
+
+
+def create_message(room_id, sender, message_type='text', content='', reply_to_id=None):
+    """
+    Write path for a new message: at most two queries.
+    
+    reply_to is only kept if it points at a message of the same room. The
+    row is inserted with bulk_create so no post_save work runs inline;
+    callers follow up with notify_new_messages() off the hot path.
+    """
+    reply_to = None
+    if reply_to_id:
+        try:
+            reply_to = Message.objects.filter(
+                id=reply_to_id,
+                room_id=room_id
+            ).values_list('id', flat=True).first()
+        except ValidationError:
+            pass
+    
+    message = build_message(room_id, sender, message_type, content, reply_to)
+    Message.objects.bulk_create([message])
+    return message
+
+
+def open_direct_room(user, other_user_id):
+    """
+    The direct room between user and other_user_id, created if there is none: (room, created).
+    
+    One lookup on the unique direct_key. Two requests racing to create the
+    same room both attempt the insert, the loser's get_or_create catches
+    the IntegrityError and returns the winner's room instead.
+    
+    The room outlives its members, so opening it again brings back
+    whichever of the two has left it.
+    """
+    user_ids = list(dict.fromkeys([user.id, uuid.UUID(str(other_user_id))]))
+    with transaction.atomic():
+        room, created = ChatRoom.objects.get_or_create(
+            direct_key=ChatRoom.direct_key_for(user.id, other_user_id),
+            defaults={'room_type': 'direct', 'created_by': user}
+        )
+        existing = set() if created else set(
+            ChatMembership.objects.filter(room=room, user_id__in=user_ids).values_list('user_id', flat=True)
+        )
+        added = [user_id for user_id in user_ids if user_id not in existing]
+        # ignore_conflicts: a concurrent reopen of the same room is not an error
+        ChatMembership.objects.bulk_create([
+            ChatMembership(user_id=user_id, room=room, role='admin' if created and user_id == user.id else 'member')
+            for user_id in added
+        ], ignore_conflicts=True)
+        if added:
+            memberships_changed(room.id, added, membership_event(
+                room.id, added=added, roles={str(user.id): 'admin'} if created else None
+            ))
+    return room, created
+
+
+def message_payload(message, sender):
+    """Outgoing representation of a message, built without touching the DB"""
+    return {
+        'id': str(message.id),
+        'sender': sender,
+        'message_type': message.message_type,
+        'content': message.content,
+        'reply_to': str(message.reply_to_id) if message.reply_to_id else None,
+        'status': message.status,
+        'created_at': message.created_at.isoformat()
+    }
+
+
+def messages_created(messages):
+    """Follow-up work for freshly saved messages, done once they were delivered"""
+    recent_messages.add(messages)
+    search_index.add(messages)
+    record_messages(messages)
+    update_room_summaries(messages)
+    notify_new_messages(messages)
+
+
+def unread_count(room_id, user_id, read_up_to):
+    """Expression counting the room's messages from others after read_up_to, values or OuterRefs"""
+    return Coalesce(Subquery(
+        Message.objects.filter(
+            room_id=room_id,
+            created_at__gt=read_up_to
+        ).exclude(
+            sender_id=user_id
+        ).order_by().values('room_id').annotate(count=Count('id')).values('count')
+    ), 0)
+
+
+def update_room_summaries(messages):
+    """
+    Move the rooms' last message forward and count the messages as unread.
+    
+    One UPDATE per room for last_message, which never moves backwards,
+    and one UPDATE for the unread counters of every member of every room
+    involved, whatever the number of messages. Members whose watermark is
+    already past a message, and its sender, don't count it.
+    """
+    newest = {}
+    for message in messages:
+        room_id = str(message.room_id)
+        if room_id not in newest or message.created_at > newest[room_id].created_at:
+            newest[room_id] = message
+    
+    for room_id, message in newest.items():
+        ChatRoom.objects.filter(id=room_id).filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.created_at)
+        ).update(last_message=message.id, last_message_at=message.created_at)
+    
+    ChatMembership.objects.filter(room_id__in=list(newest)).update(
+        unread_count=F('unread_count') + Coalesce(Subquery(
+            Message.objects.filter(
+                id__in=[message.id for message in messages],
+                room_id=OuterRef('room_id'),
+                created_at__gt=OuterRef('last_read_at')
+            ).exclude(
+                sender_id=OuterRef('user_id')
+            ).order_by().values('room_id').annotate(count=Count('id')).values('count')
+        ), 0)
+    )
+
+
+def notify_new_messages(messages):
+    """Create 'message' notifications for every recipient who wants them, in bulk"""
+    recipients = defaultdict(list)
+    for room_id, user_id in ChatMembership.objects.filter(
+        room_id__in={message.room_id for message in messages},
+        user__profile__notify_messages=True
+    ).values_list('room_id', 'user_id'):
+        recipients[room_id].append(user_id)
+    
+    notifications = []
+    for message in messages:
+        # room_id may still be the raw string the message was created with
+        for user_id in recipients[uuid.UUID(str(message.room_id))]:
+            if user_id == message.sender_id:
+                continue
+            notifications.append(Notification(
+                recipient_id=user_id,
+                sender_id=message.sender_id,
+                notification_type='message',
+                message=f'{message.sender.username} sent you a message',
+                link=f'/chat/room/{message.room_id}/'
+            ))
+    Notification.objects.bulk_create(notifications)
+    stamps.bump(*{f'notifications:{notification.recipient_id}' for notification in notifications})
+
+
+def messages_after(room_id, message_id, limit):
+    """
+    Payloads of the room's messages sent after message_id, oldest first.
+    
+    Returns at most `limit` messages, or None if message_id is not a
+    message of the room.
+    """
+    try:
+        anchor = Message.objects.filter(id=message_id, room_id=room_id).values_list('created_at', flat=True).first()
+    except ValidationError:
+        return None
+    if anchor is None:
+        return None
+    
+    messages = Message.objects.filter(
+        room_id=room_id,
+        created_at__gt=anchor,
+        is_deleted=False
+    ).select_related('sender').order_by('created_at')[:limit]
+    return [message_payload(message, sender_snapshot(message.sender)) for message in messages]
+
+
+def reaction_sample_size():
+    return getattr(settings, 'CHAT_REACTION_SAMPLE_SIZE', 3)
+
+
+def summarize_reactions(message_ids):
+    """{message UUID: reaction summary}, rebuilt from the MessageReaction rows"""
+    summaries = {uuid.UUID(str(message_id)): {} for message_id in message_ids}
+    size = reaction_sample_size()
+    for message_id, emoji, user_id in MessageReaction.objects.filter(
+        message_id__in=message_ids
+    ).order_by('created_at').values_list('message_id', 'emoji', 'user_id'):
+        entry = summaries[message_id].setdefault(emoji, {'count': 0, 'user_ids': []})
+        entry['count'] += 1
+        if len(entry['user_ids']) < size:
+            entry['user_ids'].append(str(user_id))
+    return summaries
+
+
+def add_reaction(room_id, message_id, user, emoji):
+    """
+    React to a message and fold the reaction into its reaction_summary.
+    
+    The message row is locked while its summary is updated, so concurrent
+    reactions never overwrite each other. Returns the new summary, or None
+    if the message is not in the room or the reaction already existed.
+    """
+    with transaction.atomic():
+        summary = Message.objects.select_for_update().filter(
+            id=message_id,
+            room_id=room_id
+        ).values_list('reaction_summary', flat=True).first()
+        if summary is None:
+            return None
+        
+        reaction, created = MessageReaction.objects.get_or_create(message_id=message_id, user=user, emoji=emoji)
+        if not created:
+            return None
+        
+        entry = summary.setdefault(emoji, {'count': 0, 'user_ids': []})
+        entry['count'] += 1
+        if len(entry['user_ids']) < reaction_sample_size():
+            entry['user_ids'].append(str(user.id))
+        Message.objects.filter(id=message_id).update(reaction_summary=summary)
+        record([('message', room_id, message_id, None)])
+    return summary
+
+
+def remove_reaction(room_id, message_id, user, emoji):
+    """Undo add_reaction(), returns the new summary or None if there was nothing to remove"""
+    with transaction.atomic():
+        summary = Message.objects.select_for_update().filter(
+            id=message_id,
+            room_id=room_id
+        ).values_list('reaction_summary', flat=True).first()
+        if summary is None:
+            return None
+        
+        deleted, _ = MessageReaction.objects.filter(message_id=message_id, user=user, emoji=emoji).delete()
+        if not deleted:
+            return None
+        
+        entry = summary.get(emoji)
+        if entry is None:
+            # Out of step with the reactions, start over for this message
+            summary = summarize_reactions([message_id])[uuid.UUID(str(message_id))]
+        else:
+            entry['count'] -= 1
+            if str(user.id) in entry['user_ids']:
+                entry['user_ids'].remove(str(user.id))
+                # Backfill the sample with the next oldest reactor
+                missing = min(entry['count'], reaction_sample_size()) - len(entry['user_ids'])
+                if missing > 0:
+                    entry['user_ids'] += [str(user_id) for user_id in MessageReaction.objects.filter(
+                        message_id=message_id,
+                        emoji=emoji
+                    ).exclude(
+                        user_id__in=entry['user_ids']
+                    ).order_by('created_at').values_list('user_id', flat=True)[:missing]]
+            if entry['count'] <= 0:
+                del summary[emoji]
+        Message.objects.filter(id=message_id).update(reaction_summary=summary)
+        record([('message', room_id, message_id, None)])
+    return summary
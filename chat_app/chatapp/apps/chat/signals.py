@@ -1,21 +1,65 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
 from django.dispatch import receiver
-from .models import Message
-from apps.accounts.models import Notification
+from apps.accounts.models import User
+from .cache import membership_cache, user_cache
+from .changes import record, record_messages
+from .models import ChatMembership, ChatRoom, Message
+from .search import search_index
+from .services import messages_created
 
 
 @receiver(post_save, sender=Message)
 def handle_new_message(sender, instance, created, **kwargs):
-    """Create notification for new message"""
+    """
+    Follow up on messages saved outside the services.
+    
+    New messages get the messages_created() work (recent messages cache,
+    search index, change log, room summaries, notifications); edits and
+    soft deletes are reindexed and logged for delta sync.
+    """
+    # Messages written through services.create_message are handled by the caller
     if created:
-        room_members = instance.room.members.exclude(id=instance.sender.id)
-        for member in room_members:
-            # Check if user wants message notifications
-            if hasattr(member, 'profile') and member.profile.notify_messages:
-                Notification.objects.create(
-                    recipient=member,
-                    sender=instance.sender,
-                    notification_type='message',
-                    message=f'{instance.sender.username} sent you a message',
-                    link=f'/chat/room/{instance.room.id}/'
-                )
\ No newline at end of file
+        messages_created([instance])
+    else:
+        # Edited or soft deleted
+        search_index.update([instance])
+        record_messages([instance], 'message_deleted' if instance.is_deleted else 'message')
+
+
+@receiver(pre_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    search_index.remove([instance.id])
+    record_messages([instance], 'message_deleted')
+
+
+@receiver(post_save, sender=ChatRoom)
+def log_room_change(sender, instance, **kwargs):
+    record([('room', instance.id, None, None)])
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def log_room_deletion(sender, instance, **kwargs):
+    """Tell every member the room is gone, their membership entries outlive the room"""
+    record([('room', instance.id, None, None)] + [
+        ('membership', instance.id, None, user_id)
+        for user_id in ChatMembership.objects.filter(room=instance).values_list('user_id', flat=True)
+    ])
+
+
+@receiver(post_migrate)
+def create_search_index(sender, app_config, using, **kwargs):
+    """The search index lives outside the models, create it along with the chat tables"""
+    if app_config.label == 'chat':
+        search_index.ensure_schema()
+
+
+@receiver([post_save, post_delete], sender=ChatMembership)
+def invalidate_membership(sender, instance, **kwargs):
+    """Forget the member's cached room ids when they join or leave a room"""
+    membership_cache.invalidate(str(instance.user_id))
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    """Forget the cached identity of a user whose row changed"""
+    user_cache.invalidate(str(instance.id))
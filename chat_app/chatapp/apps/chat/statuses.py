@@ -0,0 +1,159 @@
+# apps/chat/statuses.py
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Case, Q, Value, When
+from apps.accounts.versions import stamps
+from . import metrics
+from .models import ChatMembership, Message
+from .protocol import room_event
+from .recent import recent_messages
+
+logger = logging.getLogger(__name__)
+
+
+def read_watermarks(room_id):
+    """
+    (read_up_to, laggard) of a room, from its members' last_read_at.
+    
+    A message is read once every member except its sender has read past
+    it. That is the lowest watermark of the room, except for messages of
+    the member who alone holds it: those only need the second lowest.
+    laggard is then {'user_id', 'read_up_to'}, with read_up_to None when
+    they are the only member, otherwise None.
+    """
+    watermarks = sorted(ChatMembership.objects.filter(room_id=room_id).values_list('last_read_at', 'user_id'))
+    if not watermarks:
+        return None, None
+    lowest, user_id = watermarks[0]
+    if len(watermarks) > 1 and watermarks[1][0] == lowest:
+        return lowest, None
+    second = watermarks[1][0] if len(watermarks) > 1 else None
+    return lowest, {'user_id': str(user_id), 'read_up_to': second}
+
+
+def apply_statuses(room_id, delivered_up_to=None, read=False):
+    """
+    Move a room's messages forward to 'delivered' and 'read' in one UPDATE.
+    
+    Messages created at or before delivered_up_to that are still 'sent'
+    become 'delivered'. With read, every message all other members have
+    read becomes 'read'. Statuses never move backwards. Returns the
+    message_status frame announcing the watermarks, or None if no message
+    changed.
+    """
+    changed = Q()
+    status = Value('delivered')
+    if delivered_up_to:
+        changed |= Q(created_at__lte=delivered_up_to, status='sent')
+    
+    read_up_to = laggard = None
+    if read:
+        read_up_to, laggard = read_watermarks(room_id)
+    if read_up_to:
+        is_read = Q(created_at__lte=read_up_to)
+        if laggard:
+            is_read &= ~Q(sender_id=laggard['user_id'])
+            if laggard['read_up_to']:
+                is_read |= Q(sender_id=laggard['user_id'], created_at__lte=laggard['read_up_to'])
+        changed |= is_read
+        status = Case(When(is_read, then=Value('read')), default=Value('delivered'))
+    
+    if not changed:
+        return None
+    # Only messages not read yet can change: a range of the (room, status,
+    # created_at) index, however long the room's history
+    updated = Message.objects.filter(
+        room_id=room_id,
+        status__in=['sent', 'delivered']
+    ).filter(changed).update(status=status)
+    if not updated:
+        return None
+    metrics.incr('statuses.updated', updated)
+    recent_messages.refresh_statuses(room_id)
+    stamps.bump(f'room:{room_id}')
+    
+    payload = {'type': 'message_status', 'room_id': str(room_id)}
+    if delivered_up_to:
+        payload['delivered_up_to'] = delivered_up_to.isoformat()
+    if read_up_to:
+        payload['read_up_to'] = read_up_to.isoformat()
+        if laggard:
+            payload['laggard'] = {
+                'user_id': laggard['user_id'],
+                'read_up_to': laggard['read_up_to'].isoformat() if laggard['read_up_to'] else None
+            }
+    return payload
+
+
+def status_event(room_id, payload):
+    return room_event('message_status_update', payload, room_id=str(room_id))
+
+
+class StatusPipeline:
+    """
+    Delivery and read status of messages, applied per room rather than per message.
+    
+    Connections report that a message from someone else was handed to them
+    (delivered up to its created_at) or that a member's read watermark
+    moved. Every CHAT_STATUS_FLUSH_INTERVAL_MS the pending rooms get one
+    UPDATE each and one message_status frame with the new watermarks, so
+    status traffic grows with the number of active rooms, not messages.
+    State is per process; the updates are idempotent, so several workers
+    flushing the same room is harmless. With batched persistence a message
+    still waiting for its insert picks up its status at the next flush.
+    """
+    
+    def __init__(self, interval_ms=None):
+        self.interval = (interval_ms or getattr(settings, 'CHAT_STATUS_FLUSH_INTERVAL_MS', 250)) / 1000
+        self.pending = {}  # room_id -> {'delivered_up_to': datetime or None, 'read': bool}
+        self.timer = None
+        self.lock = asyncio.Lock()
+    
+    def room(self, room_id):
+        if self.timer is None:
+            self.timer = asyncio.ensure_future(self.flush_later())
+        return self.pending.setdefault(str(room_id), {'delivered_up_to': None, 'read': False})
+    
+    def delivered(self, room_id, created_at):
+        room = self.room(room_id)
+        if room['delivered_up_to'] is None or created_at > room['delivered_up_to']:
+            room['delivered_up_to'] = created_at
+    
+    def read(self, room_id):
+        self.room(room_id)['read'] = True
+    
+    async def flush_later(self):
+        await asyncio.sleep(self.interval)
+        self.timer = None
+        await self.flush()
+    
+    async def flush(self):
+        async with self.lock:
+            batch, self.pending = self.pending, {}
+            if not batch:
+                return
+            
+            try:
+                payloads = await database_sync_to_async(self.write)(batch)
+            except Exception:
+                logger.exception('Applying message statuses of %d rooms failed', len(batch))
+                return
+            
+            channel_layer = get_channel_layer()
+            for room_id, payload in payloads:
+                await channel_layer.group_send(f'chat_{room_id}', status_event(room_id, payload))
+    
+    def write(self, batch):
+        metrics.incr('statuses.flushed_rooms', len(batch))
+        payloads = []
+        for room_id, changes in batch.items():
+            payload = apply_statuses(room_id, **changes)
+            if payload:
+                payloads.append((room_id, payload))
+        return payloads
+
+
+status_pipeline = StatusPipeline()
@@ -1,7 +1,10 @@
 from celery import shared_task
 from django.core.mail import send_mail
 from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from .changes import prune
 from .models import Message, ChatRoom, ChatMembership
+from .statuses import apply_statuses, status_event
 from apps.accounts.models import User
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
@@ -70,29 +73,28 @@ def process_file_upload(message_id):
 
 
 @shared_task
-def update_message_status(message_id, status):
-    """Update message delivery/read status"""
-    try:
-        message = Message.objects.get(id=message_id)
-        message.status = status
-        message.save(update_fields=['status'])
-        
-        # Broadcast status update via WebSocket
-        channel_layer = get_channel_layer()
-        room_group_name = f'chat_{message.room.id}'
-        
-        async_to_sync(channel_layer.group_send)(
-            room_group_name,
-            {
-                'type': 'message_status_update',
-                'message_id': str(message_id),
-                'status': status
-            }
+def update_message_statuses(updates):
+    """
+    Apply message status transitions in bulk, one UPDATE per room.
+    
+    updates maps room ids to {'delivered_up_to': ISO datetime or None,
+    'read': bool}, the same shape the realtime StatusPipeline flushes.
+    """
+    channel_layer = get_channel_layer()
+    
+    changed = 0
+    for room_id, changes in updates.items():
+        delivered_up_to = changes.get('delivered_up_to')
+        payload = apply_statuses(
+            room_id,
+            delivered_up_to=parse_datetime(delivered_up_to) if delivered_up_to else None,
+            read=changes.get('read', False)
         )
-        
-        return f"Message {message_id} status updated to {status}"
-    except Message.DoesNotExist:
-        return f"Message {message_id} not found"
+        if payload:
+            changed += 1
+            async_to_sync(channel_layer.group_send)(f'chat_{room_id}', status_event(room_id, payload))
+    
+    return f"Message statuses updated in {changed} rooms"
 
 
 @shared_task
@@ -111,6 +113,12 @@ def clean_old_messages():
     return f"Cleaned up {deleted_count} old deleted messages"
 
 
+@shared_task
+def prune_change_log():
+    """Drop delta sync change log entries past CHAT_SYNC_RETENTION_DAYS"""
+    return f"Pruned {prune()} change log entries"
+
+
 @shared_task
 def send_daily_summary():
     """Send daily summary of unread messages to users"""
@@ -121,16 +129,10 @@ def send_daily_summary():
     for user in users:
         unread_count = defaultdict(int)
         
-        memberships = ChatMembership.objects.filter(user=user)
+        memberships = ChatMembership.objects.filter(user=user, unread_count__gt=0).select_related('room')
         
         for membership in memberships:
-            count = Message.objects.filter(
-                room=membership.room,
-                created_at__gt=membership.last_read_at
-            ).exclude(sender=user).count()
-            
-            if count > 0:
-                unread_count[membership.room.name or "Direct Message"] = count
+            unread_count[membership.room.name or "Direct Message"] += membership.unread_count
         
         if unread_count:
             message_text = "You have unread messages:\n\n"
@@ -150,7 +152,7 @@ def send_daily_summary():
 
 @shared_task
 def update_user_online_status():
-    """Update user online status based on last activity"""
+    """Mark users offline whose presence stopped being refreshed (e.g. a crashed worker)"""
     from django.utils import timezone
     from datetime import timedelta
     
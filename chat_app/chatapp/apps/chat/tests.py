@@ -1,3 +1,1215 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core import signals
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.db import close_old_connections, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from apps.accounts.models import User, Notification
+from apps.accounts.tokens import RefreshToken
+from apps.accounts.versions import stamps
+from .cache import member_room_ids
+from .changes import changes_since, decode_token, encode_token, record, record_messages
+from .checks import check_shared_cache
+from .consumers import ChatConsumer, StreamConsumer
+from .export import export_chunk, export_room
+from .middleware import JWTAuthMiddleware
+from .memberships import add_members, create_room, parse_user_ids, remove_members, set_role
+from .models import ChangeLogEntry, ChatRoom, ChatMembership, Message
+from .outbound import OutboundQueue
+from .persistence import MessageWriteBehind
+from .presence import PresenceRegistry
+from .protocol import DEFLATED, RAW, FrameError, MessagePackCodec, msgpack, pack, unpack
+from .ratelimit import TokenBucketLimiter
+from .recent import RecentMessages
+from .replay import RoomEventLog, room_log
+from .search import MessageSearch, PostgresMessageSearch, decode_cursor, encode_cursor, search_index
+from .services import (
+    add_reaction, build_message, create_message, message_payload, messages_created, notify_new_messages,
+    open_direct_room, remove_reaction, sender_snapshot, summarize_reactions
+)
+from .statuses import apply_statuses
+from .typing_indicators import TypingAggregator
 
-# Create your tests here.
+
+class ChatTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(email='alice@example.com', username='alice', password='pass1234')
+        self.bob = User.objects.create_user(email='bob@example.com', username='bob', password='pass1234')
+        self.room = ChatRoom.objects.create(room_type='group', name='Test', created_by=self.alice)
+        ChatMembership.objects.create(user=self.alice, room=self.room, role='admin')
+        ChatMembership.objects.create(user=self.bob, room=self.room)
+
+
+class CreateMessageTests(ChatTestCase):
+    def test_send_costs_one_query_without_reply(self):
+        with self.assertNumQueries(1):
+            message = create_message(str(self.room.id), self.alice, content='hi')
+            payload = message_payload(message, sender_snapshot(self.alice))
+        
+        self.assertEqual(payload['sender']['username'], 'alice')
+        self.assertIsNone(payload['reply_to'])
+        self.assertTrue(Message.objects.filter(id=message.id).exists())
+    
+    def test_send_with_reply_costs_two_queries(self):
+        original = create_message(self.room.id, self.bob, content='first')
+        
+        with self.assertNumQueries(2):
+            message = create_message(str(self.room.id), self.alice, content='re', reply_to_id=str(original.id))
+            payload = message_payload(message, sender_snapshot(self.alice))
+        
+        self.assertEqual(payload['reply_to'], str(original.id))
+    
+    def test_reply_to_other_room_is_dropped(self):
+        other_room = ChatRoom.objects.create(room_type='group', created_by=self.bob)
+        foreign = create_message(other_room.id, self.bob, content='elsewhere')
+        
+        message = create_message(self.room.id, self.alice, content='re', reply_to_id=str(foreign.id))
+        
+        self.assertIsNone(message.reply_to_id)
+    
+    def test_notifications_skip_the_sender(self):
+        message = create_message(str(self.room.id), self.alice, content='hi')
+        notify_new_messages([message])
+        
+        self.assertEqual(Notification.objects.filter(recipient=self.bob).count(), 1)
+        self.assertFalse(Notification.objects.filter(recipient=self.alice).exists())
+
+
+class RecentMessagesTests(ChatTestCase):
+    def test_entry_holds_the_newest_messages_and_whether_there_are_older_ones(self):
+        recent = RecentMessages(size=2)
+        first, second = [create_message(self.room.id, self.alice, content=str(number)) for number in range(2)]
+        
+        self.assertFalse(recent.get(self.room.id)['has_more'])
+        
+        third = create_message(self.room.id, self.bob, content='2')
+        recent.add([third])
+        with self.assertNumQueries(0):
+            entry = recent.get(self.room.id)
+        
+        self.assertEqual([message.id for message in entry['messages']], [third.id, second.id])
+        self.assertTrue(entry['has_more'])
+    
+    def test_deleting_a_cached_message_drops_a_short_window(self):
+        recent = RecentMessages(size=2)
+        messages = [create_message(self.room.id, self.alice, content=str(number)) for number in range(3)]
+        recent.get(self.room.id)
+        
+        recent.remove(self.room.id, messages[2].id)
+        
+        self.assertIsNone(recent.lookup(self.room.id)[0])
+
+
+class APITestCase(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+    
+    def post_messages(self, count, sender=None):
+        """count messages a minute apart, oldest first"""
+        start = timezone.now() - timedelta(hours=1)
+        messages = []
+        for number in range(count):
+            message = build_message(self.room.id, sender or self.alice, content=f'message {number}')
+            message.created_at = start + timedelta(minutes=number)
+            messages.append(message)
+        return Message.objects.bulk_create(messages)
+
+
+class KeysetPaginationTests(APITestCase):
+    url = '/api/v1/chat/messages/'
+    
+    def test_next_links_walk_the_whole_history_newest_first(self):
+        messages = self.post_messages(7)
+        
+        seen, url, params = [], self.url, {'room_id': str(self.room.id), 'page_size': 3}
+        while url:
+            response = self.client.get(url, params)
+            self.assertNotIn('count', response.data)
+            seen += [item['id'] for item in response.data['results']]
+            url, params = response.data['next'], None
+        
+        self.assertEqual(seen, [str(message.id) for message in reversed(messages)])
+    
+    def test_previous_link_returns_the_newer_page(self):
+        self.post_messages(6)
+        first = self.client.get(self.url, {'room_id': str(self.room.id), 'page_size': 3})
+        second = self.client.get(first.data['next'])
+        
+        back = self.client.get(second.data['previous'])
+        
+        self.assertEqual([item['id'] for item in back.data['results']], [item['id'] for item in first.data['results']])
+        self.assertIsNone(back.data['previous'])
+    
+    def test_around_centres_the_page_on_a_message(self):
+        messages = self.post_messages(9)
+        
+        response = self.client.get(self.url, {'room_id': str(self.room.id), 'page_size': 4, 'around': str(messages[4].id)})
+        
+        self.assertEqual(
+            [item['id'] for item in response.data['results']],
+            [str(message.id) for message in reversed(messages[3:7])]
+        )
+        self.assertIsNotNone(response.data['next'])
+        self.assertIsNotNone(response.data['previous'])
+    
+    def test_invalid_cursor_is_not_found(self):
+        response = self.client.get(self.url, {'room_id': str(self.room.id), 'cursor': 'nope'})
+        
+        self.assertEqual(response.status_code, 404)
+
+
+class ConditionalGetTests(APITestCase):
+    def test_unchanged_room_list_is_not_modified(self):
+        response = self.client.get('/api/v1/chat/rooms/')
+        etag = response['ETag']
+        
+        again = self.client.get('/api/v1/chat/rooms/', HTTP_IF_NONE_MATCH=etag)
+        
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], etag)
+        self.assertIn('private', again['Cache-Control'])
+    
+    def test_new_message_changes_the_etag(self):
+        params = {'room_id': str(self.room.id)}
+        etag = self.client.get('/api/v1/chat/messages/', params)['ETag']
+        self.assertEqual(self.client.get('/api/v1/chat/messages/', params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            messages_created([create_message(self.room.id, self.bob, content='new')])
+        response = self.client.get('/api/v1/chat/messages/', params, HTTP_IF_NONE_MATCH=etag)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['results'][0]['content'], 'new')
+    
+    def test_errors_carry_no_etag(self):
+        response = self.client.get('/api/v1/chat/messages/', {'room_id': str(uuid.uuid4())})
+        
+        self.assertFalse(response.has_header('ETag'))
+
+
+class ExportTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.messages = self.post_messages(5, sender=self.bob)
+        Message.objects.filter(id=self.messages[1].id).update(is_deleted=True)
+        add_reaction(self.room.id, self.messages[0].id, self.alice, '👍')
+    
+    def export_lines(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+    
+    def test_export_streams_the_room_then_its_messages_oldest_first(self):
+        # Room, members, then messages and their reactions
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/v1/chat/rooms/{self.room.id}/export/')
+            lines = self.export_lines(response)
+        
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        self.assertIn('attachment', response['Content-Disposition'])
+        room, *messages = lines
+        self.assertEqual((room['type'], len(room['members'])), ('room', 2))
+        self.assertEqual([message['content'] for message in messages], ['message 0', 'message 2', 'message 3', 'message 4'])
+        self.assertEqual(messages[0]['reactions'][0]['emoji'], '👍')
+        self.assertEqual(messages[0]['sender']['username'], 'bob')
+    
+    def test_gzip_export(self):
+        response = self.client.get(f'/api/v1/chat/rooms/{self.room.id}/export/', {'compress': 'gzip'})
+        
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+    
+    def test_only_members_can_export(self):
+        outsider = User.objects.create_user(email='eve@example.com', username='eve', password='pass1234')
+        self.client.force_authenticate(outsider)
+        
+        self.assertEqual(self.client.get(f'/api/v1/chat/rooms/{self.room.id}/export/').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/chat/rooms/nope/export/').status_code, 404)
+    
+    def test_export_in_chunks_matches_a_single_chunk(self):
+        self.assertEqual(
+            [line for chunk in export_room(self.room, 2) for line in chunk.splitlines()][1:],
+            [line for chunk in export_room(self.room, 100) for line in chunk.splitlines()][1:]
+        )
+    
+    def test_command_writes_a_gzipped_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'room.ndjson.gz')
+            call_command('export_room', str(self.room.id), output=path, gzip=True, chunk_size=2, stdout=StringIO())
+            with gzip.open(path, 'rt') as exported:
+                self.assertEqual(len(exported.read().splitlines()), 5)
+        
+        with self.assertRaises(CommandError):
+            call_command('export_room', str(uuid.uuid4()), stdout=StringIO())
+    
+    @override_settings(CHAT_EXPORT_CHUNK_SIZE=1)
+    async def test_asgi_export_sends_the_first_chunk_before_reading_the_rest(self):
+        # As the test client does, or the end of the request would close the test's connection
+        for signal in (signals.request_started, signals.request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': f'/api/v1/chat/rooms/{self.room.id}/export/',
+            'query_string': b'', 'headers': [
+                (b'host', b'testserver'),
+                (b'authorization', f'Bearer {AccessToken.for_user(self.alice)}'.encode()),
+            ],
+        }
+        requests = iter([{'type': 'http.request', 'body': b''}])
+        
+        async def receive():
+            return next(requests, None) or await asyncio.Future()
+        
+        chunks_read, body = [], []
+        
+        async def send(message):
+            if message['type'] == 'http.response.body' and message.get('body'):
+                chunks_read.append(read.call_count)
+                body.append(message['body'])
+        
+        with mock.patch('apps.chat.export.export_chunk', wraps=export_chunk) as read:
+            await ASGIHandler()(scope, receive, send)
+        
+        self.assertEqual(chunks_read, [0, 1, 2, 3, 4])
+        self.assertEqual(len(b''.join(body).splitlines()), 5)
+
+
+class SearchTests(APITestCase):
+    url = '/api/v1/chat/messages/search/'
+    
+    def search(self, q, **params):
+        response = self.client.get(self.url, {'room_id': str(self.room.id), 'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+    
+    def found(self, q):
+        return [result['content'] for result in self.search(q)['results']]
+    
+    def test_index_follows_create_edit_and_delete(self):
+        message = Message.objects.create(room=self.room, sender=self.bob, content='meet at the harbour')
+        kept = Message.objects.create(room=self.room, sender=self.bob, content='harbour lights')
+        self.assertEqual(set(self.found('harbour')), {'meet at the harbour', 'harbour lights'})
+        
+        message.content = 'meet at the station'
+        message.save()
+        self.assertEqual(self.found('harbour'), ['harbour lights'])
+        self.assertEqual(self.found('stat'), ['meet at the station'])
+        
+        message.is_deleted = True
+        message.save()
+        kept.delete()
+        self.assertEqual(self.found('station') + self.found('harbour'), [])
+    
+    def test_best_match_first_highlighted_and_only_in_the_room(self):
+        Message.objects.create(room=self.room, sender=self.bob, content='lunch somewhere with a view of the old town and <b>lunch</b>')
+        Message.objects.create(room=self.room, sender=self.bob, content='lunch lunch')
+        other = ChatRoom.objects.create(room_type='group', name='Other', created_by=self.bob)
+        ChatMembership.objects.create(user=self.bob, room=other)
+        Message.objects.create(room=other, sender=self.bob, content='lunch')
+        
+        results = self.search('lunch')['results']
+        
+        self.assertEqual(results[0]['content'], 'lunch lunch')
+        self.assertEqual(len(results), 2)
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+        self.assertIn('<mark>lunch</mark>', results[0]['highlight'])
+        self.assertIn('&lt;b&gt;', results[1]['highlight'])
+        response = self.client.get(self.url, {'room_id': str(other.id), 'q': 'lunch'})
+        self.assertEqual(response.status_code, 403)
+    
+    def test_cursor_pages_through_every_hit_once(self):
+        for number in range(5):
+            Message.objects.create(room=self.room, sender=self.bob, content=f'update {number}')
+        
+        contents, page = [], self.search('update', page_size=2)
+        while True:
+            contents += [result['content'] for result in page['results']]
+            if not page['next']:
+                break
+            page = self.client.get(page['next']).json()
+        
+        self.assertEqual(sorted(contents), [f'update {number}' for number in range(5)])
+    
+    def test_fallback_scan_pages_newest_first(self):
+        messages = self.post_messages(3)
+        backend = MessageSearch()
+        
+        hits, cursor = backend.search(self.room.id, 'message', 2)
+        more, end = backend.search(self.room.id, 'message', 2, decode_cursor(encode_cursor(cursor)))
+        
+        self.assertEqual([hit.message_id for hit in hits + more], [message.id for message in reversed(messages)])
+        self.assertIsNone(end)
+    
+    def test_malformed_cursors_are_a_bad_request(self):
+        for cursor in ['garbage', encode_cursor(['x', 'y']), encode_cursor([[1], 2]), encode_cursor({'a': 1})]:
+            response = self.client.get(self.url, {'room_id': str(self.room.id), 'q': 'x', 'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+        with self.assertRaises(ValueError):
+            MessageSearch().search(self.room.id, 'x', 2, ['yesterday', 'nope'])
+    
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL search only runs against PostgreSQL')
+    def test_postgresql_uses_the_tsvector_index(self):
+        self.assertIsInstance(search_index.backend, PostgresMessageSearch)
+
+
+class JWTAuthMiddlewareTests(ChatTestCase):
+    async def connect_as(self, token):
+        scopes = []
+        
+        async def app(scope, receive, send):
+            scopes.append(scope)
+        
+        await JWTAuthMiddleware(app)({'type': 'websocket', 'query_string': f'token={token}'.encode()}, None, None)
+        return scopes[0]['user']
+    
+    async def test_claims_supply_the_identity(self):
+        token = RefreshToken.for_user(self.alice).access_token
+        await database_sync_to_async(User.objects.filter(id=self.alice.id).update)(username='renamed')
+        
+        with override_settings(CHAT_JWT_TRUST_CLAIMS=True):
+            user = await self.connect_as(token)
+        
+        self.assertEqual((user.id, user.username), (self.alice.id, 'alice'))
+    
+    async def test_deactivated_users_are_refused_with_or_without_claims(self):
+        token = RefreshToken.for_user(self.alice).access_token
+        self.alice.is_active = False
+        await database_sync_to_async(self.alice.save)()
+        
+        for trust_claims in [True, False]:
+            with override_settings(CHAT_JWT_TRUST_CLAIMS=trust_claims):
+                self.assertFalse((await self.connect_as(token)).is_authenticated)
+
+
+class ReactionSummaryTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.carol = User.objects.create_user(email='carol@example.com', username='carol', password='pass1234')
+        self.message = Message.objects.create(room=self.room, sender=self.bob, content='hi')
+    
+    def react(self, change, user, emoji='👍'):
+        return change(self.room.id, self.message.id, user, emoji)
+    
+    def stored(self):
+        return Message.objects.values_list('reaction_summary', flat=True).get(id=self.message.id)
+    
+    def test_add_and_remove_keep_counts_and_a_sample_of_users(self):
+        self.react(add_reaction, self.alice)
+        self.react(add_reaction, self.bob)
+        self.react(add_reaction, self.alice, '❤️')
+        self.assertEqual(self.stored(), {
+            '👍': {'count': 2, 'user_ids': [str(self.alice.id), str(self.bob.id)]},
+            '❤️': {'count': 1, 'user_ids': [str(self.alice.id)]},
+        })
+        
+        self.assertEqual(self.react(remove_reaction, self.bob), {
+            '👍': {'count': 1, 'user_ids': [str(self.alice.id)]},
+            '❤️': {'count': 1, 'user_ids': [str(self.alice.id)]},
+        })
+    
+    def test_duplicates_and_missing_reactions_change_nothing(self):
+        self.react(add_reaction, self.alice)
+        
+        self.assertIsNone(self.react(add_reaction, self.alice))
+        self.assertIsNone(self.react(remove_reaction, self.bob))
+        self.assertIsNone(add_reaction(uuid.uuid4(), self.message.id, self.bob, '👍'))
+        self.assertEqual(self.stored(), {'👍': {'count': 1, 'user_ids': [str(self.alice.id)]}})
+    
+    def test_removing_the_last_reaction_drops_the_emoji(self):
+        self.react(add_reaction, self.alice)
+        
+        self.assertEqual(self.react(remove_reaction, self.alice), {})
+        self.assertEqual(self.stored(), {})
+    
+    @override_settings(CHAT_REACTION_SAMPLE_SIZE=1)
+    def test_removing_a_sampled_user_backfills_the_next_oldest(self):
+        for user in [self.alice, self.bob, self.carol]:
+            self.react(add_reaction, user)
+        
+        self.assertEqual(self.react(remove_reaction, self.alice), {'👍': {'count': 2, 'user_ids': [str(self.bob.id)]}})
+    
+    def test_counts_agree_with_a_rebuild(self):
+        for change, user, emoji in [
+            (add_reaction, self.alice, '👍'), (add_reaction, self.bob, '👍'), (add_reaction, self.carol, '🎉'),
+            (remove_reaction, self.alice, '👍'), (add_reaction, self.alice, '👍'), (remove_reaction, self.carol, '🎉'),
+        ]:
+            self.react(change, user, emoji)
+        
+        self.assertEqual(self.stored(), summarize_reactions([self.message.id])[self.message.id])
+        output = StringIO()
+        call_command('rebuild_reaction_summaries', stdout=output)
+        self.assertIn('Rebuilt 0', output.getvalue())
+        
+        Message.objects.filter(id=self.message.id).update(reaction_summary={'👍': {'count': 9, 'user_ids': []}})
+        call_command('rebuild_reaction_summaries', stdout=output)
+        self.assertEqual(self.stored(), {'👍': {'count': 2, 'user_ids': [str(self.bob.id), str(self.alice.id)]}})
+
+
+class UnreadCountTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader = ChatConsumer()
+        self.reader.user = self.bob
+    
+    def send(self, count, sender):
+        return [Message.objects.create(room=self.room, sender=sender, content=f'unread {number}') for number in range(count)]
+    
+    def read(self, message):
+        return async_to_sync(self.reader.mark_as_read)(str(self.room.id), str(message.id))
+    
+    def unread(self):
+        return dict(ChatMembership.objects.filter(room=self.room).values_list('user__username', 'unread_count'))
+    
+    def test_new_messages_count_for_everyone_but_the_sender(self):
+        self.send(3, self.alice)
+        self.send(1, self.bob)
+        
+        self.assertEqual(self.unread(), {'alice': 1, 'bob': 3})
+    
+    def test_reading_recounts_what_is_left(self):
+        messages = self.send(3, self.alice)
+        
+        self.assertEqual(self.read(messages[0]), messages[0].created_at)
+        self.assertEqual(self.unread()['bob'], 2)
+        self.assertIsNotNone(self.read(messages[2]))
+        self.assertEqual(self.unread()['bob'], 0)
+    
+    def test_reading_backwards_or_twice_changes_nothing(self):
+        messages = self.send(3, self.alice)
+        self.read(messages[2])
+        
+        self.assertIsNone(self.read(messages[0]))
+        self.assertIsNone(self.read(messages[2]))
+        self.assertIsNone(async_to_sync(self.reader.mark_as_read)(str(self.room.id), 'nope'))
+        self.assertEqual(self.unread()['bob'], 0)
+        self.send(1, self.alice)
+        self.assertEqual(self.unread()['bob'], 1)
+    
+    def test_counters_match_a_recount(self):
+        messages = self.send(4, self.alice)
+        self.read(messages[1])
+        self.send(2, self.bob)
+        self.send(1, self.alice)
+        counted = self.unread()
+        
+        call_command('rebuild_room_summaries', stdout=StringIO())
+        
+        self.assertEqual(self.unread(), counted)
+        self.assertEqual(counted, {'alice': 2, 'bob': 3})
+
+
+class DirectRoomTests(ChatTestCase):
+    def test_open_twice_returns_the_same_room(self):
+        room, created = open_direct_room(self.alice, self.bob.id)
+        again, created_again = open_direct_room(self.bob, str(self.alice.id))
+        
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(room.id, again.id)
+        self.assertEqual(ChatMembership.objects.get(room=room, user=self.alice).role, 'admin')
+        self.assertEqual(ChatMembership.objects.filter(room=room).count(), 2)
+    
+    def test_reopen_brings_back_a_member_who_left(self):
+        room, created = open_direct_room(self.alice, self.bob.id)
+        ChatMembership.objects.filter(room=room, user=self.alice).delete()
+        
+        again, created = open_direct_room(self.alice, self.bob.id)
+        
+        self.assertFalse(created)
+        self.assertEqual(again.id, room.id)
+        self.assertEqual(set(ChatMembership.objects.filter(room=room).values_list('user_id', flat=True)), {self.alice.id, self.bob.id})
+        self.assertEqual(ChangeLogEntry.objects.filter(room_id=room.id, kind='membership', user_id=self.alice.id).count(), 2)
+    
+    def test_reopen_of_an_abandoned_room_restores_both_members(self):
+        room, created = open_direct_room(self.alice, self.bob.id)
+        ChatMembership.objects.filter(room=room).delete()
+        
+        again, created = open_direct_room(self.bob, self.alice.id)
+        
+        self.assertEqual(again.id, room.id)
+        self.assertEqual(ChatMembership.objects.filter(room=room).count(), 2)
+
+
+class RemovedMemberTests(ChatTestCase):
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # session
+        return communicator
+    
+    async def receive_until(self, communicator, frame_type):
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame['type'] == frame_type:
+                return frame
+    
+    def remove_bob(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            remove_members(self.room, [self.bob.id])
+    
+    async def test_removed_member_is_told_and_disconnected(self):
+        communicator = await self.connect(self.bob)
+        
+        await database_sync_to_async(self.remove_bob)()
+        
+        frame = await self.receive_until(communicator, 'members')
+        self.assertEqual(frame['removed'], [str(self.bob.id)])
+        self.assertEqual((await communicator.receive_output())['code'], 4003)
+    
+    async def test_former_member_cannot_post(self):
+        communicator = await self.connect(self.bob)
+        await database_sync_to_async(ChatMembership.objects.filter(room=self.room, user=self.bob).delete)()
+        
+        await communicator.send_json_to({'action': 'send_message', 'content': 'after removal', 'client_id': 'c1'})
+        
+        frame = await self.receive_until(communicator, 'error')
+        self.assertEqual((frame['error'], frame['client_id']), ('not a member of room', 'c1'))
+        self.assertFalse(await database_sync_to_async(Message.objects.filter(content='after removal').exists)())
+        await communicator.disconnect()
+
+
+class StreamConsumerTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = ChatRoom.objects.create(room_type='group', name='Other', created_by=self.alice)
+        self.private = ChatRoom.objects.create(room_type='group', name='Private', created_by=self.bob)
+        ChatMembership.objects.bulk_create([
+            ChatMembership(user=self.alice, room=self.other),
+            ChatMembership(user=self.bob, room=self.other),
+            ChatMembership(user=self.bob, room=self.private),
+        ])
+    
+    async def connect(self, user, query=''):
+        communicator = WebsocketCommunicator(StreamConsumer.as_asgi(), f'/ws/stream/{query}')
+        communicator.scope['user'] = user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, await self.receive(communicator, 'session')
+    
+    async def receive(self, communicator, frame_type):
+        while (frame := await communicator.receive_json_from())['type'] != frame_type:
+            pass
+        return frame
+    
+    async def send_message(self, communicator, room, content):
+        await communicator.send_json_to({'action': 'send_message', 'room_id': str(room.id), 'content': content})
+        return await self.receive(communicator, 'ack')
+    
+    async def test_subscribes_to_every_room_or_the_requested_ones(self):
+        communicator, session = await self.connect(self.alice)
+        self.assertEqual(set(session['seq']), {str(self.room.id), str(self.other.id)})
+        
+        communicator, session = await self.connect(self.alice, f'?rooms={self.other.id},{self.private.id}')
+        self.assertEqual(list(session['seq']), [str(self.other.id)])
+        
+        await communicator.send_json_to({'action': 'subscribe', 'room_ids': [str(self.room.id), str(self.private.id)]})
+        self.assertEqual((await self.receive(communicator, 'subscribed'))['room_ids'], [str(self.room.id)])
+    
+    async def test_rooms_of_others_are_refused(self):
+        communicator, session = await self.connect(self.alice)
+        
+        await communicator.send_json_to({'action': 'subscribe', 'room_ids': [str(self.private.id)]})
+        self.assertEqual((await self.receive(communicator, 'subscribed'))['room_ids'], [])
+        await communicator.send_json_to({'action': 'send_message', 'room_id': str(self.private.id), 'content': 'hi'})
+        frame = await self.receive(communicator, 'error')
+        self.assertEqual((frame['error'], frame['room_id']), ('not subscribed to room', str(self.private.id)))
+    
+    async def test_broadcasts_are_tagged_with_their_room(self):
+        alice, session = await self.connect(self.alice)
+        bob, session = await self.connect(self.bob)
+        
+        await self.send_message(bob, self.other, 'in other')
+        await self.send_message(bob, self.room, 'in room')
+        
+        first, second = [await self.receive(alice, 'message') for _ in range(2)]
+        self.assertEqual(
+            [(first['room_id'], first['data']['content']), (second['room_id'], second['data']['content'])],
+            [(str(self.other.id), 'in other'), (str(self.room.id), 'in room')]
+        )
+    
+    async def test_unsubscribed_rooms_are_no_longer_delivered(self):
+        alice, session = await self.connect(self.alice)
+        bob, session = await self.connect(self.bob)
+        
+        await alice.send_json_to({'action': 'unsubscribe', 'room_ids': [str(self.other.id), str(self.private.id)]})
+        self.assertEqual((await self.receive(alice, 'unsubscribed'))['room_ids'], [str(self.other.id)])
+        await self.send_message(bob, self.other, 'in other')
+        await self.send_message(bob, self.room, 'in room')
+        
+        self.assertEqual((await self.receive(alice, 'message'))['data']['content'], 'in room')
+        await alice.send_json_to({'action': 'typing', 'room_id': str(self.other.id), 'is_typing': True})
+        self.assertEqual((await self.receive(alice, 'error'))['error'], 'not subscribed to room')
+
+
+class BulkMembershipTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = User.objects.bulk_create([
+            User(email=f'user{number}@example.com', username=f'user{number}') for number in range(20)
+        ])
+        self.user_ids = [user.id for user in self.users]
+    
+    def member_ids(self):
+        return set(ChatMembership.objects.filter(room=self.room).values_list('user_id', flat=True))
+    
+    def test_create_room_inserts_every_membership_at_once(self):
+        with self.assertNumQueries(6):
+            room = create_room(self.alice, 'group', 'Big', self.user_ids + [self.alice.id])
+        
+        self.assertEqual(ChatMembership.objects.filter(room=room).count(), 21)
+        self.assertEqual(ChatMembership.objects.get(room=room, user=self.alice).role, 'admin')
+    
+    def test_add_members_skips_existing_members(self):
+        added = add_members(self.room, [self.bob.id] + self.user_ids[:5])
+        
+        self.assertEqual(added, self.user_ids[:5])
+        self.assertEqual(len(self.member_ids()), 7)
+        self.assertEqual(ChangeLogEntry.objects.filter(room_id=self.room.id, kind='membership').count(), 5)
+    
+    def test_remove_members_deletes_in_one_statement_and_forgets_cached_rooms(self):
+        add_members(self.room, self.user_ids)
+        self.assertIn(str(self.room.id), member_room_ids(self.user_ids[0]))
+        
+        # Member ids, the rows delete() collects, DELETE and change log INSERT, in a savepoint
+        with self.assertNumQueries(6):
+            removed = remove_members(self.room, self.user_ids + [uuid.uuid4()])
+        
+        self.assertEqual(set(removed), set(self.user_ids))
+        self.assertEqual(self.member_ids(), {self.alice.id, self.bob.id})
+        self.assertNotIn(str(self.room.id), member_room_ids(self.user_ids[0]))
+    
+    def test_set_role_only_reports_changes(self):
+        self.assertEqual(set_role(self.room, [self.alice.id, self.bob.id], 'admin'), [self.bob.id])
+        self.assertEqual(set_role(self.room, [self.bob.id], 'admin'), [])
+    
+    def test_parse_user_ids(self):
+        user_id = uuid.uuid4()
+        
+        self.assertEqual(parse_user_ids([str(user_id), user_id.hex]), [user_id])
+        with self.assertRaisesMessage(ValueError, 'Invalid user id nope'):
+            parse_user_ids(['nope'])
+        with self.assertRaises(ValueError):
+            parse_user_ids(str(user_id))
+
+
+class MessageStatusTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        start = timezone.now() - timedelta(minutes=10)
+        ChatMembership.objects.filter(room=self.room).update(last_read_at=start)
+        self.messages = []
+        for minute, sender in enumerate([self.alice, self.alice, self.bob, self.alice], start=1):
+            message = build_message(self.room.id, sender, content=str(minute))
+            message.created_at = start + timedelta(minutes=minute)
+            self.messages.append(message)
+        Message.objects.bulk_create(self.messages)
+    
+    def statuses(self):
+        return [Message.objects.get(id=message.id).status for message in self.messages]
+    
+    def read_up_to(self, user, message):
+        ChatMembership.objects.filter(room=self.room, user=user).update(last_read_at=message.created_at)
+    
+    def test_delivered_up_to_a_message(self):
+        payload = apply_statuses(self.room.id, delivered_up_to=self.messages[1].created_at)
+        
+        self.assertEqual(self.statuses(), ['delivered', 'delivered', 'sent', 'sent'])
+        self.assertEqual(payload['delivered_up_to'], self.messages[1].created_at.isoformat())
+        self.assertIsNone(apply_statuses(self.room.id, delivered_up_to=self.messages[1].created_at))
+    
+    def test_read_needs_every_other_member(self):
+        self.read_up_to(self.bob, self.messages[3])
+        
+        payload = apply_statuses(self.room.id, read=True)
+        
+        # Alice, the laggard, has read nothing: only her own messages count as read
+        self.assertEqual(self.statuses(), ['read', 'read', 'sent', 'read'])
+        self.assertEqual(payload['laggard']['user_id'], str(self.alice.id))
+    
+    def test_statuses_never_move_backwards(self):
+        self.read_up_to(self.bob, self.messages[1])
+        self.read_up_to(self.alice, self.messages[2])
+        apply_statuses(self.room.id, read=True)
+        
+        apply_statuses(self.room.id, delivered_up_to=self.messages[3].created_at)
+        
+        self.assertEqual(self.statuses(), ['read', 'read', 'read', 'delivered'])
+    
+    def test_update_skips_messages_already_read(self):
+        self.read_up_to(self.bob, self.messages[3])
+        self.read_up_to(self.alice, self.messages[3])
+        apply_statuses(self.room.id, read=True)
+        
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNone(apply_statuses(self.room.id, read=True))
+        
+        self.assertIn("IN ('sent', 'delivered')", queries[-1]['sql'])
+
+
+class WriteBehindTests(ChatTestCase):
+    def batch(self, count):
+        return [build_message(self.room.id, self.alice, content=f'queued {number}') for number in range(count)]
+    
+    def inserts(self, queries):
+        return [query for query in queries if query['sql'].startswith('INSERT INTO "messages"')]
+    
+    def test_a_batch_is_written_with_one_insert(self):
+        messages = self.batch(3)
+        
+        with CaptureQueriesContext(connection) as queries:
+            failures = MessageWriteBehind().write(messages)
+        
+        self.assertEqual(failures, {})
+        self.assertEqual(len(self.inserts(queries)), 1)
+        self.assertEqual(Message.objects.filter(content__startswith='queued').count(), 3)
+    
+    def test_a_failed_batch_is_retried_row_by_row(self):
+        existing = Message.objects.create(room=self.room, sender=self.bob, content='existing')
+        messages = self.batch(3)
+        messages[1].id = existing.id
+        
+        with CaptureQueriesContext(connection) as queries, self.assertLogs('apps.chat.persistence', 'ERROR'):
+            failures = MessageWriteBehind().write(messages)
+        
+        self.assertEqual(list(failures), [existing.id])
+        self.assertEqual(len(self.inserts(queries)), 4)
+        self.assertEqual(set(Message.objects.filter(content__startswith='queued').values_list('content', flat=True)), {'queued 0', 'queued 2'})
+    
+    async def test_futures_resolve_once_the_batch_is_committed(self):
+        queue = MessageWriteBehind(max_messages=2, max_delay_ms=10)
+        messages = self.batch(3)
+        
+        saved = await asyncio.gather(*[queue.submit(message) for message in messages])
+        
+        self.assertEqual(saved, messages)
+        self.assertEqual(await database_sync_to_async(Message.objects.filter(content__startswith='queued').count)(), 3)
+    
+    async def test_follow_up_errors_do_not_fail_committed_messages(self):
+        queue = MessageWriteBehind(max_messages=2)
+        messages = self.batch(2)
+        
+        with mock.patch('apps.chat.persistence.messages_created', side_effect=RuntimeError('broker down')):
+            with self.assertLogs('apps.chat.persistence', 'ERROR') as logs:
+                saved = await asyncio.gather(*[queue.submit(message) for message in messages])
+        
+        self.assertEqual(saved, messages)
+        self.assertIn('Follow-up work for 2 messages failed', logs.output[0])
+    
+    async def test_write_errors_fail_every_future_of_the_batch(self):
+        queue = MessageWriteBehind(max_messages=2)
+        
+        with mock.patch.object(queue, 'drop_invalid_replies', side_effect=RuntimeError('no database')), self.assertLogs('apps.chat.persistence', 'ERROR'):
+            results = await asyncio.gather(*[queue.submit(message) for message in self.batch(2)], return_exceptions=True)
+        
+        self.assertEqual([str(result) for result in results], ['no database'] * 2)
+
+
+class OutboundRecorder:
+    def __init__(self):
+        self.frames = []
+    
+    def put(self, kind, frame, **kwargs):
+        self.frames.append((frame, kwargs['seq']))
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch('apps.chat.ratelimit.time.monotonic', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.limiter = TokenBucketLimiter({'typing': (2, 3)})
+    
+    def take(self, count):
+        return [self.limiter.allow('user', 'typing') for _ in range(count)]
+    
+    def test_burst_then_reject_until_refilled(self):
+        self.assertEqual(self.take(4), [True, True, True, False])
+        self.assertEqual(self.limiter.retry_after('user', 'typing'), 0.5)
+        
+        self.now += 0.5
+        self.assertEqual(self.take(2), [True, False])
+    
+    def test_refill_is_capped_at_the_burst(self):
+        self.take(3)
+        self.now += 60
+        
+        self.assertEqual(self.take(4), [True, True, True, False])
+        self.assertTrue(self.limiter.allow('other user', 'typing'))
+        self.assertEqual([self.limiter.allow('user', 'send_message') for _ in range(10)], [True] * 10)
+    
+    def test_refilled_buckets_are_pruned(self):
+        self.take(1)
+        self.now += 0.5
+        self.limiter.prune(self.now)
+        
+        self.assertEqual(self.limiter.buckets, {})
+    
+    async def test_dispatch_answers_with_a_rejection_frame(self):
+        consumer = ChatConsumer()
+        consumer.user_id = 'user'
+        replies = []
+        consumer.reply = replies.append
+        self.take(3)
+        
+        with mock.patch('apps.chat.consumers.limiter', self.limiter):
+            await consumer.dispatch_action('room', {'action': 'typing', 'client_id': 'c1', 'is_typing': True})
+        
+        self.assertEqual(replies, [{
+            'type': 'error', 'error': 'rate_limited', 'action': 'typing', 'client_id': 'c1', 'retry_after': 0.5
+        }])
+
+
+class MessagePackProtocolTests(ChatTestCase):
+    def test_frames_round_trip_with_the_compression_flag(self):
+        small = {'type': 'pong'}
+        large = {'type': 'message', 'data': {'content': 'hello ' * 100, 'client_id': 'c1'}}
+        
+        for payload, compress, flag in [(small, False, None), (small, True, RAW), (large, True, DEFLATED)]:
+            packed = pack(json.dumps(payload), compress)
+            if flag is not None:
+                self.assertEqual(packed[0], flag)
+            self.assertEqual(unpack(packed, compress), payload)
+            self.assertEqual(MessagePackCodec(compress).decode(bytes_data=packed), payload)
+        self.assertLess(len(pack(json.dumps(large), True)), len(pack(json.dumps(large))))
+    
+    def test_malformed_frames_raise_frame_errors(self):
+        deflate = MessagePackCodec(compress=True)
+        for codec, frame in [
+            (deflate, {'bytes_data': b''}),
+            (deflate, {'bytes_data': bytes([DEFLATED]) + b'not zlib'}),
+            (deflate, {'bytes_data': bytes([RAW]) + b'\xc1'}),
+            (MessagePackCodec(), {'bytes_data': msgpack.packb([1, 2])}),
+            (MessagePackCodec(), {'text_data': '{"action": '}),
+        ]:
+            with self.assertRaises(FrameError):
+                codec.decode(**frame)
+    
+    async def test_consumer_answers_a_malformed_frame_and_keeps_going(self):
+        communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/', subprotocols=['chat.msgpack.deflate']
+        )
+        communicator.scope['user'] = self.alice
+        communicator.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(subprotocol, 'chat.msgpack.deflate')
+        
+        async def receive(frame_type):
+            while (frame := unpack(await communicator.receive_from(), compress=True))['type'] != frame_type:
+                pass
+            return frame
+        
+        await communicator.send_to(bytes_data=bytes([DEFLATED]) + b'garbage')
+        self.assertEqual((await receive('error'))['error'], 'malformed frame')
+        
+        await communicator.send_to(bytes_data=pack(json.dumps({'action': 'ping'}), compress=True))
+        self.assertEqual(await receive('pong'), {'type': 'pong'})
+        await communicator.disconnect()
+
+
+class TypingAggregatorTests(TestCase):
+    def setUp(self):
+        self.frames = []
+        
+        async def group_send(group, event):
+            self.frames.append([user['username'] for user in json.loads(event['text'])['users']])
+        
+        layer = mock.patch('apps.chat.typing_indicators.get_channel_layer', lambda: mock.Mock(group_send=group_send))
+        layer.start()
+        self.addCleanup(layer.stop)
+        self.typing = TypingAggregator(window=0.02, ttl=1)
+    
+    async def settle(self, seconds=0.05):
+        await asyncio.sleep(seconds)
+    
+    async def test_changes_inside_a_window_make_one_frame(self):
+        self.typing.update('room', 'a', 'a.tab', 'alice', True)
+        self.typing.update('room', 'b', 'b.tab', 'bob', True)
+        self.typing.update('room', 'b', 'b.tab', 'bob', False)
+        self.typing.update('room', 'c', 'c.tab', 'carol', True)
+        self.typing.update('room', 'c', 'c.tab', 'carol', False)
+        await self.settle()
+        
+        self.assertEqual(self.frames, [['alice']])
+        self.typing.update('room', 'a', 'a.tab', 'alice', True)
+        await self.settle()
+        self.assertEqual(self.frames, [['alice']])
+    
+    async def test_typing_expires_without_a_refresh(self):
+        self.typing.ttl = 0.1
+        self.typing.update('room', 'a', 'a.tab', 'alice', True)
+        await self.settle()
+        self.assertEqual(self.frames, [['alice']])
+        
+        await self.settle(0.15)
+        self.assertEqual(self.frames, [['alice'], []])
+        self.assertEqual((self.typing.typing, self.typing.flushes), ({}, {}))
+    
+    async def test_user_stays_listed_while_typing_in_another_tab(self):
+        self.typing.update('room', 'a', 'a.first', 'alice', True)
+        self.typing.update('room', 'a', 'a.second', 'alice', True)
+        await self.settle()
+        
+        self.typing.update('room', 'a', 'a.first', 'alice', False)
+        await self.settle()
+        self.assertEqual(self.frames, [['alice']])
+        
+        self.typing.update('room', 'a', 'a.second', 'alice', False)
+        await self.settle()
+        self.assertEqual(self.frames, [['alice'], []])
+
+
+class RoomEventLogTests(TestCase):
+    def setUp(self):
+        self.log = RoomEventLog(size=3, max_rooms=2)
+    
+    def append(self, room_id, count):
+        return [self.log.append(room_id, 'chat_message', {'type': 'message'})['seq'] for _ in range(count)]
+    
+    def seqs(self, events):
+        return None if events is None else [event['seq'] for event in events]
+    
+    def test_resume_replays_what_is_still_buffered(self):
+        self.append('room', 5)
+        
+        self.assertEqual(self.seqs(self.log.since('room', self.log.epoch, 3)), [4, 5])
+        self.assertEqual(self.seqs(self.log.since('room', self.log.epoch, 5)), [])
+    
+    def test_gaps_and_unknown_positions_are_misses(self):
+        self.append('room', 5)
+        
+        self.assertIsNone(self.log.since('room', self.log.epoch, 1))
+        self.assertIsNone(self.log.since('room', self.log.epoch, 6))
+        self.assertIsNone(self.log.since('room', 'otherepoch', 4))
+    
+    def test_least_recently_used_rooms_are_dropped(self):
+        self.append('a', 3)
+        self.append('b', 1)
+        self.append('c', 1)
+        
+        self.assertEqual(list(self.log.seqs), ['b', 'c'])
+        self.assertEqual(list(self.log.events), ['b', 'c'])
+        self.assertIsNone(self.log.since('a', self.log.epoch, 2))
+    
+    def test_a_dropped_room_never_reuses_a_seq(self):
+        self.append('a', 3)
+        self.append('b', 1)
+        self.append('c', 1)
+        
+        self.assertEqual(self.log.last_seq('a'), 3)
+        self.assertEqual(self.append('a', 1), [4])
+        self.assertEqual(self.seqs(self.log.since('a', self.log.epoch, 3)), [4])
+        self.assertIsNone(self.log.since('a', self.log.epoch, 1))
+
+
+class MultiProcessTests(TestCase):
+    def test_resume_only_skips_events_numbered_by_this_process(self):
+        consumer = ChatConsumer()
+        consumer.outbound = OutboundRecorder()
+        consumer.replayed = {'room': (room_log.epoch, 5)}
+        
+        for epoch, seq in [(room_log.epoch, 5), ('otherprocess', 2), (room_log.epoch, 6)]:
+            consumer.deliver({'type': 'read_receipt', 'text': f'{epoch}:{seq}', 'room_id': 'room', 'epoch': epoch, 'seq': seq})
+        
+        self.assertEqual(consumer.outbound.frames, [
+            ('otherprocess:2', None),
+            (f'{room_log.epoch}:6', ('room', 6)),
+        ])
+    
+    async def test_user_stays_online_while_connected_to_another_process(self):
+        first, second = PresenceRegistry(), PresenceRegistry()
+        user_id = str(uuid.uuid4())
+        
+        self.assertTrue(await first.connect(user_id, 'first.channel'))
+        self.assertFalse(await second.connect(user_id, 'second.channel'))
+        
+        self.assertFalse(await first.disconnect(user_id, 'first.channel'))
+        self.assertEqual(first.went_offline, {})
+        self.assertEqual(await first.online_among([user_id]), {user_id})
+        
+        self.assertTrue(await second.disconnect(user_id, 'second.channel'))
+        self.assertIn(user_id, second.went_offline)
+        self.assertEqual(await first.online_among([user_id]), set())
+        first.flusher.cancel()
+        second.flusher.cancel()
+    
+    def test_a_cross_process_layer_needs_a_shared_cache(self):
+        unix_socket = {'default': {'BACKEND': 'apps.chat.layers.UnixSocketChannelLayer'}}
+        in_memory = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        local = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp/chatapp-cache'}}
+        
+        for layers, caches, errors in [(unix_socket, local, ['chat.E001']), (unix_socket, shared, []), (in_memory, local, [])]:
+            with override_settings(CHANNEL_LAYERS=layers, CACHES=caches):
+                self.assertEqual([error.id for error in check_shared_cache(None)], errors)
+
+
+class OutboundQueueTests(TestCase):
+    async def make_queue(self):
+        self.sent, self.closed, self.unblock = [], [], asyncio.Event()
+        
+        async def send(frame):
+            # A socket that takes nothing until unblocked
+            await self.unblock.wait()
+            self.sent.append(frame)
+        
+        async def close():
+            self.closed.append(True)
+        
+        queue = OutboundQueue(send, close, soft_limit=3, high_water=6)
+        self.addCleanup(queue.stop)
+        queue.put('control', 'in flight')
+        await asyncio.sleep(0)
+        return queue
+    
+    async def test_reactions_are_only_coalesced_when_behind(self):
+        queue = await self.make_queue()
+        
+        queue.put('reaction', 'first', key=('room', 'message'))
+        queue.put('reaction', 'second', key=('room', 'message'))
+        self.assertEqual([entry[1] for entry in queue.frames], ['first', 'second'])
+        
+        queue.put('message', 'message')
+        queue.put('reaction', 'third', key=('room', 'message'))
+        queue.put('typing', 'typing')
+        
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(json.loads(queue.frames[1][1])['type'], 'reaction_refresh')
+    
+    async def test_overflow_sends_a_resume_hint_and_closes(self):
+        queue = await self.make_queue()
+        for number in range(7):
+            queue.put('message', f'message {number}', delivered=('room', number))
+        
+        self.unblock.set()
+        await queue.writer
+        
+        self.assertEqual(self.sent[0], 'in flight')
+        self.assertEqual(json.loads(self.sent[1])['reason'], 'slow_consumer')
+        self.assertEqual(self.closed, [True])
+
+
+class PresenceFlushTests(TestCase):
+    async def test_flush_settles_who_left_and_keeps_later_disconnects(self):
+        registry = PresenceRegistry()
+        alice, bob = await database_sync_to_async(lambda: (
+            User.objects.create_user(email='a@example.com', username='a', password='x'),
+            User.objects.create_user(email='b@example.com', username='b', password='x')
+        ))()
+        await registry.connect(str(alice.id), 'alice.channel')
+        await registry.connect(str(bob.id), 'bob.channel')
+        await registry.disconnect(str(alice.id), 'alice.channel')
+        
+        write = registry.write
+        
+        def write_while_bob_leaves(online, offline):
+            # A disconnect handled by the loop while the UPDATEs run
+            registry.went_offline[str(bob.id)] = timezone.now()
+            write(online, offline)
+        
+        registry.write = write_while_bob_leaves
+        await registry.flush()
+        registry.flusher.cancel()
+        
+        statuses = await database_sync_to_async(lambda: dict(User.objects.filter(
+            id__in=[alice.id, bob.id]
+        ).values_list('username', 'is_online')))()
+        self.assertEqual(statuses, {'a': False, 'b': True})
+        self.assertEqual(list(registry.went_offline), [str(bob.id)])
+    
+    async def test_flush_leaves_the_users_version_alone(self):
+        registry = PresenceRegistry()
+        alice = await database_sync_to_async(
+            User.objects.create_user
+        )(email='a@example.com', username='a', password='x')
+        before = await database_sync_to_async(stamps.get)('users')
+        await registry.connect(str(alice.id), 'alice.channel')
+        await registry.disconnect(str(alice.id), 'alice.channel')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            await registry.flush()
+        registry.flusher.cancel()
+        
+        self.assertEqual(await database_sync_to_async(stamps.get)('users'), before)
+
+
+class SyncTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        ChangeLogEntry.objects.all().delete()
+    
+    def log(self, count, age):
+        record([('room', self.room.id, None, None)] * count)
+        ChangeLogEntry.objects.update(created_at=timezone.now() - age)
+    
+    def test_tokens_round_trip_and_reject_garbage(self):
+        token = encode_token(42, timezone.now())
+        
+        self.assertEqual(decode_token(token), 42)
+        self.assertIsNone(decode_token(encode_token(42, timezone.now() - timedelta(days=365))))
+        for garbage in ['nope', encode_token(-1, timezone.now())]:
+            with self.assertRaises(ValueError):
+                decode_token(garbage)
+    
+    def test_pages_through_settled_entries(self):
+        self.log(5, timedelta(minutes=1))
+        
+        entries, token, has_more = changes_since(self.bob.id, 0, 3)
+        self.assertEqual((len(entries), has_more), (3, True))
+        entries, token, has_more = changes_since(self.bob.id, decode_token(token), 3)
+        self.assertEqual((len(entries), has_more), (2, False))
+        entries, token, has_more = changes_since(self.bob.id, decode_token(token), 3)
+        self.assertEqual(entries, [])
+    
+    def test_unsettled_entries_are_returned_again_without_has_more(self):
+        self.log(5, timedelta(0))
+        
+        entries, token, has_more = changes_since(self.bob.id, 0, 3)
+        
+        self.assertEqual(len(entries), 3)
+        self.assertFalse(has_more)
+        self.assertEqual(decode_token(token), 0)
+    
+    def test_only_rooms_of_the_user_are_visible(self):
+        other_room = ChatRoom.objects.create(room_type='group', created_by=self.alice)
+        record([('room', other_room.id, None, None), ('membership', other_room.id, None, self.bob.id)])
+        
+        entries, token, has_more = changes_since(self.bob.id, 0, 10)
+        
+        self.assertEqual([entry.kind for entry in entries if entry.room_id == other_room.id], ['membership'])
+    
+    def test_sync_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        
+        response = client.get('/api/v1/chat/sync/')
+        self.assertTrue(response.data['reset'])
+        self.assertEqual(client.get('/api/v1/chat/sync/', {'since': 'nope'}).status_code, 400)
+        
+        message = create_message(self.room.id, self.alice, content='hi')
+        record_messages([message])
+        ChangeLogEntry.objects.update(created_at=timezone.now() - timedelta(minutes=1))
+        response = client.get('/api/v1/chat/sync/', {'since': response.data['token']})
+        
+        self.assertEqual([item['content'] for item in response.data['messages']], ['hi'])
+        self.assertFalse(response.data['has_more'])
@@ -0,0 +1,95 @@
+# apps/chat/typing_indicators.py
+import asyncio
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .protocol import room_event
+from .replay import room_log
+
+
+class TypingAggregator:
+    """
+    Coalesce typing state changes into at most one frame per room per window.
+    
+    Each frame lists everyone currently typing in the room. Start/stop toggles
+    that cancel out inside a window never reach the channel layer, and typing
+    state expires on its own after CHAT_TYPING_TTL seconds without a refresh.
+    State is kept per connection, so a user typing in another tab stays
+    listed when one of their tabs stops or disconnects.
+    State is per process: frames carry the epoch of the process that sent
+    them and list the typists connected to it, so with a channel layer
+    spanning processes clients keep one list per epoch.
+    """
+    
+    def __init__(self, window=None, ttl=None):
+        self.window = window if window is not None else getattr(settings, 'CHAT_TYPING_WINDOW', 0.25)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'CHAT_TYPING_TTL', 5)
+        self.typing = {}     # room_id -> {(user_id, channel_name): (username, expires_at)}
+        self.announced = {}  # room_id -> user ids listed in the last frame sent
+        self.flushes = {}    # room_id -> (pending flush task, when it runs)
+    
+    def update(self, room_id, user_id, channel_name, username, is_typing):
+        room = self.typing.setdefault(room_id, {})
+        if is_typing:
+            room[user_id, channel_name] = (username, time.monotonic() + self.ttl)
+        else:
+            room.pop((user_id, channel_name), None)
+        
+        # A refresh of an already announced typist only extends its expiry
+        if frozenset(typists(room)) != self.announced.get(room_id, frozenset()):
+            self.schedule(room_id, self.window)
+    
+    def schedule(self, room_id, delay):
+        # One pending flush per room absorbs every change made before it runs,
+        # a change within the window moves a later expiry wake-up forward
+        due = time.monotonic() + delay
+        if room_id in self.flushes:
+            task, pending_due = self.flushes[room_id]
+            if pending_due <= due:
+                return
+            task.cancel()
+        self.flushes[room_id] = (asyncio.ensure_future(self.flush_later(room_id, delay)), due)
+    
+    async def flush_later(self, room_id, delay):
+        await asyncio.sleep(max(delay, 0))
+        del self.flushes[room_id]
+        await self.flush(room_id)
+    
+    async def flush(self, room_id):
+        now = time.monotonic()
+        room = self.typing.get(room_id, {})
+        for key, (username, expires_at) in list(room.items()):
+            if expires_at <= now:
+                del room[key]
+        
+        users = typists(room)
+        if frozenset(users) != self.announced.get(room_id, frozenset()):
+            self.announced[room_id] = frozenset(users)
+            await get_channel_layer().group_send(
+                f'chat_{room_id}',
+                room_event('typing_indicator', {
+                    'type': 'typing',
+                    'room_id': str(room_id),
+                    'epoch': room_log.epoch,
+                    'users': [
+                        {'user_id': user_id, 'username': username}
+                        for user_id, username in users.items()
+                    ]
+                })
+            )
+        
+        if room:
+            # Wake up again when the oldest typist is due to expire
+            next_expiry = min(expires_at for username, expires_at in room.values())
+            self.schedule(room_id, next_expiry - now)
+        else:
+            self.typing.pop(room_id, None)
+            self.announced.pop(room_id, None)
+
+
+def typists(room):
+    """{user_id: username} of everyone typing in at least one connection"""
+    return {user_id: username for (user_id, channel_name), (username, expires_at) in room.items()}
+
+
+typing_aggregator = TypingAggregator()
@@ -1,16 +1,20 @@
 # apps/chat/views.py
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q, Max
+from django.db.models import F, Q
+from django.http import Http404
 from .models import ChatRoom, Message, ChatMembership
+from .recent import recent_messages
+from .memberships import create_room, parse_user_ids, unknown_users
+from .services import open_direct_room
 from apps.accounts.models import User
 
 
 @login_required
 def chat_list(request):
-    rooms = ChatRoom.objects.filter(members=request.user).annotate(
-        last_message_time=Max('messages__created_at')
-    ).order_by('-last_message_time')
+    rooms = ChatRoom.objects.filter(members=request.user).select_related(
+        'last_message'
+    ).prefetch_related('members').order_by(F('last_message_at').desc(nulls_last=True), '-created_at')
     
     return render(request, 'chat/chat_list.html', {'rooms': rooms})
 
@@ -18,7 +22,8 @@ def chat_list(request):
 @login_required
 def chat_room(request, room_id):
     room = get_object_or_404(ChatRoom, id=room_id, members=request.user)
-    messages = room.messages.filter(is_deleted=False).select_related('sender')[:50]
+    # Newest messages first, usually straight from the cache
+    messages = recent_messages.get(room.id)['messages']
     members = room.members.all()
     
     return render(request, 'chat/chat_room.html', {
@@ -35,26 +40,19 @@ def create_chat(request):
         room_type = request.POST.get('room_type', 'direct')
         
         if room_type == 'direct' and len(user_ids) == 1:
-            # Check existing direct chat
+            # Existing direct chat by its pair key, or a new one
             other_user = get_object_or_404(User, id=user_ids[0])
-            existing = ChatRoom.objects.filter(
-                room_type='direct',
-                members=request.user
-            ).filter(members=other_user).first()
-            
-            if existing:
-                return redirect('chat:chat_room', room_id=existing.id)
+            room, created = open_direct_room(request.user, other_user.id)
+            return redirect('chat:chat_room', room_id=room.id)
         
-        # Create new room
-        room = ChatRoom.objects.create(
-            room_type=room_type,
-            name=request.POST.get('name'),
-            created_by=request.user
-        )
-        
-        ChatMembership.objects.create(user=request.user, room=room, role='admin')
-        for user_id in user_ids:
-            ChatMembership.objects.create(user_id=user_id, room=room)
+        # New room and all its memberships in one transaction
+        try:
+            user_ids = parse_user_ids(user_ids)
+        except ValueError:
+            raise Http404
+        if unknown_users(user_ids):
+            raise Http404
+        room = create_room(request.user, room_type, request.POST.get('name'), user_ids)
         
         return redirect('chat:chat_room', room_id=room.id)
     
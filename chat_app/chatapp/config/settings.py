@@ -121,6 +121,72 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels.layers.InMemoryChannelLayer'
     }
 }
+# Several workers on one host without Redis (the default cache still has to
+# be shared, a file or database cache will do):
+# CHANNEL_LAYERS = {
+#     'default': {
+#         'BACKEND': 'apps.chat.layers.UnixSocketChannelLayer',
+#         'CONFIG': {'path': '/tmp/chatapp-channels'},
+#     }
+# }
+
+# Per-process cache; point it at Redis when HTTP and WebSocket traffic are
+# served by separate processes, the chat caches rely on seeing each other's writes
+# (check --deploy refuses a per-process cache)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#         'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/1',
+#     }
+# }
+# Chat
+CHAT_TYPING_WINDOW = 0.25  # seconds typing changes are coalesced per room
+CHAT_TYPING_TTL = 5  # seconds before a typing indicator expires without a refresh
+CHAT_PRESENCE_FLUSH_INTERVAL = 30  # seconds between batched is_online/last_seen writes
+# 'sync' writes each message before broadcasting it, 'batched' broadcasts first
+# and persists in bulk, acking the sender after commit
+CHAT_MESSAGE_PERSISTENCE = os.getenv('CHAT_MESSAGE_PERSISTENCE', 'sync')
+CHAT_BATCH_MAX_MESSAGES = 100
+CHAT_BATCH_MAX_DELAY_MS = 50
+CHAT_OUTBOUND_SOFT_LIMIT = 100  # queued frames before typing/status frames get dropped
+CHAT_OUTBOUND_HIGH_WATER = 1000  # queued frames before a slow client is disconnected
+CHAT_CACHE_TTL = 60  # seconds a cached membership set or user identity is trusted
+CHAT_CACHE_MAX_ENTRIES = 10000  # per cache, least recently used entries go first
+# Take WebSocket users' username/avatar from access token claims. Claims are
+# copied at login (there is no refresh endpoint, and a refreshed token would
+# carry the same claims), so changes only show up on the next login. Whether
+# the user is still active is checked through the user cache either way.
+CHAT_JWT_TRUST_CLAIMS = False
+CHAT_COMPRESS_MIN_BYTES = 256  # smallest binary frame worth deflating for chat.msgpack.deflate clients
+CHAT_REPLAY_BUFFER_SIZE = 200  # latest events kept per room for reconnecting clients
+CHAT_REPLAY_MAX_ROOMS = 10000  # rooms with the latest events whose sequence and buffer are kept
+CHAT_REPLAY_DB_LIMIT = 100  # messages loaded when a gap is older than the buffer
+CHAT_RECENT_MESSAGES = 50  # newest messages cached per room for the room view and first API page
+CHAT_RECENT_MESSAGES_TTL = 300  # seconds
+CHAT_REACTION_SAMPLE_SIZE = 3  # reactor ids kept per emoji in Message.reaction_summary
+CHAT_STATUS_FLUSH_INTERVAL_MS = 250  # delivered/read statuses are applied per room at this interval
+CHAT_SEARCH_CONFIG = 'simple'  # PostgreSQL text search configuration of the message index
+CHAT_BULK_MEMBERS_MAX = 5000  # users per bulk room creation or membership change
+CHAT_SYNC_MAX_CHANGES = 500  # change log entries per delta sync response
+CHAT_SYNC_SETTLE_SECONDS = 5  # sync tokens only move past change log entries this old
+CHAT_SYNC_RETENTION_DAYS = 30  # change log entries kept, older sync tokens have to start over
+CHAT_EXPORT_CHUNK_SIZE = 1000  # messages read and encoded at a time by room exports
+# Token buckets per user and action: (tokens per second, burst)
+CHAT_RATE_LIMITS = {
+    'send_message': (5, 20),
+    'typing': (4, 10),
+    'read': (10, 30),
+    'react': (5, 20),
+    'presence': (1, 5),
+    'export': (0.05, 3),
+}
+
 # Celery configuration
 # CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
 # CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'